@@ -0,0 +1,113 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from .common import Molecule,sweep_fields,B
+import numpy
+import tempfile
+import shutil
+import os
+'''
+Solving the Hamiltonian and everything that is done with the eigenstates.
+'''
+
+class Sweep(Molecule):
+
+    def setup(self,molecule,Nmax):
+        Molecule.setup(self,molecule,Nmax)
+        self.Hams = Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,
+                                                                True,True,True)
+        self.fields = sweep_fields()
+        MF,self.blocks = Calculate.MF_Blocks(Nmax,self.I1,self.I2)
+
+    def time_sweep(self,molecule,Nmax):
+        Calculate.Sweep(self.Hams,self.fields)
+
+    def time_sweep_energies(self,molecule,Nmax):
+        Calculate.Sweep(self.Hams,self.fields,return_states=False)
+
+    def time_sweep_blocks(self,molecule,Nmax):
+        Calculate.Sweep(self.Hams,self.fields,blocks=self.blocks)
+
+    def peakmem_sweep(self,molecule,Nmax):
+        Calculate.Sweep(self.Hams,self.fields)
+
+class SortSmooth(Molecule):
+
+    def setup(self,molecule,Nmax):
+        Molecule.setup(self,molecule,Nmax)
+        Hams = Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,True)
+        self.energies,self.states = Calculate.Sweep(Hams,sweep_fields())
+
+    def time_sort_smooth(self,molecule,Nmax):
+        Calculate.Sort_Smooth(self.energies,self.states)
+
+    def time_sort_smooth_optimal(self,molecule,Nmax):
+        Calculate.Sort_Smooth(self.energies,self.states,method='optimal')
+
+    def peakmem_sort_smooth(self,molecule,Nmax):
+        Calculate.Sort_Smooth(self.energies,self.states)
+
+class Eigenstates(Molecule):
+
+    def setup(self,molecule,Nmax):
+        Molecule.setup(self,molecule,Nmax)
+        H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,
+                                                                        True)
+        self.energies,self.states = numpy.linalg.eigh(H0+B*Hz)
+        self.N,self.MN = Calculate.LabelStates_N_MN(self.states,Nmax,
+                                                            self.I1,self.I2)
+        self.F,self.MF = Calculate.LabelStates_F_MF(self.states,Nmax,
+                                                            self.I1,self.I2)
+        # the operators are cached by the labelling, start again
+        Molecule.setup(self,molecule,Nmax)
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self,molecule,Nmax):
+        shutil.rmtree(self.path,ignore_errors=True)
+
+    def time_label_N_MN(self,molecule,Nmax):
+        Calculate.LabelStates_N_MN(self.states,Nmax,self.I1,self.I2)
+
+    def time_label_I_MI(self,molecule,Nmax):
+        Calculate.LabelStates_I_MI(self.states,Nmax,self.I1,self.I2)
+
+    def time_label_F_MF(self,molecule,Nmax):
+        Calculate.LabelStates_F_MF(self.states,Nmax,self.I1,self.I2)
+
+    def peakmem_label_N_MN(self,molecule,Nmax):
+        Calculate.LabelStates_N_MN(self.states,Nmax,self.I1,self.I2)
+
+    def peakmem_label_I_MI(self,molecule,Nmax):
+        Calculate.LabelStates_I_MI(self.states,Nmax,self.I1,self.I2)
+
+    def peakmem_label_F_MF(self,molecule,Nmax):
+        Calculate.LabelStates_F_MF(self.states,Nmax,self.I1,self.I2)
+
+    def time_tdm(self,molecule,Nmax):
+        for M in (0,-1,1):
+            Calculate.TDM(Nmax,self.I1,self.I2,M,self.states,0)
+
+    def peakmem_tdm(self,molecule,Nmax):
+        for M in (0,-1,1):
+            Calculate.TDM(Nmax,self.I1,self.I2,M,self.states,0)
+
+    def time_export_energy(self,molecule,Nmax):
+        Calculate.Export_Energy(os.path.join(self.path,"Energy"),
+                        self.energies/Calculate.h,labels=[self.N,self.MF],
+                        headers=["N","MF"])
+
+    def peakmem_export_energy(self,molecule,Nmax):
+        Calculate.Export_Energy(os.path.join(self.path,"Energy"),
+                        self.energies/Calculate.h,labels=[self.N,self.MF],
+                        headers=["N","MF"])
+
+    def time_export_state_comp(self,molecule,Nmax):
+        Calculate.Export_State_Comp(os.path.join(self.path,"States"),Nmax,
+                        self.I1,self.I2,self.states,
+                        labels=[self.N,self.MF,self.energies/Calculate.h],
+                        headers=["N","MF","Energy (Hz)"])
+
+    def peakmem_export_state_comp(self,molecule,Nmax):
+        Calculate.Export_State_Comp(os.path.join(self.path,"States"),Nmax,
+                        self.I1,self.I2,self.states,
+                        labels=[self.N,self.MF,self.energies/Calculate.h],
+                        headers=["N","MF","Energy (Hz)"])
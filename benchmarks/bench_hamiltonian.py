@@ -0,0 +1,60 @@
+from diatom import Hamiltonian
+from .common import Molecule
+'''
+Building the Hamiltonian, one term at a time and all together.
+'''
+
+class BuildHamiltonians(Molecule):
+
+    def time_hyperfine(self,molecule,Nmax):
+        Hamiltonian.Hyperfine_Ham(Nmax,self.I1,self.I2,self.Constants)
+
+    def time_zeeman(self,molecule,Nmax):
+        Hamiltonian.Zeeman_Ham(Nmax,self.I1,self.I2,self.Constants)
+
+    def time_dc(self,molecule,Nmax):
+        Hamiltonian.DC(Nmax,self.Constants['d0'],self.I1,self.I2)
+
+    def time_ac(self,molecule,Nmax):
+        Hamiltonian.AC_iso(Nmax,self.Constants['a0'],self.I1,self.I2)
+        Hamiltonian.AC_aniso(Nmax,self.Constants['a2'],self.Constants['Beta'],
+                                                            self.I1,self.I2)
+
+    def time_all(self,molecule,Nmax):
+        Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,True,True,True)
+
+    def time_all_sparse(self,molecule,Nmax):
+        Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,True,True,True,
+                                                                sparse=True)
+
+    def peakmem_hyperfine(self,molecule,Nmax):
+        Hamiltonian.Hyperfine_Ham(Nmax,self.I1,self.I2,self.Constants)
+
+    def peakmem_zeeman(self,molecule,Nmax):
+        Hamiltonian.Zeeman_Ham(Nmax,self.I1,self.I2,self.Constants)
+
+    def peakmem_dc(self,molecule,Nmax):
+        Hamiltonian.DC(Nmax,self.Constants['d0'],self.I1,self.I2)
+
+    def peakmem_ac(self,molecule,Nmax):
+        Hamiltonian.AC_iso(Nmax,self.Constants['a0'],self.I1,self.I2)
+        Hamiltonian.AC_aniso(Nmax,self.Constants['a2'],self.Constants['Beta'],
+                                                            self.I1,self.I2)
+
+    def peakmem_all(self,molecule,Nmax):
+        Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,True,True,True)
+
+    def peakmem_all_sparse(self,molecule,Nmax):
+        Hamiltonian.Build_Hamiltonians(Nmax,self.Constants,True,True,True,
+                                                                sparse=True)
+
+class GenerateVecs(Molecule):
+
+    def time_generate_vecs(self,molecule,Nmax):
+        Hamiltonian.Generate_vecs(Nmax,self.I1,self.I2)
+
+    def time_generate_vecs_sparse(self,molecule,Nmax):
+        Hamiltonian.Generate_vecs(Nmax,self.I1,self.I2,sparse=True)
+
+    def peakmem_generate_vecs(self,molecule,Nmax):
+        Hamiltonian.Generate_vecs(Nmax,self.I1,self.I2)
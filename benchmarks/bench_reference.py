@@ -0,0 +1,123 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from .common import clear_caches,B
+import numpy
+import os
+'''
+Checks against the reference outputs in Example Scripts/Outputs.
+
+These are RbCs with Nmax = 3 at 181.5 G: the energies, state compositions
+and transition dipole moments from the ground state, and the energies of
+every level tracked by Sort_Smooth over a 250 point sweep of the magnetic
+field. The largest deviation of each is tracked, and the benchmark fails if
+it is larger than the tolerance, so that a faster version of any of the
+functions used can not silently change the answer.
+
+The signs of the eigenstates are arbitrary, so the state compositions are
+compared after matching the sign of each state, and the transition dipole
+moments are compared by magnitude.
+'''
+
+Outputs = os.path.join(os.path.dirname(os.path.dirname(
+                        os.path.abspath(__file__))),"Example Scripts","Outputs")
+
+suffix = "B_181.5G Nmax_3.csv"
+
+Nmax = 3
+
+# largest allowed deviations, the reference files have 6 decimal places
+# (1 for the energies in the state file)
+tolerances = {"energy":1e-3,          # Hz
+              "state_energy":0.1,     # Hz
+              "composition":1e-5,
+              "tdm":1e-5,             # d0
+              "sweep":1e-3,           # Hz
+              "labels":0}
+
+def _read(name):
+    return numpy.genfromtxt(os.path.join(Outputs,name+suffix),delimiter=',',
+                                                                comments='#')
+
+def compare():
+    ''' largest deviation of each quantity from the reference files '''
+    clear_caches()
+    Constants = Hamiltonian.RbCs
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    h = Calculate.h
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,Constants,True)
+
+    energies,states = numpy.linalg.eigh(H0+B*Hz)
+    N,MN = Calculate.LabelStates_N_MN(states,Nmax,I1,I2)
+    F,MF = Calculate.LabelStates_F_MF(states,Nmax,I1,I2)
+    errors = {}
+
+    tdm = _read("TDM")
+    loc = numpy.where(numpy.logical_and(N==0,MF==5))[0][0]
+    dipoles = numpy.array([Calculate.TDM(Nmax,I1,I2,M,states,loc)
+                                                        for M in (0,-1,1)])
+    errors["energy"] = numpy.amax(numpy.abs(energies/h-tdm[:,5]))
+    errors["tdm"] = numpy.amax(numpy.abs(numpy.abs(dipoles.T)
+                                                    -numpy.abs(tdm[:,2:5])))
+    labels = numpy.sum(N != tdm[:,0])+numpy.sum(MF != tdm[:,1])
+
+    composition = _read("States")
+    sign = numpy.sign(numpy.sum(composition[:,3:]*states.T.real,axis=1))
+    errors["state_energy"] = numpy.amax(numpy.abs(energies/h
+                                                        -composition[:,2]))
+    errors["composition"] = numpy.amax(numpy.abs(composition[:,3:]
+                                                    -sign[:,None]*states.T))
+    labels += numpy.sum(N != composition[:,0])+numpy.sum(MF != composition[:,1])
+
+    sweep = _read("Energies")
+    # the fields in the file are only given to 6 decimal places in G, which
+    # moves the energies by a few mHz, so the grid of the original
+    # calculation is used instead
+    fields = numpy.zeros((sweep.shape[1]-2,3))
+    fields[:,0] = numpy.linspace(1e-9,B,sweep.shape[1]-2)
+    levels,tracked = Calculate.Sweep((H0,Hz,HDC,HAC),fields)
+    levels,tracked = Calculate.Sort_Smooth(levels/h,tracked)
+    N,MN = Calculate.LabelStates_N_MN(tracked[-1],Nmax,I1,I2)
+    F,MF = Calculate.LabelStates_F_MF(tracked[-1],Nmax,I1,I2)
+    errors["sweep"] = numpy.amax(numpy.abs(levels.T-sweep[1:,2:]))
+    labels += numpy.sum(N != sweep[1:,0])+numpy.sum(MF != sweep[1:,1])
+    errors["labels"] = int(labels)
+    return errors
+
+def _check(errors,name):
+    if not errors[name] <= tolerances[name]:
+        raise AssertionError("{:s} differs from the reference by {:g}, more "
+                "than the tolerance of {:g}".format(name,errors[name],
+                                                        tolerances[name]))
+    return errors[name]
+
+class Reference:
+    number = 1
+    timeout = 600
+
+    def setup_cache(self):
+        return compare()
+
+    def track_energy(self,errors):
+        return _check(errors,"energy")
+    track_energy.unit = "Hz"
+
+    def track_state_energy(self,errors):
+        return _check(errors,"state_energy")
+    track_state_energy.unit = "Hz"
+
+    def track_composition(self,errors):
+        return _check(errors,"composition")
+    track_composition.unit = "amplitude"
+
+    def track_tdm(self,errors):
+        return _check(errors,"tdm")
+    track_tdm.unit = "d0"
+
+    def track_sweep(self,errors):
+        return _check(errors,"sweep")
+    track_sweep.unit = "Hz"
+
+    def track_labels(self,errors):
+        return _check(errors,"labels")
+    track_labels.unit = "mismatches"
@@ -0,0 +1,48 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+import numpy
+'''
+Set up shared by the benchmarks.
+
+Every benchmark class that derives from Molecule is run for each of the
+three molecules and for Nmax from 1 to 6. The operator caches in diatom are
+cleared before each measurement so that the cost of building the operators
+is always included, and each measurement is a single call (number = 1).
+'''
+
+molecules = {"RbCs":Hamiltonian.RbCs,
+             "K41Cs":Hamiltonian.K41Cs,
+             "K40Rb":Hamiltonian.K40Rb}
+
+# points in the benchmarked sweeps, kept small as a single dense solve takes
+# seconds for Nmax = 6
+points = 5
+
+B = 181.5e-4
+
+def clear_caches():
+    ''' empty every cache of operators in the full basis '''
+    for cached in (Hamiltonian.Angular_Momentum,Hamiltonian._dipole_vector,
+                    Hamiltonian._aniso_components,Hamiltonian.Compile_Molecule,
+                    Calculate.Dipole_Operators):
+        cached.cache_clear()
+
+def sweep_fields(n=points,Bmax=B):
+    ''' (n,3) fields with B from 1 nT to Bmax and no electric field or light '''
+    fields = numpy.zeros((n,3))
+    fields[:,0] = numpy.linspace(1e-9,Bmax,n)
+    return fields
+
+class Molecule:
+    ''' base class for benchmarks over the molecules and Nmax '''
+    params = (list(molecules),[1,2,3,4,5,6])
+    param_names = ("molecule","Nmax")
+    number = 1
+    timeout = 600
+
+    def setup(self,molecule,Nmax):
+        self.Constants = molecules[molecule]
+        self.Nmax = Nmax
+        self.I1 = self.Constants['I1']
+        self.I2 = self.Constants['I2']
+        clear_caches()
@@ -0,0 +1,107 @@
+import argparse
+import importlib
+import inspect
+import itertools
+import os
+import re
+import sys
+import time
+import tracemalloc
+import traceback
+'''
+Run the benchmarks without asv.
+
+asv (https://asv.readthedocs.io) is the intended way to run the suite, as
+it keeps a history of the results for every commit, e.g. ``asv run`` or
+``asv continuous master HEAD`` from the top of the repository. This script
+runs the same benchmarks once each in the current environment and prints a
+table, which is enough to check that they work or to compare two versions
+by hand. peakmem benchmarks are measured with tracemalloc here, which only
+sees memory allocated through Python (including numpy arrays).
+
+Example::
+
+    python -m benchmarks.run Sweep --nmax 3
+'''
+
+_kinds = ("time_","peakmem_","track_")
+
+def _modules():
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(here)):
+        if name.startswith("bench_") and name.endswith(".py"):
+            yield importlib.import_module("benchmarks."+name[:-3])
+
+def _benchmarks(pattern):
+    for module in _modules():
+        for cname,cls in inspect.getmembers(module,inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            for name,method in inspect.getmembers(cls,inspect.isfunction):
+                full = "{:s}.{:s}.{:s}".format(module.__name__.split(".")[-1],
+                                                                cname,name)
+                if name.startswith(_kinds) and re.search(pattern,full):
+                    yield full,cls,name
+
+def _measure(instance,name,args):
+    method = getattr(instance,name)
+    if name.startswith("time_"):
+        start = time.perf_counter()
+        method(*args)
+        return "{:.4g} s".format(time.perf_counter()-start)
+    if name.startswith("peakmem_"):
+        tracemalloc.start()
+        try:
+            method(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return "{:.4g} MB".format(peak/2**20)
+    value = method(*args)
+    return "{:g} {:s}".format(value,getattr(method,"unit",""))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmarks "
+                                                        "without asv.")
+    parser.add_argument("pattern",nargs="?",default="",
+                        help="regular expression for the benchmarks to run")
+    parser.add_argument("--nmax",type=int,default=None,
+                        help="largest Nmax to run")
+    options = parser.parse_args(argv)
+
+    failed = 0
+    caches = {}
+    for full,cls,name in _benchmarks(options.pattern):
+        params = getattr(cls,"params",[[]])
+        names = getattr(cls,"param_names",())
+        combinations = itertools.product(*params) if params != [[]] else [()]
+        for combination in combinations:
+            setting = dict(zip(names,combination))
+            if options.nmax is not None and \
+                                setting.get("Nmax",0) > options.nmax:
+                continue
+            instance = cls()
+            label = "{:s}({:s})".format(full,", ".join(str(x) for x in
+                                                                combination))
+            try:
+                args = list(combination)
+                if hasattr(cls,"setup_cache"):
+                    if cls not in caches:
+                        caches[cls] = instance.setup_cache()
+                    args = [caches[cls]]+args
+                if hasattr(instance,"setup"):
+                    instance.setup(*args)
+                try:
+                    result = _measure(instance,name,args)
+                finally:
+                    if hasattr(instance,"teardown"):
+                        instance.teardown(*args)
+            except Exception:
+                failed += 1
+                result = "failed"
+                traceback.print_exc()
+            print("{:<70s} {:>16s}".format(label,result),flush=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+from diatom import Hamiltonian
+import diatom
+import numpy
+import scipy.sparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+'''
+This module keeps an on-disk cache of the Hamiltonians made by
+Hamiltonian.Build_Hamiltonians, so that the construction only has to be done
+once for each molecule and Nmax.
+
+Each entry is a directory named by a hash of everything that goes into the
+build: the molecular constants, Nmax, which terms are included, the version
+of the package, the cache format and a hash of the source of Hamiltonian.py,
+so that editing the builders never serves stale matrices. The terms are saved as raw .npy files so that they can be
+memory mapped when they are loaded.
+
+The cache lives in the directory given by the environment variable
+DIATOM_CACHE (default ~/.cache/diatom) and is kept below DIATOM_CACHE_SIZE
+bytes (default 2 GB) by removing the least recently used entries.
+'''
+
+###############################################################################
+# Cache configuration                                                         #
+###############################################################################
+
+cache_dir = os.environ.get("DIATOM_CACHE",
+                        os.path.join(os.path.expanduser("~"),".cache","diatom"))
+
+max_size = int(float(os.environ.get("DIATOM_CACHE_SIZE",2e9)))
+
+_terms = ("H0","Hz","HDC","HAC")
+
+# bump whenever the layout of an entry on disk changes
+_format = 1
+
+def _source_hash():
+    ''' sha256 of Hamiltonian.py, or None if the source cannot be read '''
+    try:
+        with open(Hamiltonian.__file__,"rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (OSError,TypeError):
+        return None
+
+_source = _source_hash()
+
+def Set_Cache(path=None,size=None):
+    ''' Change the cache directory and/or its maximum size
+
+    kwargs:
+        path (str) - directory to store the cache in
+        size (int) - maximum total size of the cache in bytes
+    '''
+    global cache_dir,max_size
+    if path is not None:
+        cache_dir = str(path)
+    if size is not None:
+        max_size = int(size)
+
+def Cache_Key(Nmax,Constants,zeeman=False,EDC=False,AC=False,sparse=False):
+    ''' Key of a set of Hamiltonians in the cache
+
+    The key is a sha256 hash of the molecular constants, Nmax, the terms that
+    are included, the version of diatom, the cache format and the source of
+    Hamiltonian.py, so that any change to any of them gives a different entry.
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+        zeeman,EDC,AC (Boolean) - Switches for the terms in the Hamiltonian
+
+    kwargs:
+        sparse (bool) - whether the terms are scipy.sparse.csr_matrix
+
+    Returns:
+        key (str) - hexadecimal hash
+    '''
+    description = {"constants":{k:repr(float(v)) for k,v in Constants.items()},
+                    "Nmax":int(Nmax),
+                    "terms":[bool(zeeman),bool(EDC),bool(AC)],
+                    "sparse":bool(sparse),
+                    "version":diatom.__version__,
+                    "format":_format,
+                    "source":_source}
+    text = json.dumps(description,sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _size(path):
+    ''' total size in bytes of the files in a directory '''
+    total = 0
+    for root,dirs,files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root,f))
+            except OSError:
+                pass
+    return total
+
+def _remove(path):
+    ''' remove a directory without anyone seeing it half deleted
+
+    The directory is renamed first, which is atomic, so only one process can
+    succeed and readers see either the whole entry or nothing.
+    '''
+    trash = path+".del-"+uuid.uuid4().hex
+    try:
+        os.rename(path,trash)
+    except OSError:
+        return
+    shutil.rmtree(trash,ignore_errors=True)
+
+def _save(path,Hams):
+    ''' write the terms into the directory path '''
+    manifest = {}
+    for name,H in zip(_terms,Hams):
+        if scipy.sparse.issparse(H):
+            H = scipy.sparse.csr_matrix(H)
+            for part in ("data","indices","indptr"):
+                numpy.save(os.path.join(path,name+"."+part+".npy"),
+                                                            getattr(H,part))
+            manifest[name] = {"format":"csr","shape":list(H.shape)}
+        elif isinstance(H,numpy.ndarray):
+            numpy.save(os.path.join(path,name+".npy"),H)
+            manifest[name] = {"format":"dense"}
+        else:
+            # switched off terms are stored as scalars
+            manifest[name] = {"format":"scalar","value":float(H)}
+    # the manifest is written last, an entry without one is incomplete
+    with open(os.path.join(path,"manifest.json"),"w") as f:
+        json.dump(manifest,f)
+
+def _load(path,mmap=True):
+    ''' read the terms back from the directory path '''
+    with open(os.path.join(path,"manifest.json"),"r") as f:
+        manifest = json.load(f)
+    mode = "r" if mmap else None
+    Hams = []
+    for name in _terms:
+        entry = manifest[name]
+        if entry["format"] == "csr":
+            data,indices,indptr = [numpy.load(os.path.join(path,
+                        name+"."+part+".npy"),mmap_mode=mode)
+                        for part in ("data","indices","indptr")]
+            Hams.append(scipy.sparse.csr_matrix((data,indices,indptr),
+                                        shape=tuple(entry["shape"]),copy=False))
+        elif entry["format"] == "dense":
+            Hams.append(numpy.load(os.path.join(path,name+".npy"),
+                                                            mmap_mode=mode))
+        else:
+            Hams.append(entry["value"])
+    # update the time of last use for the LRU eviction
+    os.utime(os.path.join(path,"manifest.json"))
+    return tuple(Hams)
+
+def Evict(size=None,path=None,keep=()):
+    ''' Remove the least recently used entries until the cache fits in size
+
+    kwargs:
+        size (int) - maximum total size in bytes, defaults to the module setting
+        path (str) - cache directory, defaults to the module setting
+        keep (list of str) - keys that must not be removed
+    '''
+    size = max_size if size is None else size
+    path = cache_dir if path is None else path
+    if not os.path.isdir(path):
+        return
+
+    entries = []
+    for key in os.listdir(path):
+        manifest = os.path.join(path,key,"manifest.json")
+        if "." in key:
+            # temporary directories left behind by processes that died
+            # part way through writing an entry
+            try:
+                if time.time()-os.path.getmtime(os.path.join(path,key)) > 3600:
+                    shutil.rmtree(os.path.join(path,key),ignore_errors=True)
+            except OSError:
+                pass
+            continue
+        if not os.path.isfile(manifest):
+            continue
+        try:
+            entries.append((os.path.getmtime(manifest),key,
+                                            _size(os.path.join(path,key))))
+        except OSError:
+            continue
+
+    total = sum(e[2] for e in entries)
+    for used,key,nbytes in sorted(entries):
+        if total <= size:
+            break
+        if key in keep:
+            continue
+        _remove(os.path.join(path,key))
+        total -= nbytes
+
+def Clear(path=None):
+    ''' Remove every entry from the cache
+
+    kwargs:
+        path (str) - cache directory, defaults to the module setting
+    '''
+    Evict(size=0,path=path)
+
+def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False,
+                                    sparse=False,mmap=True,path=None):
+    ''' Return the hyperfine hamiltonian, from the cache if possible.
+
+        Drop-in replacement for Hamiltonian.Build_Hamiltonians. If the
+        Hamiltonians have been built before they are loaded from disk,
+        otherwise they are built and saved for next time.
+
+        Several processes can fill the cache at once. Each builds into its
+        own temporary directory which is renamed into place when complete, so
+        an entry is only ever seen whole.
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            Constants (Dictionary) - Dict of molecular constants
+            zeeman,EDC,AC (Boolean) - Switches for turning off parts of the total Hamiltonian
+
+        kwargs:
+            sparse (bool) - return scipy.sparse.csr_matrix terms (default = False)
+            mmap (bool) - memory map the arrays read from disk, these are read-only (default = True)
+            path (str) - cache directory, defaults to the module setting
+
+        Returns:
+            H0,Hz,HDC,HAC (numpy.ndarray): Each of the terms in the Hamiltonian.
+    '''
+    path = cache_dir if path is None else path
+    key = Cache_Key(Nmax,Constants,zeeman,EDC,AC,sparse)
+    entry = os.path.join(path,key)
+
+    try:
+        return _load(entry,mmap)
+    except (OSError,ValueError,KeyError):
+        # not there, incomplete or removed while we were reading it
+        pass
+
+    Hams = Hamiltonian.Build_Hamiltonians(Nmax,Constants,zeeman,EDC,AC,sparse)
+
+    os.makedirs(path,exist_ok=True)
+    temp = entry+".tmp-{:d}-".format(os.getpid())+uuid.uuid4().hex
+    os.makedirs(temp)
+    try:
+        _save(temp,Hams)
+        os.rename(temp,entry)
+    except OSError:
+        # another process got there first (or the disk is full), either way
+        # we already have the Hamiltonians to hand
+        shutil.rmtree(temp,ignore_errors=True)
+        return Hams
+
+    Evict(path=path,keep=(key,))
+
+    if mmap:
+        try:
+            return _load(entry,mmap)
+        except (OSError,ValueError,KeyError):
+            pass
+    return Hams
@@ -1,9 +1,17 @@
 from diatom import Hamiltonian
+from diatom import Cache
+from diatom import Profiling
 import numpy
 import warnings
-import pyprind
 import sys
 import scipy.constants
+import scipy.sparse
+import scipy.linalg
+import scipy.sparse.linalg
+import scipy.sparse.csgraph
+import scipy.optimize
+import scipy.interpolate
+from functools import lru_cache
 '''
 This module is designed as a more user-friendly version of the Hamiltonian module,
 allowing simple wrappers for common problems.
@@ -58,7 +66,9 @@ K40Rb = Hamiltonian.K40Rb
 # This is the main build function and one that the user will actually have to
 # use.
 
-def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False):
+@Profiling.profiled()
+def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False,
+                                                    sparse=False,cache=False):
     ''' Return the hyperfine hamiltonian.
 
         This function builds the hamiltonian matrices for evalutation so that
@@ -72,11 +82,17 @@ def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False):
             I1_mag,I2_mag (float) - magnitude of the nuclear spins
             Constants (Dictionary) - Dict of molecular constants
             zeeman,EDC,AC (Boolean) - Switches for turning off parts of the total Hamiltonian can save significant time on calculations where DC and AC fields are not required due to nested for loops
+            sparse (Boolean) - return scipy.sparse.csr_matrix terms instead of dense arrays
+            cache (Boolean) - load the terms from the on-disk cache in diatom.Cache if they have been built before, arrays from the cache are read-only
 
         Returns:
             H0,Hz,HDC,HAC (numpy.ndarray): Each of the terms in the Hamiltonian.
         '''
-    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,Constants,zeeman,EDC,AC)
+    if cache:
+        return Cache.Build_Hamiltonians(Nmax,Constants,zeeman,EDC,AC,sparse)
+
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,Constants,zeeman,EDC,AC,
+                                                                    sparse)
 
     return H0,Hz,HDC,HAC
 
@@ -84,22 +100,66 @@ def SolveQuadratic(a,b,c):
     ''' Solve a quadratic equation
 
     for a*x^2+b*x+c=0 this is a simple function to solve the quadratic formula for x. returns the most
-    positive value of x supported.
+    positive value of x supported. The coefficients can also be arrays, in
+    which case the equation is solved elementwise.
 
     Args:
-        a,b,c (floats) - coefficients in quadratic
+        a,b,c (floats or numpy.ndarray) - coefficients in quadratic
 
     Returns:
-        x (float) - maximum value of x supported by equation
+        x (float or numpy.ndarray) - maximum value of x supported by equation
 
     '''
 
     d = b**2-4*a*c # discriminant
-    x1 = (-b+numpy.sqrt((b**2)-(4*(a*c))))/(2*a)
-    x2 = (-b-numpy.sqrt((b**2)-(4*(a*c))))/(2*a)
+    x1 = (-b+numpy.sqrt(d))/(2*a)
+    x2 = (-b-numpy.sqrt(d))/(2*a)
+
+    return numpy.maximum(x1,x2)
 
-    return max([x1,x2])
+def _expectation(Op,States):
+    ''' expectation value of Op for each column of States
 
+    Both the operator and the states can be dense numpy arrays or
+    scipy.sparse matrices, nothing is made dense in the full basis. If Op is
+    a 1D array it is taken to be the diagonal of a diagonal operator, which
+    only needs |psi|^2. Dense States can also be a (steps,dim,k) stack, as
+    from Sweep.
+
+    Args:
+        Op (numpy.ndarray or scipy.sparse matrix) - square operator, or the diagonal of one
+        States (numpy.ndarray or scipy.sparse matrix) - states stored as columns
+
+    Returns:
+        X (numpy.ndarray) - array of <psi|Op|psi>, one per state, with shape (k,) or (steps,k)
+    '''
+    diagonal = isinstance(Op,numpy.ndarray) and Op.ndim == 1
+    if scipy.sparse.issparse(States):
+        States = scipy.sparse.csc_matrix(States)
+        if diagonal:
+            weights = States.multiply(States.conj()).real
+            return numpy.asarray(weights.T.dot(Op)).ravel()
+        X = States.conj().multiply(Op.dot(States)).sum(axis=0)
+        return numpy.asarray(X).ravel()
+
+    States = numpy.asarray(States)
+    if States.ndim == 3:
+        # one step at a time keeps the temporaries in cache, which is faster
+        # than a single product over the whole stack
+        return numpy.array([_expectation(Op,S) for S in States])
+    if diagonal:
+        return Op.dot(States.real**2+States.imag**2)
+    return numpy.einsum('ik,ik->k',numpy.conj(States),Op.dot(States))
+
+def _subset(States,locs):
+    ''' the states (columns) in locs, for a single set or a stack '''
+    if locs is None:
+        return States
+    if scipy.sparse.issparse(States):
+        return States[:,locs]
+    return numpy.asarray(States)[...,locs]
+
+@Profiling.profiled()
 def LabelStates_N_MN(States,Nmax,I1,I2,locs=None):
     ''' Label states by N,MN
 
@@ -111,9 +171,13 @@ def LabelStates_N_MN(States,Nmax,I1,I2,locs=None):
     is provided. Each element in the list locs corresponds to the index for the
     states to label.
 
+    N^2 and N_z are both diagonal in the uncoupled basis, so no matrix
+    products are needed. States can be a (steps,dim,k) stack from a sweep, in
+    which case the labels have shape (steps,k).
+
     Args:
 
-        States (Numpy.ndarray) - array of eigenstates, from linalg.eig
+        States (Numpy.ndarray) - array of eigenstates, from linalg.eig. Can also be a scipy.sparse matrix
         Nmax (int) - maximum rotational state in calculation
         I1 , I2 (float) - nuclear spin quantum numbers
 
@@ -124,21 +188,17 @@ def LabelStates_N_MN(States,Nmax,I1,I2,locs=None):
         Nlabels,MNlabels (list of ints) - list of values of N,MN
 
     '''
-    if locs != None:
-        States = States[:,locs]
-    N, I1,I2 = Generate_vecs(Nmax,I1,I2)
-
-    N2 = vector_dot(N,N)
-    Nz = N[2]
+    States = _subset(States,locs)
+    diagonal = Hamiltonian.Angular_Momentum(Nmax,I1,I2)['diagonal']
 
-    Nlabels = numpy.einsum('ik,ij,jk->k',numpy.conj(States),N2,States)
-    Nlabels = numpy.round([SolveQuadratic(1,1,-1*x)  for x in Nlabels],0).real
+    Nlabels = _expectation(diagonal['N2'],States)
+    Nlabels = numpy.round(SolveQuadratic(1,1,-1*Nlabels),0)
 
-    MNlabels = numpy.round(numpy.einsum('ik,ij,jk->k',
-                                    numpy.conj(States),Nz,States),0).real
+    MNlabels = numpy.round(_expectation(diagonal['Nz'],States),0)
 
     return Nlabels,MNlabels
 
+@Profiling.profiled()
 def LabelStates_I_MI(States,Nmax,I1,I2,locs = None):
     ''' Label states by I,MI
 
@@ -150,8 +210,11 @@ def LabelStates_I_MI(States,Nmax,I1,I2,locs = None):
     is provided. Each element in the list locs corresponds to the index for the
     states to label.
 
+    States can be a (steps,dim,k) stack from a sweep, in which case the
+    labels have shape (steps,k).
+
     Args:
-        States (Numpy.ndarray) - array of eigenstates, from linalg.eig
+        States (Numpy.ndarray) - array of eigenstates, from linalg.eig. Can also be a scipy.sparse matrix
         Nmax (int) - maximum rotational state in calculation
         I1 , I2 (float) - nuclear spin quantum numbers
 
@@ -162,25 +225,17 @@ def LabelStates_I_MI(States,Nmax,I1,I2,locs = None):
         Ilabels,MIlabels (list of ints) - list of values of I,MI
 
     '''
-    if locs != None:
-        States = States[:,locs]
-
-    I = I1 + I2
-
-    N, I1,I2 = Generate_vecs(Nmax,I1,I2)
-
-    I2 = vector_dot(I,I)
-
-    Iz = I[2]
+    States = _subset(States,locs)
+    ops = Hamiltonian.Angular_Momentum(Nmax,I1,I2)
 
-    Ilabels = numpy.einsum('ik,ij,jk->k',numpy.conj(States),I2,States)
-    Ilabels = numpy.round([SolveQuadratic(1,1,-1*x)  for x in Ilabels],1).real
+    Ilabels = _expectation(ops['I_2'],States).real
+    Ilabels = numpy.round(SolveQuadratic(1,1,-1*Ilabels),1)
 
-    MIlabels = numpy.round(numpy.einsum('ik,ij,jk->k',
-                                    numpy.conj(States),Iz,States),1).real
+    MIlabels = numpy.round(_expectation(ops['diagonal']['Iz'],States),1)
 
     return Ilabels,MIlabels
 
+@Profiling.profiled()
 def LabelStates_F_MF(States,Nmax,I1,I2,locs=None):
     ''' Label states by F,MF
 
@@ -192,8 +247,11 @@ def LabelStates_F_MF(States,Nmax,I1,I2,locs=None):
     is provided. Each element in the list locs corresponds to the index for the
     states to label.
 
+    States can be a (steps,dim,k) stack from a sweep, in which case the
+    labels have shape (steps,k).
+
     Args:
-        States (Numpy.ndarray) - array of eigenstates, from linalg.eig
+        States (Numpy.ndarray) - array of eigenstates, from linalg.eig. Can also be a scipy.sparse matrix
         Nmax (int) - maximum rotational state in calculation
         I1 , I2 (float) - nuclear spin quantum numbers
 
@@ -204,28 +262,17 @@ def LabelStates_F_MF(States,Nmax,I1,I2,locs=None):
         Flabels,MFlabels (list of ints) - list of values of F,MF
 
     '''
+    States = _subset(States,locs)
+    ops = Hamiltonian.Angular_Momentum(Nmax,I1,I2)
 
-    if locs != None:
-        States = States[:,locs]
-
-    N, I1,I2 = Generate_vecs(Nmax,I1,I2)
-
-    F = N + I1 + I2
-
-    F2 = vector_dot(F,F)
-
-    Fz = F[2]
-
-
-    Flabels = numpy.einsum('ik,ij,jk->k',numpy.conj(States),F2,States)
-    Flabels = numpy.round([SolveQuadratic(1,1,-1*x)  for x in Flabels],1).real
+    Flabels = _expectation(ops['F2'],States).real
+    Flabels = numpy.round(SolveQuadratic(1,1,-1*Flabels),1)
 
-    MFlabels = numpy.round(numpy.einsum('ik,ij,jk->k',
-                                    numpy.conj(States),Fz,States),1).real
+    MFlabels = numpy.round(_expectation(ops['diagonal']['Fz'],States),1)
 
     return Flabels,MFlabels
 
-def dipole(Nmax,I1,I2,d,M):
+def dipole(Nmax,I1,I2,d,M,sparse=False):
     ''' Generates the induced dipole moment operator for a Rigid rotor.
     Expanded to cover state  vectors in the uncoupled hyperfine basis.
 
@@ -235,32 +282,28 @@ def dipole(Nmax,I1,I2,d,M):
         d (float) - permanent dipole moment
         M (float) - index indicating the helicity of the dipole field
 
+    kwargs:
+        sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
+
     Returns:
         Dmat (numpy.ndarray) - dipole matrix
     '''
-    shape = numpy.sum(numpy.array([2*x+1 for x in range(0,Nmax+1)]))
-    Dmat = numpy.zeros((shape,shape),dtype= numpy.complex)
-    i =0
-    j =0
-    for N1 in range(0,Nmax+1):
-        for M1 in range(N1,-(N1+1),-1):
-            for N2 in range(0,Nmax+1):
-                for M2 in range(N2,-(N2+1),-1):
-                    Dmat[i,j]=d*numpy.sqrt((2*N1+1)*(2*N2+1))*(-1)**(M1)*\
-                    wigner_3j(N1,1,N2,-M1,M,M2)*wigner_3j(N1,1,N2,0,0,0)
-                    j+=1
-            j=0
-            i+=1
+    Dmat = d*Hamiltonian.Rotational_Tensor(Nmax,1,M).astype(numpy.complex128)
 
     shape1 = int(2*I1+1)
 
     shape2 = int(2*I2+1)
 
+    if sparse:
+        return scipy.sparse.kron(scipy.sparse.csr_matrix(Dmat),
+                    scipy.sparse.identity(shape1*shape2),format='csr')
+
     Dmat = numpy.kron(Dmat,numpy.kron(numpy.identity(shape1),
                                                     numpy.identity(shape2)))
 
     return Dmat
 
+@Profiling.profiled()
 def TDM(Nmax,I1,I2,M,States,gs,locs=None):
     ''' calculate TDM between gs and States
 
@@ -272,7 +315,7 @@ def TDM(Nmax,I1,I2,M,States,gs,locs=None):
         Nmax (int): Maximum rotational quantum number in original calculations
         I1,I2 (float): nuclear spin quantum numbers
         M (float): Helicity of Transition, -1 = S+, 0 = Pi, +1 = S-
-        States (numpy.ndarray): matrix for eigenstates of problem output from numpy.linalg.eig
+        States (numpy.ndarray): matrix for eigenstates of problem output from numpy.linalg.eig, can also be a scipy.sparse matrix
         gs (int): index of ground state.
 
     kwargs:
@@ -284,17 +327,1039 @@ def TDM(Nmax,I1,I2,M,States,gs,locs=None):
     
     '''
 
-    dipole_op = dipole(Nmax,I1,I2,1,M)
+    dipole_op = Dipole_Operators(Nmax,I1,I2)[_helicities.index(M)]
 
-    gs = numpy.conj(States[:,gs])
-    if locs != None :
+    if scipy.sparse.issparse(States):
+        States = scipy.sparse.csc_matrix(States)
+        gs = numpy.conj(States[:,gs].toarray().ravel())
+    else:
+        gs = numpy.conj(States[:,gs])
+    if locs is not None :
         States =  States[:,locs]
 
-    TDM =  numpy.einsum('i,ij,jk->k',gs,dipole_op,States).real
+    # <gs|d|k> = sum_ij gs*_i d_ij S_jk, do the small product first
+    TDM =  States.T.dot(dipole_op.T.dot(gs)).real
 
     return TDM
 
-def Sort_Smooth(Energy,States,pb=False):
+# helicities of the three dipole operators, in [sigma-,pi,sigma+] order
+_helicities = (+1,0,-1)
+
+@lru_cache(maxsize=16)
+@Profiling.profiled()
+def Dipole_Operators(Nmax,I1,I2):
+    ''' The three spherical components of the dipole operator
+
+    Cached for each (Nmax,I1,I2), in units of the permanent dipole moment.
+    The operators are shared between all callers and must not be modified.
+
+    Args:
+        Nmax (int) - maximum rotational states
+        I1,I2 (float) - nuclear spin quantum numbers
+
+    Returns:
+        ops (tuple of scipy.sparse.csr_matrix) - dipole operators for M = +1,0,-1 (sigma-,pi,sigma+)
+    '''
+    return tuple(dipole(Nmax,I1,I2,1,M,sparse=True) for M in _helicities)
+
+def _selection_blocks(States,Nmax,I1,I2):
+    ''' group states by their (N,MF) labels
+
+    Returns the sorted labels and a dict from (N,MF) to the state indices.
+    '''
+    N,MN = LabelStates_N_MN(States,Nmax,I1,I2)
+    F,MF = LabelStates_F_MF(States,Nmax,I1,I2)
+    groups = {}
+    for index,key in enumerate(zip(N.real.astype(int),MF.real)):
+        groups.setdefault(key,[]).append(index)
+    return {key:numpy.array(value) for key,value in groups.items()}
+
+def _transition_matrix(ops,States,bra,ket,selection,Nmax,I1,I2):
+    ''' <bra|d_M|ket> for the three polarisations at one field '''
+    if scipy.sparse.issparse(States):
+        States = scipy.sparse.csc_matrix(States)
+    Bra = States if bra is None else States[:,bra]
+    Ket = States if ket is None else States[:,ket]
+
+    if not selection:
+        # <a|d|b> = sum_ij a*_i d_ij b_j, the sparse product first
+        T = [Bra.conj().T.dot(D.dot(Ket)) for D in ops]
+        return numpy.array([X.toarray() if scipy.sparse.issparse(X) else X
+                                                    for X in T])
+
+    bra_groups = _selection_blocks(Bra,Nmax,I1,I2)
+    ket_groups = _selection_blocks(Ket,Nmax,I1,I2)
+    T = numpy.zeros((3,Bra.shape[1],Ket.shape[1]),dtype=numpy.complex128)
+    for (N,MF),b in ket_groups.items():
+        for p,(M,D) in enumerate(zip(_helicities,ops)):
+            # <N',MF'|d_M|N,MF> needs N' = N+-1 and MF' = MF+M
+            a = [bra_groups.get((N+dN,MF+M)) for dN in (-1,1)]
+            a = [x for x in a if x is not None]
+            if len(a) == 0:
+                continue
+            a = numpy.concatenate(a)
+            X = Bra[:,a].conj().T.dot(D.dot(Ket[:,b]))
+            if scipy.sparse.issparse(X):
+                X = X.toarray()
+            T[p,a[:,None],b[None,:]] = X
+    return T
+
+@Profiling.profiled()
+def Transition_Dipoles(Nmax,I1,I2,States,bra=None,ket=None,selection=False):
+    ''' Transition dipole moments between eigenstates, for all polarisations
+
+    Returns the complex matrix elements <a|d_M|b> for every pair of states a
+    (from bra) and b (from ket), for all three polarisations at once, in
+    units of the permanent dipole moment (d0). The dipole operators come from
+    the cache in Dipole_Operators.
+
+    With selection = True only the elements allowed by the electric dipole
+    selection rules, N' = N+-1 and MF' = MF+M, are calculated and the rest
+    are left as zero. The states are assigned N and MF from LabelStates_N_MN
+    and LabelStates_F_MF, so this is only valid when these are good quantum
+    numbers, i.e. with the fields along z and electric fields small enough
+    that N is not mixed.
+
+    States can also be a (steps,dim,k) stack of eigenstates from a field
+    sweep, in which case the result has an extra leading axis of length steps.
+
+    Args:
+        Nmax (int): Maximum rotational quantum number in original calculations
+        I1,I2 (float): nuclear spin quantum numbers
+        States (numpy.ndarray): eigenstates stored as columns, or a (steps,dim,k) stack. A single set can also be a scipy.sparse matrix
+
+    kwargs:
+        bra (list of ints): indices of the states a, defaults to all
+        ket (list of ints): indices of the states b, defaults to all
+        selection (bool): only calculate the elements allowed by the selection rules (default = False)
+
+    Returns:
+        TDM (numpy.ndarray): complex array of shape (3,len(bra),len(ket)), or (steps,3,len(bra),len(ket)) for a stack, in [sigma-,pi,sigma+] (M = +1,0,-1) order
+    '''
+    ops = Dipole_Operators(Nmax,I1,I2)
+    if not scipy.sparse.issparse(States) and numpy.ndim(States) == 3:
+        return numpy.array([_transition_matrix(ops,S,bra,ket,selection,
+                                            Nmax,I1,I2) for S in States])
+    return _transition_matrix(ops,States,bra,ket,selection,Nmax,I1,I2)
+
+def _offdiagonal_bound(H):
+    ''' sum of |H_ij| over j != i for each row i, or an upper bound on it
+    for a KroneckerHamiltonian. None for any other kind of operator. '''
+    if isinstance(H,Hamiltonian.KroneckerHamiltonian):
+        shapeN,shapeS = H.shapes
+        bound = numpy.zeros(H.shape[0])
+        for coeff,A,B in H.terms:
+            if A is None:
+                a,da = numpy.ones(shapeN),numpy.ones(shapeN)
+            else:
+                a = numpy.asarray(abs(A).sum(axis=1)).ravel()
+                da = numpy.abs(A.diagonal())
+            if B is None:
+                b,db = numpy.ones(shapeS),numpy.ones(shapeS)
+            else:
+                b = numpy.abs(B).sum(axis=1)
+                db = numpy.abs(numpy.diagonal(B))
+            bound += abs(coeff)*(numpy.kron(a,b)-numpy.kron(da,db))
+        return bound
+    if scipy.sparse.issparse(H):
+        return numpy.asarray(abs(H).sum(axis=1)).ravel()-\
+                                                    numpy.abs(H.diagonal())
+    if isinstance(H,numpy.ndarray):
+        return numpy.abs(H).sum(axis=1)-numpy.abs(numpy.diagonal(H))
+    return None
+
+def Solve_Iterative(H,k=6,N=None,I1=None,I2=None,method='arpack',tol=0,
+                                                        maxiter=None,seed=0):
+    ''' Lowest eigenstates of a large sparse or matrix-free Hamiltonian
+
+    Finds the lowest eigenstates of H with an iterative eigensolver, ARPACK
+    (scipy.sparse.linalg.eigsh) or LOBPCG, so that only products H.v are ever
+    needed. This is intended for the matrix-free operators from
+    Hamiltonian.Build_Kronecker_Hamiltonians and the sparse matrices from
+    Build_Hamiltonians(...,sparse=True) at large Nmax.
+
+    Instead of the k lowest states, all of the states in rotational manifold
+    N can be requested. These are taken to be the (2N+1)(2I1+1)(2I2+1) states
+    above all of the lower manifolds, which holds as long as the rotational
+    splitting is the largest energy scale. The hyperfine structure within
+    each manifold is cleaned up with a final Rayleigh-Ritz step.
+
+    The residual |H.x - E x| of every state that is returned is checked
+    afterwards, relative to the largest diagonal element of H (or the largest
+    eigenvalue found if H has no diagonal), and a
+    UserWarning is raised for any that is larger than the limit for the
+    method (see below). Increase maxiter if this happens.
+
+    The defaults differ between the two methods. ARPACK converges to machine
+    precision (tol = 0) and the residuals are checked against 1e-12, with
+    scipy's default maxiter. LOBPCG cannot reach that in a reasonable number
+    of iterations, so it defaults to tol = 1e-8 on the rescaled Hamiltonian
+    with maxiter = 1000. It is run with a few extra guard vectors and a
+    Jacobi preconditioner, and its residuals are checked against 10*tol
+    (1e-7 by default) as they are not quite reached for every member of a
+    tight hyperfine cluster.
+
+    Args:
+        H (KroneckerHamiltonian, scipy.sparse matrix or LinearOperator) - Hermitian Hamiltonian
+
+    kwargs:
+        k (int) - number of states to find from the bottom of the spectrum (default = 6)
+        N (int) - rotational manifold to return instead of the k lowest states
+        I1,I2 (float) - nuclear spins, only needed with N if H is not a KroneckerHamiltonian
+        method (str) - 'arpack' or 'lobpcg'
+        tol (float) - convergence tolerance passed to the solver, and the limit on the relative residuals (default = machine precision checked against 1e-12 for ARPACK, 1e-8 checked against 1e-7 for LOBPCG)
+        maxiter (int) - maximum number of solver iterations (default = scipy's for ARPACK, 1000 for LOBPCG)
+        seed (int or numpy.random.Generator) - random numbers for the perturbation of the LOBPCG starting vectors (default = 0, reproducible)
+
+    Returns:
+        energies (numpy.ndarray) - eigenenergies from lowest to highest
+        states (numpy.ndarray) - eigenstates as columns, states[:,i] -> energies[i]
+    '''
+    if N is not None:
+        if isinstance(H,Hamiltonian.KroneckerHamiltonian):
+            shapeS = H.shapes[1]
+        elif I1 is not None and I2 is not None:
+            shapeS = int((2*I1+1)*(2*I2+1))
+        else:
+            raise ValueError("I1 and I2 are needed to find the N manifold")
+        # there are N^2 rotational states below the manifold N
+        lo = (N**2)*shapeS
+        hi = ((N+1)**2)*shapeS
+    else:
+        lo,hi = 0,k
+
+    if hi >= H.shape[0]:
+        raise ValueError("asked for {:.0f} states from a {:.0f} state basis, "
+                "use a dense solver instead".format(hi,H.shape[0]))
+
+    # the elements are ~1e-24 J, rescale so that the solver tolerances make
+    # sense. The diagonal is a cheap estimate of the size of the spectrum.
+    Hn = scipy.sparse.linalg.aslinearoperator(H)
+    scale = None
+    if hasattr(H,'diagonal'):
+        diagonal = numpy.real(H.diagonal())
+        scale = numpy.amax(numpy.abs(diagonal))
+        Hn = Hn*(1/scale)
+
+    if method == 'arpack':
+        # the hyperfine levels are very tightly clustered compared to the
+        # rotational structure, a generous Krylov space is needed to resolve
+        # every member of each cluster
+        ncv = min(H.shape[0]-1,max(4*hi+1,20))
+        energies,states = scipy.sparse.linalg.eigsh(Hn,k=hi,which='SA',
+                                        tol=tol,maxiter=maxiter,ncv=ncv)
+    elif method == 'lobpcg':
+        # a few guard vectors beyond the wanted states stop LOBPCG stalling
+        # when the last wanted state is one of a tight hyperfine cluster
+        m = min(hi+4,H.shape[0]-1)
+        # start from the uncoupled basis states with the lowest diagonal
+        # energies, which are already close to the wanted subspace
+        X = numpy.zeros((H.shape[0],m),dtype=numpy.complex128)
+        if hasattr(H,'diagonal'):
+            start = numpy.argsort(diagonal,kind='stable')[:m]
+        else:
+            start = numpy.arange(m)
+        X[start,numpy.arange(m)] = 1
+        X += 1e-3*numpy.random.default_rng(seed).standard_normal(X.shape)
+        # Jacobi preconditioner (D-sigma)^-1, with sigma below the lowest
+        # eigenvalue by the Gershgorin bound on the off-diagonal elements.
+        # This takes out the rotational spread of the spectrum, which is
+        # what makes plain LOBPCG so slow here.
+        M = None
+        offdiagonal = _offdiagonal_bound(H)
+        if scale is not None and offdiagonal is not None:
+            shift = diagonal-numpy.amin(diagonal)+numpy.amax(offdiagonal)
+            if numpy.all(shift > 0):
+                M = scipy.sparse.diags(scale/shift)
+        # the residuals of the wanted states are checked below, scipy's
+        # warnings are about the whole block including the guard vectors
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore",message="Exited",
+                                                        category=UserWarning)
+            energies,states = scipy.sparse.linalg.lobpcg(Hn,X,M=M,
+                        largest=False,tol=tol if tol else 1e-8,
+                        maxiter=maxiter if maxiter else 1000)
+    else:
+        raise ValueError("method must be 'arpack' or 'lobpcg'")
+
+    # Rayleigh-Ritz in the converged subspace, the hyperfine splittings are
+    # tiny compared to the spread of the spectrum so this tidies them up
+    Q,_ = numpy.linalg.qr(states)
+    Hs = Q.conj().T.dot(H.dot(Q))
+    energies,U = numpy.linalg.eigh(0.5*(Hs+Hs.conj().T))
+    states = Q.dot(U)
+    energies,states = energies[lo:hi],states[:,lo:hi]
+
+    # neither solver reports states that have not converged, so check them
+    if scale is None:
+        scale = numpy.amax(numpy.abs(energies))
+    residual = numpy.linalg.norm(H.dot(states)-states*energies[None,:],
+                                                            axis=0)/scale
+    if method == 'lobpcg':
+        limit = 10*tol if tol else 1e-7
+    else:
+        limit = tol if tol else 1e-12
+    if numpy.any(residual > limit):
+        warnings.warn("{:.0f} of {:.0f} states have not converged, largest "
+                "relative residual {:.2e} > {:.2e}".format(
+                numpy.sum(residual > limit),len(residual),
+                numpy.amax(residual),limit),UserWarning)
+
+    return energies,states
+
+def Manifold_Indices(N,I1,I2):
+    ''' Position of rotational manifolds in the energy-ordered spectrum
+
+    Gives the range of eigenstate indices (counting from the lowest energy)
+    occupied by the manifold(s) N, assuming that the rotational splitting is
+    the largest energy scale so that the manifolds do not overlap.
+
+    The range is always contiguous, from the lowest to the highest manifold
+    in N, so for N = [0,2] it includes N = 1 as well. Call this once for each
+    manifold if N skips any.
+
+    Args:
+        N (int or list of ints) - rotational manifold(s)
+        I1,I2 (float) - nuclear spins
+
+    Returns:
+        lo,hi (int) - the manifolds occupy indices lo to hi-1
+    '''
+    N = numpy.atleast_1d(N)
+    shapeS = int((2*I1+1)*(2*I2+1))
+    return int(numpy.amin(N)**2*shapeS),int((numpy.amax(N)+1)**2*shapeS)
+
+def Solve_Subset(H,window=None,count=None,N=None,I1=None,I2=None,
+                                                        return_states=True):
+    ''' Eigenstates in part of the spectrum only
+
+    Finds the eigenstates of H inside an energy window, the lowest count
+    eigenstates, or those in the rotational manifold(s) N, without finding the
+    rest of the spectrum. Dense matrices use scipy.linalg.eigh with
+    subset_by_value or subset_by_index, scipy.sparse matrices (and
+    KroneckerHamiltonians) use shift-invert Lanczos.
+
+    States picked by N are labelled as in LabelStates_N_MN and only those
+    with the right N are returned, a warning is given if the manifolds are
+    mixed up in energy.
+
+    Args:
+        H (numpy.ndarray, scipy.sparse matrix or KroneckerHamiltonian) - Hermitian Hamiltonian
+
+    kwargs:
+        window (tuple) - (lowest,highest) energy to include in Joules
+        count (int) - number of states to find from the bottom of the spectrum
+        N (int or list of ints) - rotational manifold(s) to find
+        I1,I2 (float) - nuclear spins, needed with N
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+
+    Returns:
+        energies (numpy.ndarray) - eigenenergies from lowest to highest
+        states (numpy.ndarray) - (dim,k) eigenstates as columns, states[:,i] -> energies[i]
+    '''
+    if sum(x is not None for x in (window,count,N)) != 1:
+        raise ValueError("give exactly one of window, count or N")
+    if N is not None and (I1 is None or I2 is None):
+        raise ValueError("I1 and I2 are needed to find the N manifold")
+
+    dim = H.shape[0]
+    dense = isinstance(H,numpy.ndarray)
+    if N is not None:
+        lo,hi = Manifold_Indices(N,I1,I2)
+        if hi > dim:
+            raise ValueError("N = {:} is not in the basis".format(N))
+
+    if dense:
+        if window is not None:
+            energies,states = scipy.linalg.eigh(H,subset_by_value=window)
+        else:
+            if count is not None:
+                lo,hi = 0,int(count)
+            energies,states = scipy.linalg.eigh(H,subset_by_index=[lo,hi-1])
+    else:
+        if isinstance(H,Hamiltonian.KroneckerHamiltonian):
+            H = H.tosparse()
+        H = scipy.sparse.csc_matrix(H)
+        diagonal = H.diagonal().real
+        if count is not None:
+            energies,states = Solve_Iterative(H,k=int(count))
+        else:
+            if window is not None:
+                # the diagonal is a guess at how many states are inside
+                inside = numpy.flatnonzero((diagonal >= window[0]) &
+                                                    (diagonal <= window[1]))
+                k = max(6,int(1.5*len(inside)))
+                sigma = 0.5*(window[0]+window[1])
+            else:
+                # the basis states in manifold N have energies close to
+                # the eigenstates
+                order = numpy.argsort(diagonal,kind='stable')[lo:hi]
+                k = hi-lo
+                sigma = 0.5*(diagonal[order].min()+diagonal[order].max())
+            while True:
+                k = min(k,dim-2)
+                energies,states = scipy.sparse.linalg.eigsh(H,k=k,
+                                                    sigma=sigma,which='LM')
+                if window is None:
+                    break
+                keep = (energies >= window[0]) & (energies <= window[1])
+                if not numpy.all(keep) or k == dim-2:
+                    break
+                # every state found is in the window, there may be more
+                k = 2*k
+            order = numpy.argsort(energies)
+            energies,states = energies[order],states[:,order]
+            if window is not None:
+                keep = (energies >= window[0]) & (energies <= window[1])
+                energies,states = energies[keep],states[:,keep]
+
+    if N is not None:
+        Nmax = int(numpy.round(numpy.sqrt(dim/((2*I1+1)*(2*I2+1)))))-1
+        label,MN = LabelStates_N_MN(states,Nmax,I1,I2)
+        keep = numpy.isin(label,numpy.atleast_1d(N))
+        if numpy.sum(keep) != hi-lo:
+            warnings.warn("rotational manifolds overlap in energy, only "
+                    "{:.0f} of {:.0f} states have the right N".format(
+                    numpy.sum(keep),hi-lo),UserWarning)
+        energies,states = energies[keep],states[:,keep]
+
+    if return_states:
+        return energies,states
+    return energies
+
+def MF_Blocks(Nmax,I1,I2):
+    ''' Partition the uncoupled basis by total MF
+
+    When every field is along z (and Beta = 0) the projection
+    MF = MN + M1 + M2 is conserved, so after a permutation the Hamiltonian is
+    block diagonal with one block per value of MF. The MF of each basis state
+    is read off the diagonals of the z angular momentum operators.
+
+    Args:
+        Nmax (int) - Maximum rotational quantum number in the basis
+        I1,I2 (float) - nuclear spin quantum numbers
+
+    Returns:
+        MF (numpy.ndarray) - the distinct values of MF, from lowest to highest
+        blocks (list of numpy.ndarray) - indices of the basis states in each MF block, blocks[i] -> MF[i]
+    '''
+    N,I1,I2 = Hamiltonian.Generate_vecs(Nmax,I1,I2,sparse=True)
+    Fz = numpy.round((N[2]+I1[2]+I2[2]).diagonal().real,1)
+
+    MF = numpy.unique(Fz)
+    blocks = [numpy.flatnonzero(Fz == m) for m in MF]
+
+    return MF,blocks
+
+@Profiling.profiled()
+def Solve_Blocks(H,blocks,return_states=True,parallel=False,workers=None,
+                                                                check=True):
+    ''' Diagonalise a Hamiltonian one symmetry block at a time
+
+    Each block of H given by blocks (e.g. from MF_Blocks) is diagonalised
+    on its own and the results are put back together in the original basis,
+    as though the whole matrix had been given to numpy.linalg.eigh. Since the
+    cost of diagonalisation is cubic in the size of the matrix this is much
+    faster than solving the full matrix.
+
+    H can also be a stack of Hamiltonians with shape (steps,dim,dim), for
+    instance one for each step of a field sweep.
+
+    Args:
+        H (numpy.ndarray or scipy.sparse matrix) - Hermitian Hamiltonian(s), (...,dim,dim)
+        blocks (list of numpy.ndarray) - indices of the basis states in each block
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        parallel (bool) - diagonalise the blocks in a pool of threads (default = False)
+        workers (int) - number of threads to use when parallel, default is set by concurrent.futures
+        check (bool) - warn if H couples states in different blocks (default = True)
+
+    Returns:
+        energies (numpy.ndarray) - (...,dim) eigenenergies, sorted from lowest to highest
+        states (numpy.ndarray) - (...,dim,dim) eigenstates as columns, states[...,:,i] -> energies[...,i]
+    '''
+    dim = H.shape[-1]
+
+    # which block each basis state belongs to
+    label = numpy.full(dim,-1)
+    for b,idx in enumerate(blocks):
+        label[idx] = b
+    if numpy.any(label < 0):
+        raise ValueError("blocks do not cover all {:.0f} basis states".format(
+                                                                        dim))
+
+    if check:
+        if scipy.sparse.issparse(H):
+            H = scipy.sparse.coo_matrix(H)
+            leak = numpy.abs(H.data[label[H.row] != label[H.col]])
+            total = numpy.abs(H.data)
+        else:
+            leak = numpy.abs(H[...,label[:,None] != label[None,:]])
+            total = numpy.abs(H)
+        if leak.size and numpy.amax(leak) > 1e-10*numpy.amax(total):
+            warnings.warn("Hamiltonian couples different symmetry blocks, "
+                            "the results will not be exact",UserWarning)
+
+    if scipy.sparse.issparse(H):
+        H = scipy.sparse.csr_matrix(H)
+        take = lambda idx: H[idx][:,idx].toarray()
+    else:
+        take = lambda idx: H[...,idx[:,None],idx]
+
+    def solve(idx):
+        if return_states:
+            return numpy.linalg.eigh(take(idx))
+        return numpy.linalg.eigvalsh(take(idx)),None
+
+    if parallel:
+        # numpy releases the GIL inside LAPACK so threads are enough, start
+        # with the biggest blocks so that the pool stays busy
+        from concurrent.futures import ThreadPoolExecutor
+        order = sorted(range(len(blocks)),key=lambda b:-len(blocks[b]))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            solved = dict(zip(order,pool.map(solve,[blocks[b] for b in order])))
+        solved = [solved[b] for b in range(len(blocks))]
+    else:
+        solved = [solve(idx) for idx in blocks]
+
+    # put the blocks back together. Eigenstates of block b only have
+    # components on the basis states in that block.
+    stack = H.shape[:-2]
+    energies = numpy.concatenate([e for e,v in solved],axis=-1)
+    if return_states:
+        states = numpy.zeros(stack+(dim,dim),dtype=numpy.complex128)
+        col = 0
+        for idx,(e,v) in zip(blocks,solved):
+            states[...,idx[:,None],numpy.arange(col,col+len(idx))] = v
+            col += len(idx)
+
+    order = numpy.argsort(energies,axis=-1,kind='stable')
+    energies = numpy.take_along_axis(energies,order,axis=-1)
+    if return_states:
+        states = numpy.take_along_axis(states,order[...,None,:],axis=-1)
+        return energies,states
+    return energies
+
+def _default_chunk(dim):
+    ''' points per batch that keep a stack of (dim,dim) complex matrices
+    below ~256 MB '''
+    return max(1,int(2**28//(16*dim**2)))
+
+@Profiling.profiled()
+def _Sweep_Core(terms,coeffs,return_states=True,chunk=None,blocks=None,
+                                                                subset=None):
+    ''' diagonalise sum_k coeffs[p,k]*terms[k] for every point p
+
+    The Hamiltonians are assembled a chunk of points at a time as a
+    (chunk,dim,dim) stack, with a single matrix product of the coefficients
+    and the flattened terms, and then given to the batched Hermitian solver.
+
+    Args:
+        terms (list of numpy.ndarray) - K square matrices, can be scipy.sparse or a (K,dim,dim) array
+        coeffs (numpy.ndarray) - (points,K) coefficient of each term at each point
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies
+        chunk (int) - number of points to solve at once, default keeps the stack below ~256 MB
+        blocks (list of numpy.ndarray) - symmetry blocks to pass to Solve_Blocks
+        subset (tuple) - (lo,hi) only find the eigenstates lo to hi-1, counting from the lowest
+
+    Returns:
+        energies (numpy.ndarray) - (points,k) eigenenergies, lowest to highest
+        states (numpy.ndarray) - (points,dim,k) eigenstates as columns
+    '''
+    if not (isinstance(terms,numpy.ndarray) and terms.ndim == 3):
+        terms = numpy.array([T.toarray() if scipy.sparse.issparse(T) else T
+                                    for T in terms],dtype=numpy.complex128)
+    dim = terms.shape[-1]
+    coeffs = numpy.atleast_2d(coeffs)
+    points = coeffs.shape[0]
+
+    if chunk is None:
+        chunk = _default_chunk(dim)
+    chunk = int(chunk)
+
+    # (K,dim*dim) so that the whole stack is one matrix product, this is a
+    # view if the terms were given already stacked
+    flat = numpy.asarray(terms,dtype=numpy.complex128).reshape(len(terms),-1)
+
+    lo,hi = (0,dim) if subset is None else (int(subset[0]),int(subset[1]))
+    energies = numpy.zeros((points,hi-lo))
+    if return_states:
+        states = numpy.zeros((points,dim,hi-lo),dtype=numpy.complex128)
+
+    for start in range(0,points,chunk):
+        stop = min(start+chunk,points)
+        H = coeffs[start:stop].dot(flat).reshape(stop-start,dim,dim)
+        with Profiling.section("Calculate.eigensolver") as stage:
+            if subset is not None and blocks is None:
+                # LAPACK only finds the wanted states, one matrix at a time
+                result = [scipy.linalg.eigh(h,subset_by_index=[lo,hi-1],
+                            eigvals_only=not return_states,overwrite_a=True,
+                            check_finite=False) for h in H]
+                if return_states:
+                    E = numpy.array([r[0] for r in result])
+                    S = numpy.array([r[1] for r in result])
+                else:
+                    E = numpy.array(result)
+            else:
+                if blocks is not None:
+                    # only worth checking that the blocks are respected once
+                    result = Solve_Blocks(H,blocks,return_states,check=start==0)
+                elif return_states:
+                    result = numpy.linalg.eigh(H)
+                else:
+                    result = numpy.linalg.eigvalsh(H)
+                if return_states:
+                    E,S = result[0][:,lo:hi],result[1][:,:,lo:hi]
+                else:
+                    E = result[:,lo:hi]
+            stage.result = H
+        energies[start:stop] = E
+        if return_states:
+            states[start:stop] = S
+
+    if return_states:
+        return energies,states
+    return energies
+
+def _Sweep_Terms(Hams,fields):
+    ''' terms and coefficients for H = H0 + B*Hz + E*HDC + I*HAC
+
+    Any term that has been switched off (i.e. is a scalar) is left out.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians
+        fields (numpy.ndarray) - (points,3) array of (B,E,I)
+
+    Returns:
+        terms (list of numpy.ndarray) - the terms that are switched on
+        coeffs (numpy.ndarray) - (points,len(terms)) coefficient of each term
+    '''
+    H0,Hz,HDC,HAC = Hams
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    if fields.shape[1] != 3:
+        raise ValueError("fields should have shape (points,3) of (B,E,I)")
+
+    terms = [H0]
+    columns = [numpy.ones(fields.shape[0])]
+    for i,H in enumerate([Hz,HDC,HAC]):
+        if numpy.ndim(H) == 2:
+            terms.append(H)
+            columns.append(fields[:,i])
+        elif numpy.any(fields[:,i] != 0):
+            warnings.warn("a field is applied but its Hamiltonian is zero",
+                                                                UserWarning)
+    return terms,numpy.column_stack(columns)
+
+def Sweep(Hams,fields,return_states=True,chunk=None,blocks=None,subset=None):
+    ''' Eigenstates of the Hamiltonian over a list of field values
+
+    Finds the eigenenergies (and optionally eigenstates) of
+    H = H0 + B*Hz + E*HDC + I*HAC for every row (B,E,I) of fields. The
+    Hamiltonians are built and solved in batches with numpy.linalg.eigh,
+    chunk points at a time so that memory use stays bounded.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) in T, V/m and W/m^2
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        chunk (int) - number of points to solve at once, default keeps each batch below ~256 MB
+        blocks (list of numpy.ndarray) - symmetry blocks from MF_Blocks, only valid when everything is along z
+        subset (tuple) - (lo,hi) only keep eigenstates lo to hi-1 counting from the lowest, e.g. from Manifold_Indices
+
+    Returns:
+        energies (numpy.ndarray) - (points,k) eigenenergies, lowest to highest at each point
+        states (numpy.ndarray) - (points,dim,k) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    terms,coeffs = _Sweep_Terms(Hams,fields)
+    return _Sweep_Core(terms,coeffs,return_states,chunk,blocks,subset)
+
+def Sweep_Polarisation(Hams,Nmax,Constants,B=0,E=0,I=0,Beta=None,
+            polarisation=None,return_states=True,chunk=None,subset=None):
+    ''' Eigenstates of the Hamiltonian over a list of laser polarisations
+
+    The anisotropic ac Stark shift for any polarisation is a weighted sum of
+    its five spherical components (Hamiltonian.AC_aniso_components), so the
+    Hamiltonians for every polarisation are assembled from the same six
+    matrices and solved in batches, as in Sweep.
+
+    The ac Stark shift is made from a0 and a2 in Constants, so HAC in Hams
+    (which is for one fixed polarisation) is not used.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        Nmax (int) - Maximum rotational level of the Hamiltonians
+        Constants (Dictionary) - Dict of molecular constants
+
+    kwargs:
+        B,E,I (float) - magnetic field (T), electric field (V/m) and intensity (W/m^2)
+        Beta (numpy.ndarray) - polarisation angles in radians
+        polarisation (numpy.ndarray) - (n,3) Cartesian polarisation vectors, used instead of Beta if given
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        chunk (int) - number of polarisations to solve at once
+        subset (tuple) - (lo,hi) only keep eigenstates lo to hi-1 counting from the lowest
+
+    Returns:
+        energies (numpy.ndarray) - (n,k) eigenenergies, lowest to highest for each polarisation
+        states (numpy.ndarray) - (n,dim,k) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    if Beta is None and polarisation is None:
+        raise ValueError("give either the angles Beta or the polarisation "
+                                                                "vectors")
+    H0,Hz,HDC,HAC = Hams
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+
+    fixed = H0+B*Hz+E*HDC
+    fixed = fixed+I*Hamiltonian.AC_iso(Nmax,Constants['a0'],I1,I2,True)/(2*eps0*c)
+    aniso = Hamiltonian.AC_aniso_components(Nmax,Constants['a2'],I1,I2,True)
+    terms = [fixed]+[I*A/(2*eps0*c) for A in aniso]
+
+    weights = numpy.atleast_2d(Hamiltonian.Polarisation_Weights(
+                        0 if Beta is None else Beta,polarisation))
+    coeffs = numpy.column_stack([numpy.ones(weights.shape[0]),weights])
+    return _Sweep_Core(terms,coeffs,return_states,chunk,subset=subset)
+
+def _Rotate(A,V,W):
+    ''' apply the unitary U = 1+W to A -> U^H A U and V -> V U
+
+    W is sparse, so this is much cheaper than a dense rotation. A is
+    Hermitian, so A W = (W^H A)^H.
+    '''
+    Wh = scipy.sparse.csr_matrix(W.conj().T)
+    WhA = Wh.dot(A)
+    AW = numpy.conj(WhA).T
+    A = A+WhA+AW+Wh.dot(AW)
+    V = V+numpy.conj(Wh.dot(numpy.conj(V).T)).T
+    return A,V
+
+def _Continue_Step(H,V,tol=1e-12,max_iter=6,gap=1e-3):
+    ''' eigenstates of H, starting from the nearby eigenbasis V
+
+    H is rotated into the basis V, where it is nearly diagonal, and the
+    remaining off-diagonal part is removed by repeated first order
+    (Jacobi-like) rotations. Groups of states that are coupled strongly
+    compared to their separation, i.e. near an avoided crossing, are
+    diagonalised exactly among themselves first. Only if that does not
+    converge is the whole matrix diagonalised. Either way column k of the
+    result is the state that follows on adiabatically from column k of V.
+
+    Away from the first rotation everything is done with sparse matrices,
+    as only a few pairs of states are coupled by the change in field.
+
+    Args:
+        H (numpy.ndarray) - Hermitian Hamiltonian at this step
+        V (numpy.ndarray) - orthonormal eigenstates from the last step, as columns
+
+    kwargs:
+        tol (float) - largest off-diagonal element left, relative to the largest diagonal element
+        max_iter (int) - rotations to try before falling back to a full solve
+        gap (float) - largest coupling/separation ratio allowed for the rotations
+
+    Returns:
+        energies (numpy.ndarray) - eigenenergies, in the same order as V
+        states (numpy.ndarray) - eigenstates as columns
+        full (bool) - whether a full diagonalisation was needed
+    '''
+    A = numpy.conj(V).T.dot(H.dot(V))
+    n = A.shape[0]
+    scale = numpy.amax(numpy.abs(numpy.diagonal(A)))
+
+    for iteration in range(max_iter):
+        # rounding errors build up a non-Hermitian part, remove it
+        A = 0.5*(A+numpy.conj(A).T)
+        d = numpy.diagonal(A).real
+        # couplings at the level of rounding error are ignored
+        row,col = numpy.nonzero(numpy.abs(A) > tol*scale)
+        keep = row != col
+        row,col = row[keep],col[keep]
+        if len(row) == 0:
+            return d,V,False
+        coupling = A[row,col]
+        separation = d[col]-d[row]
+        strong = numpy.abs(coupling) > gap*numpy.abs(separation)
+
+        if numpy.any(strong):
+            # diagonalise each cluster of strongly coupled states on its own
+            graph = scipy.sparse.coo_matrix((numpy.ones(strong.sum()),
+                                (row[strong],col[strong])),shape=(n,n))
+            count,label = scipy.sparse.csgraph.connected_components(graph,
+                                                                directed=False)
+            sizes = numpy.bincount(label)
+            if numpy.amax(sizes) > n//2:
+                break
+            rows,cols,data = [],[],[]
+            members = numpy.argsort(label,kind='stable')
+            first = numpy.concatenate([[0],numpy.cumsum(sizes)])
+            # clusters of the same size are diagonalised together
+            for size in numpy.unique(sizes[sizes > 1]):
+                clusters = numpy.flatnonzero(sizes == size)
+                idx = members[first[clusters][:,None]+numpy.arange(size)]
+                w,u = numpy.linalg.eigh(A[idx[:,:,None],idx[:,None,:]])
+                if size == 2:
+                    # keep the states in place unless they have swapped
+                    swap = (numpy.abs(u[:,0,1])+numpy.abs(u[:,1,0]) >
+                                numpy.abs(u[:,0,0])+numpy.abs(u[:,1,1]))
+                    u[swap] = u[swap][:,:,::-1]
+                else:
+                    for k in range(len(clusters)):
+                        r,order = scipy.optimize.linear_sum_assignment(
+                                            numpy.abs(u[k]),maximize=True)
+                        u[k] = u[k][:,order]
+                u = u-numpy.eye(size)
+                rows.append(numpy.repeat(idx,size,axis=1).ravel())
+                cols.append(numpy.tile(idx,(1,size)).ravel())
+                data.append(u.ravel())
+            W = scipy.sparse.csr_matrix((numpy.concatenate(data),
+                            (numpy.concatenate(rows),numpy.concatenate(cols))),
+                            shape=(n,n))
+            A,V = _Rotate(A,V,W)
+            continue
+
+        # first order correction to each state, X is anti-Hermitian so the
+        # Cayley transform (1-X/2)^-1 (1+X/2) = 1 + 2 sum_k (X/2)^k gives a
+        # unitary rotation that keeps the order of the states
+        Y = scipy.sparse.csr_matrix((0.5*coupling/separation,(row,col)),
+                                                                shape=(n,n))
+        Y = 0.5*(Y-Y.conj().T)
+        if scipy.sparse.linalg.norm(Y,1) > 0.25:
+            break
+        W = 2*Y
+        term = Y
+        for k in range(50):
+            term = term.dot(Y)
+            if term.nnz == 0 or numpy.amax(numpy.abs(term.data)) < 1e-17:
+                break
+            W = W+2*term
+        A,V = _Rotate(A,V,W)
+
+    else:
+        A = 0.5*(A+numpy.conj(A).T)
+        d = numpy.diagonal(A).real
+        if numpy.amax(numpy.abs(A-numpy.diag(d))) <= tol*scale:
+            return d,V,False
+
+    # not converging, solve the rotated problem in full and match the new
+    # states to the old ones
+    d,U = numpy.linalg.eigh(0.5*(A+numpy.conj(A).T))
+    row,order = scipy.optimize.linear_sum_assignment(numpy.abs(U),
+                                                                maximize=True)
+    return d[order],V.dot(U[:,order]),True
+
+@Profiling.profiled()
+def Sweep_Continuation(Hams,fields,return_states=True,tol=1e-12,max_iter=6,
+                                                                gap=1e-3):
+    ''' Adiabatically connected eigenstates over a finely stepped sweep
+
+    Like Sweep, this finds the eigenstates of H = H0 + B*Hz + E*HDC + I*HAC
+    for every row (B,E,I) of fields. Instead of diagonalising every point
+    from scratch, each step starts from the eigenstates of the last one and
+    only corrects them, and the full solver is only used close to avoided
+    crossings. The states come out in adiabatic order: column k at every
+    point follows on from column k at the point before, so there is no need
+    for Sort_Smooth. The first point is in order of increasing energy.
+
+    This is only faster than Sweep when the steps are small compared to the
+    spacing of the energy levels.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) in T, V/m and W/m^2
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        tol (float) - convergence of each step, relative to the largest energy
+        max_iter (int) - corrections to try at each step before a full solve
+        gap (float) - coupling/separation ratio above which a full solve is used
+
+    Returns:
+        energies (numpy.ndarray) - (points,dim) eigenenergies, in adiabatic order
+        states (numpy.ndarray) - (points,dim,dim) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    terms,coeffs = _Sweep_Terms(Hams,fields)
+    terms = [T.toarray() if scipy.sparse.issparse(T) else numpy.asarray(T)
+                                                                for T in terms]
+    points = coeffs.shape[0]
+    dim = terms[0].shape[0]
+
+    energies = numpy.zeros((points,dim))
+    if return_states:
+        states = numpy.zeros((points,dim,dim),dtype=numpy.complex128)
+
+    for p in range(points):
+        H = sum(x*T for x,T in zip(coeffs[p],terms))
+        if p == 0:
+            E,V = numpy.linalg.eigh(H)
+        else:
+            E,V,full = _Continue_Step(H,V,tol,max_iter,gap)
+        energies[p] = E
+        if return_states:
+            states[p] = V
+
+    if return_states:
+        return energies,states
+    return energies
+
+def _matrix_elements(T,States):
+    ''' S^dagger T S for a (points,dim,k) stack of states '''
+    if scipy.sparse.issparse(T):
+        TS = numpy.array([T.dot(S) for S in States])
+    else:
+        TS = numpy.matmul(T,States)
+    return numpy.matmul(numpy.conj(States).swapaxes(1,2),TS)
+
+@Profiling.profiled()
+def Field_Derivatives(Hams,Energy,States,second=False,gap=1e-36,chunk=None):
+    ''' Derivatives of the energies with respect to the fields
+
+    As H = H0 + B*Hz + E*HDC + I*HAC, the Hellmann-Feynman theorem gives the
+    first derivatives of the energy of each eigenstate as expectation values
+
+    dE_i/dB = <i|Hz|i>, dE_i/dE = <i|HDC|i>, dE_i/dI = <i|HAC|i>
+
+    i.e. minus the magnetic moment, minus the dipole moment and
+    -alpha/(2 eps0 c) with alpha the polarisability. The second derivatives come from the
+    sum over states
+
+    d^2E_i/dx dy = 2 Re sum_j <i|X|j><j|Y|i>/(E_i-E_j)
+
+    which needs every eigenstate, not just a subset. Pairs of states closer
+    than gap in energy are left out of the sum.
+
+    Everything is calculated from the eigenstates of a sweep in a batched
+    contraction over all of the field points, with no extra diagonalisations.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        Energy (numpy.ndarray) - (points,k) eigenenergies, as from Sweep
+        States (numpy.ndarray) - (points,dim,k) eigenstates, as from Sweep
+
+    kwargs:
+        second (bool) - also calculate the second derivatives (default = False)
+        gap (float) - smallest energy difference in joules included in the second derivatives (default = 1e-36)
+        chunk (int) - number of field points to work on at once
+
+    Returns:
+        first (numpy.ndarray) - (3,points,k) dE/dB, dE/dE and dE/dI in J/T, J/(V/m) and J/(W/m^2)
+        second (numpy.ndarray) - (3,3,points,k) second derivatives, only if second is True
+    '''
+    Energy = numpy.atleast_2d(numpy.asarray(Energy).real)
+    States = numpy.asarray(States)
+    if States.ndim == 2:
+        States = States[None,:,:]
+    points,dim,k = States.shape
+    if second and k != dim:
+        raise ValueError("the second derivatives need the full set of "
+                                                                "eigenstates")
+    if chunk is None:
+        chunk = _default_chunk(dim)
+    chunk = int(chunk)
+
+    terms = [(a,H) for a,H in enumerate(Hams[1:]) if numpy.ndim(H) == 2]
+    first = numpy.zeros((3,points,k))
+    if second:
+        hessian = numpy.zeros((3,3,points,k))
+
+    for start in range(0,points,chunk):
+        stop = min(start+chunk,points)
+        S = States[start:stop]
+        if not second:
+            for a,H in terms:
+                first[a,start:stop] = _expectation(H,S).real
+            continue
+
+        M = {a:_matrix_elements(H,S) for a,H in terms}
+        for a in M:
+            first[a,start:stop] = numpy.diagonal(M[a],axis1=1,axis2=2).real
+
+        E = Energy[start:stop]
+        D = E[:,:,None]-E[:,None,:]
+        far = numpy.abs(D) > gap
+        W = numpy.divide(1,D,out=numpy.zeros_like(D),where=far)
+        for a in M:
+            for b in M:
+                if b < a:
+                    continue
+                # <j|Y|i> = conj(<i|Y|j>) as Y is Hermitian
+                X = 2*numpy.einsum('pij,pij,pij->pi',M[a],
+                                            numpy.conj(M[b]),W).real
+                hessian[a,b,start:stop] = X
+                hessian[b,a,start:stop] = X
+
+    if second:
+        return first,hessian
+    return first
+
+def _overlap(S0,S1):
+    ''' |<S0_j|S1_k>| for dense or sparse sets of states, as a dense array '''
+    O = S0.conj().T.dot(S1)
+    if scipy.sparse.issparse(O):
+        O = O.toarray()
+    return numpy.abs(O)
+
+def _Track_Step(E0,S0,E1,S1,window=None):
+    ''' best one-to-one assignment of the states at one step to the last
+
+    Finds the permutation of the columns of S1 that maximises the total
+    overlap with the columns of S0, using the Hungarian algorithm. If window
+    is given, only pairs of states whose energies differ by less than window
+    are compared, which for a small window is much less work than the full
+    overlap matrix.
+
+    Args:
+        E0,S0 (numpy.ndarray) - energies and states at the previous step
+        E1,S1 (numpy.ndarray) - energies and states at this step
+
+    kwargs:
+        window (float) - largest energy change allowed between steps, in joules
+
+    Returns:
+        order (numpy.ndarray) - indices such that S1[:,order] follows S0
+    '''
+    n = len(E0)
+    if window is not None:
+        # work through the states in energy order, a block at a time, each
+        # block only needs the overlaps with the states of E1 in the window
+        # around it, which is a small dense matrix product
+        sort0 = numpy.argsort(E0,kind='stable')
+        sort1 = numpy.argsort(E1,kind='stable')
+        E1s = E1[sort1]
+        rows,cols,overlaps = [],[],[]
+        for start in range(0,n,64):
+            r = sort0[start:start+64]
+            lo = numpy.searchsorted(E1s,E0[r].min()-window,side='left')
+            hi = numpy.searchsorted(E1s,E0[r].max()+window,side='right')
+            k = sort1[lo:hi]
+            O = _overlap(S0[:,r],S1[:,k])
+            ii,jj = numpy.nonzero(numpy.abs(E0[r][:,None]-E1[k][None,:])
+                                                                    <= window)
+            rows.append(r[ii])
+            cols.append(k[jj])
+            overlaps.append(O[ii,jj])
+        rows = numpy.concatenate(rows)
+        cols = numpy.concatenate(cols)
+        overlaps = numpy.concatenate(overlaps)
+        # shift the weights so that every allowed pair is an explicit edge
+        cost = scipy.sparse.csr_matrix((2-overlaps,(rows,cols)),shape=(n,n))
+        try:
+            return scipy.sparse.csgraph.min_weight_full_bipartite_matching(
+                                                                    cost)[1]
+        except ValueError:
+            # the window is too narrow to pair off every state, so compare
+            # everything instead
+            pass
+
+    overlaps = _overlap(S0,S1)
+    row,order = scipy.optimize.linear_sum_assignment(overlaps,maximize=True)
+    return order
+
+@Profiling.profiled()
+def Sort_Smooth(Energy,States,pb=False,method='greedy',window=None,
+                                                            callback=None):
     ''' Sort states to remove false avoided crossings.
 
     This is a function to ensure that all eigenstates plotted change
@@ -302,42 +1367,217 @@ def Sort_Smooth(Energy,States,pb=False):
     should vary by only a small amount (i.e. that the  step size is fine) and
     arranging states to maximise the overlap one step to the next.
 
+    The default 'greedy' method takes the largest overlap for each state in
+    turn, which can give two states the same partner. The 'optimal' method
+    finds the one-to-one assignment with the largest total overlap, and with
+    window set only compares states whose energies are within window of each
+    other, which is much faster for large numbers of states.
+
     Args:
         Energy (numpy.ndarray) : numpy.ndarray containing the eigenergies, as from numpy.linalg.eig
-        States (numpy.ndarray): numpy.ndarray containing the states, in the same order as Energy
-        pb (bool) : optionally show progress bar, requires pyprind. Doesn't work in all environments (Sorry!)
+        States (numpy.ndarray): numpy.ndarray containing the states, in the same order as Energy. Can also be a list of scipy.sparse matrices from Compress_States, which are sorted in place without being made dense
+        pb (bool) : optionally show a progress bar, Profiling.Progress_Bar
+        method (str) : 'greedy' or 'optimal'
+        window (float) : for method = 'optimal', largest energy change of a state between steps in joules
+        callback (function) : called as callback(step,total) after each step is sorted, e.g. for progress or metrics. Replaces the progress bar of pb
     Returns:
         Energy (numpy.ndarray) : numpy.ndarray containing the eigenergies, as from numpy.linalg.eig
         States (numpy.ndarray): numpy.ndarray containing the states, in the same order as Energy E[x,i] -> States[x,:,i]
     '''
-    ls = numpy.arange(States.shape[2],dtype="int")
+    if method not in ('greedy','optimal'):
+        raise ValueError("method must be 'greedy' or 'optimal'")
+    ls = numpy.arange(States[0].shape[1],dtype="int")
     number_iterations = len(Energy[:,0])
-    if pb:
-        bar = pyprind.ProgBar(number_iterations, monitor=True)
+    if callback is None and pb:
+        callback = Profiling.Progress_Bar()
     for i in range(1,number_iterations):
         '''
         This loop sorts the eigenstates such that they maintain some
         continuity. Each eigenstate should be chosen to maximise the overlap
         with the previous.
         '''
-        #calculate the overlap of the ith and jth eigenstates
-        overlaps = numpy.einsum('ij,ik->jk',
-                                numpy.conjugate(States[i-1,:,:]),States[i,:,:])
-        orig2 = States[i,:,:].copy()
-        orig1 = Energy[i,:].copy()
-        #insert location of maximums into array ls
-        numpy.argmax(numpy.abs(overlaps),axis=1,out=ls)
-        for k in range(States.shape[2]):
-            l = ls[k]
-            if l!=k:
-                Energy[i,k] = orig1[l].copy()
-                States[i,:,k] = orig2[:,l].copy()
-        if pb:
-            bar.update()
-    if pb:
-        print(bar)
+        if method == 'optimal':
+            ls = _Track_Step(Energy[i-1,:].real,States[i-1],
+                                    Energy[i,:].real,States[i],window)
+        else:
+            #calculate the overlap of the ith and jth eigenstates
+            overlaps = _overlap(States[i-1],States[i])
+            #insert location of maximums into array ls
+            numpy.argmax(overlaps,axis=1,out=ls)
+        # reorder the whole step at once
+        Energy[i,:] = Energy[i,ls]
+        States[i] = States[i][:,ls]
+        if callback is not None:
+            callback(i,number_iterations-1)
     return Energy,States
 
+def _Skipped_Crossing(E0,S0,E1,terms,coeffs,h,min_step):
+    ''' has a step jumped straight over an avoided crossing?
+
+    If the step is much longer than the width of an avoided crossing, the
+    two states swap completely and are matched diabatically, so neither the
+    overlaps nor the curvature show anything. Such a pair of levels swaps
+    order in energy over the step. The coupling of the two states is
+    estimated from the Hamiltonian at the end of the step in the states at
+    the start, and the crossing is wide enough to resolve if the gap this
+    would open (twice the coupling) divided by the change in slope is more
+    than min_step. Exact crossings, of states of different symmetry, have no
+    coupling and are let through.
+    '''
+    swapped = numpy.triu(numpy.sign(E0[:,None]-E0[None,:]) !=
+                                numpy.sign(E1[:,None]-E1[None,:]),1)
+    if not numpy.any(swapped):
+        return False
+    i,j = numpy.nonzero(swapped)
+    cols,inverse = numpy.unique(numpy.concatenate([i,j]),return_inverse=True)
+    U = S0[:,cols]
+    H = numpy.tensordot(coeffs,terms,axes=1)
+    M = numpy.conj(U).T.dot(H.dot(U))
+    coupling = numpy.abs(M[inverse[:len(i)],inverse[len(i):]])
+    slope = numpy.abs((E1[i]-E0[i])-(E1[j]-E0[j]))/h
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        width = 2*coupling/slope
+    return bool(numpy.any(width > min_step))
+
+@Profiling.profiled()
+def Sweep_Adaptive(Hams,start,stop,step=1e-2,min_step=1e-6,max_step=0.1,
+                    overlap=0.95,tol=0.05,resample=None,return_states=True,
+                    blocks=None,subset=None,window=None):
+    ''' Tracked eigenstates along a line of fields, with an adaptive step
+
+    The fields go in a straight line from start to stop, parametrised by t
+    from 0 to 1. Each step is diagonalised and its states matched to the
+    last step (as in Sort_Smooth with method = 'optimal'). A step is
+    rejected and halved if any state has an overlap smaller than overlap
+    with its partner at the last step, if the levels curve too much (any
+    energy is further from a straight line through the last two steps than
+    tol times the largest change of an energy over the step), or if it has
+    jumped over an avoided crossing that is wider than min_step. When a
+    step is well inside the limits the next one is made 1.5 times longer.
+    The points end up dense near crossings and sparse where the levels are
+    smooth.
+
+    The output is in adiabatic order, so there is no need for Sort_Smooth.
+    It is on the non-uniform grid of accepted steps unless resample is
+    given, in which case the tracked energies are interpolated onto the
+    requested grid (see Resample_Levels).
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        start,stop (numpy.ndarray) - (B,E,I) at the two ends of the line in T, V/m and W/m^2
+
+    kwargs:
+        step (float) - first step, as a fraction of the line
+        min_step,max_step (float) - limits of the step; steps of min_step are always accepted
+        overlap (float) - smallest overlap of a state with itself at the last step
+        tol (float) - largest deviation from a linear extrapolation of the energies, relative to the largest change in energy over the step
+        resample (int or numpy.ndarray) - number of evenly spaced points, or values of t, to interpolate the energies onto
+        return_states (bool) - return the eigenstates as well as the energies (default = True), not with resample
+        blocks (list of numpy.ndarray) - symmetry blocks from MF_Blocks, only valid when everything is along z
+        subset (tuple) - (lo,hi) only keep eigenstates lo to hi-1 counting from the lowest at each step
+        window (float) - largest energy change of a state between steps in joules, passed to the matching
+
+    Returns:
+        fields (numpy.ndarray) - (points,3) the accepted (or resampled) values of (B,E,I)
+        energies (numpy.ndarray) - (points,k) eigenenergies, in adiabatic order
+        states (numpy.ndarray) - (points,dim,k) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    start = numpy.asarray(start,dtype=float)
+    stop = numpy.asarray(stop,dtype=float)
+    terms,ends = _Sweep_Terms(Hams,numpy.array([start,stop]))
+    # made dense once, rather than at every step
+    terms = numpy.array([T.toarray() if scipy.sparse.issparse(T) else T
+                                    for T in terms],dtype=numpy.complex128)
+
+    def coefficients(t):
+        return ends[0]+t*(ends[1]-ends[0])
+
+    def solve(t):
+        E,S = _Sweep_Core(terms,coefficients(t),True,1,blocks,subset)
+        return E[0],S[0]
+
+    E,S = solve(0.)
+    t = [0.]
+    energies = [E]
+    states = [S]
+    h = step
+    while t[-1] < 1:
+        h = min(h,1-t[-1])
+        E,S = solve(t[-1]+h)
+        order = _Track_Step(energies[-1],states[-1],E,S,window)
+        E,S = E[order],S[:,order]
+
+        worst = numpy.amin(numpy.abs(numpy.sum(numpy.conj(states[-1])*S,
+                                                                    axis=0)))
+        if len(t) > 1:
+            slope = (energies[-1]-energies[-2])/(t[-1]-t[-2])
+            change = numpy.amax(numpy.abs(E-energies[-1]))
+            error = numpy.amax(numpy.abs(E-energies[-1]-h*slope))
+            error = error/change if change > 0 else 0
+        else:
+            error = 0
+        if h > min_step and (worst < overlap or error > tol or
+                    _Skipped_Crossing(energies[-1],states[-1],E,terms,
+                                coefficients(t[-1]+h),h,min_step)):
+            h = max(h/2,min_step)
+            continue
+
+        t.append(t[-1]+h)
+        energies.append(E)
+        # only the last step is needed for the tracking
+        if return_states and resample is None:
+            states.append(S)
+        else:
+            states[-1] = S
+        if worst > 1-(1-overlap)/4 and error < tol/4:
+            h = min(1.5*h,max_step)
+
+    t = numpy.array(t)
+    energies = numpy.array(energies)
+    if resample is not None:
+        return Resample_Levels(t,energies,resample,start,stop)
+    fields = start[None,:]+t[:,None]*(stop-start)[None,:]
+    if return_states:
+        return fields,energies,numpy.array(states)
+    return fields,energies
+
+def Resample_Levels(t,energies,grid,start=None,stop=None):
+    ''' Interpolate tracked energy levels onto a new grid
+
+    Each level is interpolated with a cubic spline, so the levels need to be
+    in adiabatic order, e.g. from Sweep_Adaptive or Sort_Smooth. The grid has
+    to lie within t[0] to t[-1], the levels are not extrapolated.
+
+    Args:
+        t (numpy.ndarray) - (points,) increasing positions of the energies, e.g. a field
+        energies (numpy.ndarray) - (points,k) energies of the tracked levels
+        grid (int or numpy.ndarray) - positions to interpolate onto, or a number of points evenly spaced from t[0] to t[-1]
+
+    kwargs:
+        start,stop (numpy.ndarray) - (B,E,I) at t[0] and t[-1], if given the fields at the grid are also returned, on the straight line between them
+
+    Returns:
+        fields (numpy.ndarray) - (n,3) fields at the grid, only if start and stop are given
+        energies (numpy.ndarray) - (n,k) interpolated energies
+    '''
+    t = numpy.asarray(t,dtype=float)
+    if numpy.ndim(grid) == 0:
+        grid = numpy.linspace(t[0],t[-1],int(grid))
+    grid = numpy.asarray(grid,dtype=float)
+    if numpy.any(grid < t[0]) or numpy.any(grid > t[-1]):
+        raise ValueError("grid goes outside {:g} to {:g}, the range of "
+                                            "t".format(t[0],t[-1]))
+    spline = scipy.interpolate.CubicSpline(t,energies,axis=0)
+    energies = spline(grid)
+    if start is None or stop is None:
+        return energies
+    start = numpy.asarray(start,dtype=float)
+    stop = numpy.asarray(stop,dtype=float)
+    x = (grid-t[0])/(t[-1]-t[0])
+    fields = start[None,:]+x[:,None]*(stop-start)[None,:]
+    return fields,energies
+
+@Profiling.profiled()
 def Export_Energy(fname,Energy,Fields=None,labels=None,
                                 headers=None,dp=6,format=None):
     ''' Export Energies in spreadsheet format.
@@ -418,6 +1658,7 @@ def Export_Energy(fname,Energy,Fields=None,labels=None,
     output = numpy.row_stack((labels,Energy))
     numpy.savetxt(fname,output.T,delimiter=',',header = headers,fmt=format)
 
+@Profiling.profiled()
 def Export_State_Comp(fname,Nmax,I1,I2,States,labels=None,
                                 headers=None,dp=6,format=None):
     ''' function to export state composition in a human-readable format
@@ -469,22 +1710,18 @@ def Export_State_Comp(fname,Nmax,I1,I2,States,labels=None,
         headers = []
 
 
-    # create labels for basis states from Generate_vecs
-    # first step is to recreate the angular momentum operators
-    N, I1,I2 = Generate_vecs(Nmax,I1,I2)
-
-    # each basis state is an eigenstate of N^2, so N^2 is diagonal in our basis
-    # with eigenvalues N(N+1)
+    if scipy.sparse.issparse(States):
+        States = States.toarray()
 
-    N2 = numpy.round([SolveQuadratic(1,1,-1*x) for x in numpy.diag(vector_dot(N,
-                                                                N))],0).real
+    # create labels for basis states from the angular momentum operators
+    # each basis state is an eigenstate of N^2, Nz, I1z and I2z, so these are
+    # diagonal in the basis that we constructed.
+    diagonal = Hamiltonian.Angular_Momentum(Nmax,I1,I2)['diagonal']
 
-    # they are also eigenstates of Nz, I1z and I2z which are diagonal
-    # in the basis that we constructed.
-
-    MN = numpy.round(numpy.diag(N[2]),0).real
-    M1 = numpy.round(numpy.diag(I1[2]),1).real
-    M2 = numpy.round(numpy.diag(I2[2]),1).real
+    N2 = numpy.round(SolveQuadratic(1,1,-1*diagonal['N2']),0)
+    MN = numpy.round(diagonal['Nz'],0)
+    M1 = numpy.round(diagonal['I1z'],1)
+    M2 = numpy.round(diagonal['I2z'],1)
 
     # Now we create a list of each of the values in the right place
     state_list = ["({:.0f}:{:.0f}:{:.1f}:{:.1f})".format(N2[i],
@@ -523,6 +1760,169 @@ def Export_State_Comp(fname,Nmax,I1,I2,States,labels=None,
     output = numpy.insert(States.real,0,labels.real,axis=0)
     numpy.savetxt(fname,output.T,delimiter=',',header = headers,fmt=format)
 
+def Compress_States(States,tol=1e-4):
+    ''' Keep only the large components of a set of eigenstates
+
+    Most eigenstates have only a handful of significant components in the
+    uncoupled basis. This drops every component with magnitude below tol and
+    stores the rest as a scipy.sparse.csc_matrix of complex64, which can be
+    passed straight to the LabelStates functions, TDM, Transition_Dipoles and
+    Sort_Smooth.
+
+    Args:
+        States (numpy.ndarray) - (dim,k) eigenstates stored as columns, or a (steps,dim,k) stack from a sweep
+
+    kwargs:
+        tol (float) - smallest magnitude of component to keep (default = 1e-4)
+
+    Returns:
+        compressed (scipy.sparse.csc_matrix or list) - the compressed states, a list with one matrix per step for a stack
+        discarded (numpy.ndarray) - (k,) or (steps,k) norm of the part of each state that was dropped
+    '''
+    States = numpy.asarray(States)
+    if States.ndim == 3:
+        compressed = [Compress_States(S,tol) for S in States]
+        return ([c[0] for c in compressed],
+                numpy.array([c[1] for c in compressed]))
+
+    dim,k = States.shape
+    weight = States.real**2+States.imag**2
+    keep = weight >= tol**2
+    discarded = numpy.sqrt(numpy.sum(numpy.where(keep,0,weight),axis=0))
+
+    # numpy.nonzero of the transpose runs down each column in turn, which is
+    # the order the csc format wants
+    cols,rows = numpy.nonzero(keep.T)
+    indptr = numpy.searchsorted(cols,numpy.arange(k+1))
+    data = States[rows,cols].astype(numpy.complex64)
+    compressed = scipy.sparse.csc_matrix((data,rows,indptr),shape=(dim,k))
+    return compressed,discarded
+
+def Save_Compressed(fname,States,discarded=None):
+    ''' Save compressed eigenstates to a .npz file
+
+    The basis indices are stored as 16 bit integers where the basis is small
+    enough, so each kept component takes 10 bytes.
+
+    Args:
+        fname (str) - file name, .npz is appended if not present
+        States (scipy.sparse matrix or list) - compressed states from Compress_States
+
+    kwargs:
+        discarded (numpy.ndarray) - discarded norms from Compress_States
+    '''
+    stack = isinstance(States,(list,tuple))
+    if not stack:
+        States = [States]
+    States = [scipy.sparse.csc_matrix(S) for S in States]
+    dim,k = States[0].shape
+    index = numpy.uint16 if dim <= numpy.iinfo(numpy.uint16).max+1 \
+                                                            else numpy.int32
+
+    arrays = {"data":numpy.concatenate([S.data for S in States]
+                                            ).astype(numpy.complex64),
+            "indices":numpy.concatenate([S.indices for S in States]
+                                            ).astype(index),
+            "indptr":numpy.array([S.indptr for S in States],dtype=numpy.int64),
+            "shape":numpy.array([len(States),dim,k]),
+            "stack":numpy.array(stack)}
+    if discarded is not None:
+        arrays["discarded"] = numpy.asarray(discarded,dtype=numpy.float32)
+    numpy.savez(fname,**arrays)
+
+def Load_Compressed(fname):
+    ''' Load compressed eigenstates saved by Save_Compressed
+
+    Args:
+        fname (str) - file name
+
+    Returns:
+        States (scipy.sparse.csc_matrix or list) - the compressed states
+        discarded (numpy.ndarray) - discarded norms, None if they were not saved
+    '''
+    if fname[-4:] != ".npz":
+        fname = fname+".npz"
+    with numpy.load(fname) as f:
+        steps,dim,k = f["shape"]
+        indptr = f["indptr"]
+        data = f["data"]
+        indices = f["indices"].astype(numpy.int32)
+        discarded = f["discarded"] if "discarded" in f else None
+        stack = bool(f["stack"])
+
+    States = []
+    start = 0
+    for p in indptr:
+        stop = start+p[-1]
+        States.append(scipy.sparse.csc_matrix((data[start:stop],
+                        indices[start:stop],p-p[0]),shape=(dim,k)))
+        start = stop
+    if not stack:
+        return States[0],discarded
+    return States,discarded
+
+def Export_State_Sparse(fname,Nmax,I1,I2,States,labels=None,headers=None,
+                                                            dp=6,tol=1e-4):
+    ''' Export the significant components of each state
+
+    A sparse form of Export_State_Comp. Each row of the output is one
+    component of one state: the index of the state, its labels, the
+    uncoupled basis state (N:MN:M1:M2) and the real and imaginary parts of
+    the amplitude. Only components with magnitude of at least tol are
+    written.
+
+    Args:
+        fname (string) : the filename and path to save the output file
+        Nmax (int/float) : the maximum value of N used in the calculation
+        I1,I2 (float) : the nuclear spin quantum numbers of nucleus 1 and 2
+        States (numpy.ndarray or scipy.sparse matrix) : (M,N) eigenstates stored as columns, or from Compress_States
+
+    kwargs:
+        labels (X,N) list : X labels for each of the N states
+        headers (X) list : descriptions of the labels
+        dp (int) : number of decimal places to output the file to [default = 6]
+        tol (float) : smallest magnitude of component to write [default = 1e-4]
+    '''
+    if fname[-4:]!=".csv":
+        fname = fname+".csv"
+    dp = int(numpy.round(dp))
+
+    if scipy.sparse.issparse(States):
+        States = scipy.sparse.csc_matrix(States)
+        States = States.multiply(abs(States) >= tol).tocsc()
+    else:
+        States = Compress_States(States,tol)[0]
+    States.eliminate_zeros()
+    States.sort_indices()
+
+    if labels is None:
+        labels = numpy.zeros((0,States.shape[1]))
+    labels = numpy.array(labels).real
+    if headers is None or len(headers) != labels.shape[0]:
+        if labels.shape[0] > 0:
+            warnings.warn("using default headers for labels",UserWarning)
+        headers = ["Label {:.0f}".format(x) for x in range(labels.shape[0])]
+
+    diagonal = Hamiltonian.Angular_Momentum(Nmax,I1,I2)['diagonal']
+    N2 = numpy.round(SolveQuadratic(1,1,-1*diagonal['N2']),0)
+    MN = numpy.round(diagonal['Nz'],0)
+    M1 = numpy.round(diagonal['I1z'],1)
+    M2 = numpy.round(diagonal['I2z'],1)
+
+    value = "{:."+str(dp)+"f}"
+    with open(fname,"w") as f:
+        f.write(",".join(["# State"]+list(headers)+
+                            ["Basis (N:MN:M1:M2)","Re","Im"])+"\n")
+        for k in range(States.shape[1]):
+            start,stop = States.indptr[k],States.indptr[k+1]
+            state = ",".join(["{:d}".format(k)]+
+                            ["{:.1f}".format(x) for x in labels[:,k]])
+            for i,a in zip(States.indices[start:stop],
+                                                States.data[start:stop]):
+                f.write(state+",({:.0f}:{:.0f}:{:.1f}:{:.1f}),".format(
+                                                N2[i],MN[i],M1[i],M2[i])+
+                        value.format(a.real)+","+value.format(a.imag)+"\n")
+
 if __name__ == "__main__":
     import os
     from scipy import constants
@@ -533,7 +1933,7 @@ if __name__ == "__main__":
 
     dir = os.path.dirname(cwd)
 
-    dir = dir+"\\Example Scripts\\Outputs"
+    dir = os.path.join(dir,"Example Scripts","Outputs")
 
     if not os.path.exists(dir):
         os.makedirs(dir)
@@ -546,28 +1946,36 @@ if __name__ == "__main__":
     E = 0
     B = 181.5*1e-4
 
-    H = [H0+Hz*Bz+E*HDC+I*HAC for Bz in numpy.linspace(1e-6,B,200)]
-
-    eigvals,eigstates = numpy.linalg.eig(H)
-    print("Sorting")
-    eigvals,eigstates = Sort_Smooth(eigvals,eigstates,pb=True)
+    # all of the fields are along z so each MF can be solved separately
+    MF,blocks = MF_Blocks(Nmax,Consts['I1'],Consts['I2'])
+    # the step adapts to the crossings, so the states come out already sorted
+    fields,eigvals = Sweep_Adaptive((H0,Hz,HDC,HAC),[1e-6,E,I],[B,E,I],
+                                        blocks=blocks,return_states=False)
+    print("{:d} field points".format(len(fields)))
+    fields,eigvals = Resample_Levels(fields[:,0],eigvals,200,
+                                        start=fields[0],stop=fields[-1])
+
+    # keeping the states at every accepted step takes GBs, so solve again at
+    # the end and put the states in the same order as the tracked levels
+    energies,states = numpy.linalg.eigh(H0+B*Hz+E*HDC+I*HAC)
+    states = states[:,numpy.argsort(numpy.argsort(eigvals[-1,:],
+                                                            kind='stable'))]
 
     eigvals = eigvals /h # convert to Hz
 
-    N,MN = LabelStates_N_MN(eigstates[-1,:,:],Nmax,Consts['I1'],Consts['I2'])
+    N,MN = LabelStates_N_MN(states,Nmax,Consts['I1'],Consts['I2'])
 
-    F,MF = LabelStates_F_MF(eigstates[-1,:,:],Nmax,Consts['I1'],Consts['I2'])
+    F,MF = LabelStates_F_MF(states,Nmax,Consts['I1'],Consts['I2'])
 
     labels = [N,MF,eigvals[-1,:]]
 
     headers = ["N","MF","Energy@181.5G (Hz)"]
-    Export_State_Comp(dir+"\\States_{:.2f}".format(B*1e4),
+    Export_State_Comp(os.path.join(dir,"States_{:.2f}".format(B*1e4)),
                             Nmax,Consts['I1'],Consts['I2'],
-                            eigstates[-1,:,:],labels=labels,headers=headers)
+                            states,labels=labels,headers=headers)
     labels = [N,MF]
 
     headers = ["N","MF"]
-    Export_Energy(dir+"\\Energy_{:.2f}".format(B*1e4),
-                            Nmax,Consts['I1'],Consts['I2'],
-                            eigvals,1e4*numpy.linspace(1e-6,B,200),
+    Export_Energy(os.path.join(dir,"Energy_{:.2f}".format(B*1e4)),
+                            eigvals,1e4*fields[:,0],
                             labels=labels,headers=headers)
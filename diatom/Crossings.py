@@ -0,0 +1,239 @@
+from diatom import Calculate
+import numpy
+import scipy.sparse
+'''
+This module finds avoided crossings along a straight line through
+(B,E,I) space, without needing a very dense sweep.
+
+A coarse sweep is made first. Pairs of neighbouring levels that swap
+character between two points (the overlap of each eigenstate with itself at
+the next point drops) or that come closer than a given gap are candidates.
+Only those intervals are refined, by a golden section search on the gap
+between the two levels, with all of the candidates solved together in
+batches. Close to an avoided crossing between two levels the square of the
+gap is a quadratic in the field, so the last three points of the search fix
+the position of the minimum far more accurately than the width of the
+final interval.
+
+Levels with different symmetry cross exactly. If every field is along z
+those crossings can be skipped by searching each MF block separately (see
+Calculate.MF_Blocks), otherwise they are found too, with a gap close to zero.
+
+Example:
+    Avoided crossings of RbCs in the N=0 manifold from 0 to 200 G::
+
+        from diatom import Calculate,Crossings
+        Hams = Calculate.Build_Hamiltonians(1,RbCs,zeeman=True)
+        MF,blocks = Calculate.MF_Blocks(1,RbCs['I1'],RbCs['I2'])
+        found = Crossings.Find_Crossings(Hams,[0,0,0],[200e-4,0,0],
+                                            blocks=blocks)
+'''
+
+# 1/golden ratio
+_invphi = (numpy.sqrt(5)-1)/2
+
+def _path(start,stop,t):
+    ''' (points,3) fields at fractions t of the way from start to stop '''
+    t = numpy.atleast_1d(numpy.asarray(t,dtype=float))
+    return start[None,:]+t[:,None]*(stop-start)[None,:]
+
+def _candidates(E,S,overlap,gap):
+    ''' (point,level) of the coarse sweep nearest each candidate crossing
+
+    Level i is the pair of levels i and i+1 in order of energy.
+    '''
+    g = numpy.diff(E,axis=1)
+    candidates = set()
+    if S is not None and g.shape[1] > 0:
+        # |<i(t_k)|i(t_k+1)>| for every level, a drop means that the state
+        # has changed character between the two points. At a crossing of
+        # levels i and i+1 both of them drop.
+        ov = numpy.abs(numpy.einsum('pai,pai->pi',numpy.conj(S[:-1]),S[1:]))
+        drop = numpy.maximum(ov[:,:-1],ov[:,1:]) < overlap
+        for k,i in zip(*numpy.nonzero(drop)):
+            candidates.add((k if g[k,i] <= g[k+1,i] else k+1,i))
+    if gap is not None:
+        # local minima of the gap that are below the threshold
+        left = numpy.concatenate([numpy.full((1,g.shape[1]),numpy.inf),
+                                                                g[:-1]])
+        right = numpy.concatenate([g[1:],numpy.full((1,g.shape[1]),
+                                                                numpy.inf)])
+        small = (g < gap)&(g <= left)&(g <= right)
+        candidates.update(zip(*numpy.nonzero(small)))
+    return sorted((int(k),int(i)) for k,i in candidates)
+
+def _vertex(x,y):
+    ''' minimum of the parabola through three points, nan if there isn't one '''
+    x0,x1,x2 = x
+    y0,y1,y2 = y
+    denominator = (x1-x0)*(y1-y2)-(x1-x2)*(y1-y0)
+    numerator = (x1-x0)**2*(y1-y2)-(x1-x2)**2*(y1-y0)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        curvature = ((y2-y1)/(x2-x1)-(y1-y0)/(x1-x0))
+        x = numpy.where(curvature > 0,x1-0.5*numpy.where(denominator != 0,
+                                numerator/denominator,numpy.nan),numpy.nan)
+    return x
+
+def _refine(terms,coeffs,t,E,candidates,subset,xtol,chunk):
+    ''' golden section search on the gap of each candidate, all at once
+
+    Returns the refined positions, the level of each candidate, the
+    smaller of the gaps at the two ends of its interval in the coarse sweep
+    and the number of points solved.
+    '''
+    def gaps(x,i):
+        energies = Calculate._Sweep_Core(terms,coeffs(x),False,chunk,
+                                                            subset=subset)
+        return energies[numpy.arange(len(i)),i+1]-energies[numpy.arange(
+                                                                len(i)),i]
+
+    k = numpy.array([c[0] for c in candidates])
+    i = numpy.array([c[1] for c in candidates])
+    last = len(t)-1
+    ka = numpy.maximum(k-1,0)
+    kb = numpy.minimum(k+1,last)
+    a,b = t[ka],t[kb]
+    fa = E[ka,i+1]-E[ka,i]
+    fb = E[kb,i+1]-E[kb,i]
+    ends = numpy.minimum(fa,fb)
+
+    x = b-_invphi*(b-a)
+    y = a+_invphi*(b-a)
+    f = gaps(numpy.concatenate([x,y]),numpy.concatenate([i,i]))
+    fx,fy = f[:len(i)],f[len(i):]
+    solves = 2*len(i)
+
+    while numpy.any(b-a > xtol):
+        # the minimum is in [a,y] if fx < fy, otherwise in [x,b], and one of
+        # the two inner points carries over to the new interval
+        left = fx < fy
+        a,b,fa,fb = (numpy.where(left,a,x),numpy.where(left,y,b),
+                        numpy.where(left,fa,fx),numpy.where(left,fy,fb))
+        x,y,fx,fy = (numpy.where(left,b-_invphi*(b-a),y),
+                        numpy.where(left,x,a+_invphi*(b-a)),
+                        numpy.where(left,numpy.nan,fy),
+                        numpy.where(left,fx,numpy.nan))
+        f = gaps(numpy.where(left,x,y),i)
+        fx = numpy.where(left,f,fx)
+        fy = numpy.where(left,fy,f)
+        solves += len(i)
+
+    # the square of the gap is quadratic near an avoided crossing, fit it
+    # through the three points around the minimum
+    left = fx < fy
+    points = numpy.where(left,[a,x,y],[x,y,b])
+    values = numpy.where(left,[fa,fx,fy],[fx,fy,fb])**2
+    best = numpy.where(left,x,y)
+    position = _vertex(points,values)
+    position = numpy.where(numpy.isfinite(position)&(position >= a)
+                                            &(position <= b),position,best)
+    return position,i,ends,solves
+
+def Find_Crossings(Hams,start,stop,points=101,overlap=0.9,gap=None,
+                    blocks=None,subset=None,xtol=1e-6,chunk=None):
+    ''' Locate avoided crossings along a line from start to stop
+
+    The fields go in a straight line from start to stop, and positions along
+    it are given by t, which goes from 0 at start to 1 at stop.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        start,stop (numpy.ndarray) - (B,E,I) at the two ends of the line in T, V/m and W/m^2
+
+    kwargs:
+        points (int) - number of points in the coarse sweep
+        overlap (float) - a pair of levels is a candidate if either state has an overlap smaller than this with itself at the next point
+        gap (float) - a pair of levels is also a candidate where the gap between them has a local minimum smaller than this, in joules
+        blocks (list of numpy.ndarray) - symmetry blocks from MF_Blocks, to only search for crossings of levels in the same block. Only valid when everything is along z
+        subset (tuple) - (lo,hi) only consider levels lo to hi-1 counting from the lowest, not with blocks
+        xtol (float) - width in t to refine each crossing to
+        chunk (int) - number of points to solve at once
+
+    Returns:
+        crossings (dict) - arrays with one entry per crossing, in order of t:
+            "t" (C,) position along the line,
+            "fields" (C,3) (B,E,I) at the crossing,
+            "gap" (C,) energy gap at the crossing in joules,
+            "energies" (C,2) energies of the two levels,
+            "levels" (C,2) indices of the two levels counting from the lowest, in the block (or subset) that they are in,
+            "block" (C,) index of the block of the crossing, -1 without blocks,
+            "states" (C,dim,2) the two eigenstates at the crossing,
+            "solves" total number of points that were diagonalised
+    '''
+    if blocks is not None and subset is not None:
+        raise ValueError("subset can not be used with blocks")
+    start = numpy.asarray(start,dtype=float)
+    stop = numpy.asarray(stop,dtype=float)
+    terms,_ = Calculate._Sweep_Terms(Hams,numpy.array([start,stop]))
+    dim = terms[0].shape[0]
+    groups = [None] if blocks is None else list(blocks)
+
+    t = numpy.linspace(0,1,points)
+    found = {"t":[],"gap":[],"energies":[],"levels":[],"block":[],
+                                                                "states":[]}
+    coeffs = lambda x: Calculate._Sweep_Terms(Hams,_path(start,stop,x))[1]
+    solves = 0
+    for b,group in enumerate(groups):
+        if group is None:
+            block = terms
+        else:
+            block = [T[group][:,group] if numpy.ndim(T) == 2 else T
+                                                            for T in terms]
+            block = [T.toarray() if scipy.sparse.issparse(T) else T
+                                                            for T in block]
+        E,S = Calculate._Sweep_Core(block,coeffs(t),True,chunk,subset=subset)
+        solves += points
+        candidates = _candidates(E,S,overlap,gap)
+        if not candidates:
+            continue
+
+        position,levels,ends,n = _refine(block,coeffs,t,E,candidates,subset,
+                                                                xtol,chunk)
+        solves += n
+        energies,states = Calculate._Sweep_Core(block,coeffs(position),True,
+                                                        chunk,subset=subset)
+        solves += len(position)
+        rows = numpy.arange(len(position))
+        pair = numpy.stack([levels,levels+1],axis=1)
+        E2 = energies[rows[:,None],pair]
+        S2 = numpy.moveaxis(states[rows[:,None],:,pair],1,2)
+
+        # a minimum at the end of the interval is not a crossing, just a
+        # region where the states change quickly, and the same crossing can
+        # be reached from neighbouring coarse points
+        keep = []
+        for c in numpy.lexsort((position,levels)):
+            if not E2[c,1]-E2[c,0] < ends[c]:
+                continue
+            if keep and levels[keep[-1]] == levels[c] and \
+                        abs(position[keep[-1]]-position[c]) < 1/(points-1):
+                if E2[c,1]-E2[c,0] < E2[keep[-1],1]-E2[keep[-1],0]:
+                    keep[-1] = c
+                continue
+            keep.append(c)
+
+        for c in keep:
+            V = S2[c]
+            if group is not None:
+                V = numpy.zeros((dim,2),dtype=numpy.complex128)
+                V[group] = S2[c]
+            found["t"].append(position[c])
+            found["gap"].append(E2[c,1]-E2[c,0])
+            found["energies"].append(E2[c])
+            found["levels"].append(pair[c])
+            found["block"].append(-1 if group is None else b)
+            found["states"].append(V)
+
+    order = numpy.argsort(found["t"],kind='stable')
+    crossings = {"t":numpy.array(found["t"],dtype=float)[order]}
+    crossings["fields"] = _path(start,stop,crossings["t"]).reshape(-1,3)
+    crossings["gap"] = numpy.array(found["gap"],dtype=float)[order]
+    crossings["energies"] = numpy.array(found["energies"],
+                                        dtype=float).reshape(-1,2)[order]
+    crossings["levels"] = numpy.array(found["levels"],
+                                        dtype=int).reshape(-1,2)[order]
+    crossings["block"] = numpy.array(found["block"],dtype=int)[order]
+    crossings["states"] = numpy.array(found["states"],
+                        dtype=numpy.complex128).reshape(-1,dim,2)[order]
+    crossings["solves"] = solves
+    return crossings
@@ -0,0 +1,178 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+import numpy
+import scipy.sparse
+'''
+This module builds small effective Hamiltonians for one or more rotational
+manifolds, using quasi-degenerate (Van Vleck) perturbation theory to second
+order.
+
+The couplings to the other rotational levels (the Stark effect, and the
+tensor and anisotropic ac Stark couplings with Delta N = 2) are folded into
+the chosen manifolds. The result is a polynomial in B, E and I with matrix
+coefficients, which can be evaluated and diagonalised at a very large number of
+field points for a fraction of the cost of the full Hamiltonian.
+'''
+
+# powers of (B,E,I) that multiply H0, Hz, HDC and HAC
+_powers = numpy.array([[0,0,0],[1,0,0],[0,1,0],[0,0,1]])
+
+def Manifold_Basis(N,Nmax,I1,I2):
+    ''' Indices of the uncoupled basis states in rotational manifold(s) N
+
+    Args:
+        N (int or list of ints) - rotational manifold(s)
+        Nmax (int) - Maximum rotational level in the basis
+        I1,I2 (float) - nuclear spins
+
+    Returns:
+        P (numpy.ndarray) - indices of the basis states with N in the manifolds
+    '''
+    shapeS = int((2*I1+1)*(2*I2+1))
+    return numpy.concatenate([numpy.arange(n**2*shapeS,(n+1)**2*shapeS)
+                                for n in sorted(set(numpy.atleast_1d(N)))
+                                if n <= Nmax]).astype(int)
+
+def Van_Vleck(Nmax,Constants,N,Hams=None):
+    ''' Second order effective Hamiltonian for rotational manifold(s) N
+
+    Finds matrices M_k such that in the basis states of the manifolds N
+
+    H_eff(B,E,I) = sum_k B^b_k E^e_k I^i_k M_k
+
+    where (b_k,e_k,i_k) = powers[k]. The zeroth order energies are the
+    rotational energies Brot N(N+1) - Drot N^2(N+1)^2, everything else in
+    the Hamiltonian is treated as the perturbation. The terms are first
+    order (linear in the fields) or second order (quadratic).
+
+    Args:
+        Nmax (int) - Maximum rotational level of the full basis
+        Constants (Dictionary) - Dict of molecular constants
+        N (int or list of ints) - rotational manifold(s) to keep
+
+    kwargs:
+        Hams (list) - H0,Hz,HDC,HAC from Build_Hamiltonians, built here if not given
+
+    Returns:
+        terms (numpy.ndarray) - (K,p,p) the matrices M_k
+        powers (numpy.ndarray) - (K,3) powers of (B,E,I) for each term
+        P (numpy.ndarray) - the p basis states that the effective Hamiltonian acts on
+    '''
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    if Hams is None:
+        Hams = Hamiltonian.Build_Hamiltonians(Nmax,Constants,True,True,True,
+                                                                sparse=True)
+    dim = Hams[0].shape[0]
+    shapeS = int((2*I1+1)*(2*I2+1))
+
+    P = Manifold_Basis(N,Nmax,I1,I2)
+    Q = numpy.setdiff1d(numpy.arange(dim),P)
+
+    # rotational energy of each basis state
+    Nlabel = numpy.repeat(numpy.arange(Nmax+1),
+                        [(2*n+1)*shapeS for n in range(Nmax+1)])
+    Erot = Constants['Brot']*Nlabel*(Nlabel+1) \
+                            -Constants['Drot']*(Nlabel*(Nlabel+1))**2
+
+    terms = {}
+    def add(power,M):
+        key = tuple(int(x) for x in power)
+        terms[key] = terms.get(key,0)+M
+
+    used = [(a,scipy.sparse.csr_matrix(H)) for a,H in enumerate(Hams)
+                                                    if numpy.ndim(H) == 2]
+
+    # first order, the Hamiltonian inside the manifolds
+    for a,H in used:
+        add(_powers[a],H[P][:,P].toarray())
+
+    # second order, through every state outside the manifolds
+    # <m|H_eff|m'> = 1/2 sum_l <m|V|l><l|V|m'> [1/(E_m-E_l) + 1/(E_m'-E_l)]
+    out = {a:H[P][:,Q] for a,H in used}
+    back = {a:H[Q][:,P] for a,H in used}
+    manifolds = numpy.unique(Nlabel[P])
+    rows = [numpy.flatnonzero(Nlabel[P] == n) for n in manifolds]
+    # 1/(E_n - E_l) for each manifold n and outside state l
+    G = [1/(Erot[P][r[0]]-Erot[Q]) for r in rows]
+
+    for a,A in out.items():
+        for b,Bm in back.items():
+            M = numpy.zeros((len(P),len(P)),dtype=numpy.complex128)
+            for r,g in zip(rows,G):
+                M[r,:] += 0.5*(A[r].multiply(g[None,:])).dot(Bm).toarray()
+                M[:,r] += 0.5*A.dot(Bm[:,r].multiply(g[:,None])).toarray()
+            if numpy.any(M):
+                add(_powers[a]+_powers[b],M)
+
+    powers = numpy.array(sorted(terms.keys()),dtype=int)
+    terms = numpy.array([terms[tuple(p)] for p in powers],
+                                                    dtype=numpy.complex128)
+    return terms,powers,P
+
+def Effective_Coefficients(powers,fields):
+    ''' Weight of each effective Hamiltonian term at each field point
+
+    Args:
+        powers (numpy.ndarray) - (K,3) powers of (B,E,I) from Van_Vleck
+        fields (numpy.ndarray) - (points,3) array of (B,E,I)
+
+    Returns:
+        coeffs (numpy.ndarray) - (points,K) coefficients
+    '''
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    return numpy.prod(fields[:,None,:]**powers[None,:,:],axis=2)
+
+def Effective_Sweep(terms,powers,fields,return_states=True,chunk=None):
+    ''' Eigenstates of the effective Hamiltonian over a list of field values
+
+    Args:
+        terms,powers - effective Hamiltonian from Van_Vleck
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) in T, V/m and W/m^2
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        chunk (int) - number of points to solve at once
+
+    Returns:
+        energies (numpy.ndarray) - (points,p) eigenenergies, lowest to highest at each point
+        states (numpy.ndarray) - (points,p,p) eigenstates in the basis P of Van_Vleck
+    '''
+    return Calculate._Sweep_Core(terms,Effective_Coefficients(powers,fields),
+                                                        return_states,chunk)
+
+def Effective_Error(Nmax,Constants,N,terms,powers,fields,Hams=None):
+    ''' Error of the effective Hamiltonian compared to the full solution
+
+    Diagonalises the full Hamiltonian at each of the (few) field points given
+    and compares the energies of the states in the manifolds N with the
+    eigenvalues of the effective Hamiltonian.
+
+    Args:
+        Nmax (int) - Maximum rotational level of the full basis
+        Constants (Dictionary) - Dict of molecular constants
+        N (int or list of ints) - rotational manifold(s) of the effective Hamiltonian
+        terms,powers - effective Hamiltonian from Van_Vleck
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) to test at
+
+    kwargs:
+        Hams (list) - H0,Hz,HDC,HAC from Build_Hamiltonians, built here if not given
+
+    Returns:
+        error (numpy.ndarray) - (points,) largest absolute energy error at each point in Joules
+    '''
+    if Hams is None:
+        Hams = Hamiltonian.Build_Hamiltonians(Nmax,Constants,True,True,True)
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    # Manifold_Indices gives one contiguous range, take each manifold from
+    # it separately in case N skips any
+    manifolds = [Calculate.Manifold_Indices(n,Constants['I1'],Constants['I2'])
+                                            for n in numpy.unique(N)]
+    lo = manifolds[0][0]
+    subset = (lo,manifolds[-1][1])
+    keep = numpy.concatenate([numpy.arange(a-lo,b-lo) for a,b in manifolds])
+
+    full = Calculate.Sweep(Hams,fields,return_states=False,subset=subset)
+    full = full[:,keep]
+    effective = Effective_Sweep(terms,powers,fields,return_states=False)
+    return numpy.amax(numpy.abs(full-effective),axis=1)
@@ -0,0 +1,231 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+import numpy
+import scipy.constants
+import scipy.optimize
+import scipy.sparse
+'''
+This module fits molecular constants to measured transition frequencies.
+
+Every constant enters the Hamiltonian linearly, so
+
+H = sum_c c * f_c(B,E,I) * U_c
+
+where U_c is the Hamiltonian with that constant set to one and everything
+else set to zero, and f_c is 1 for the field-free constants, B for the
+magnetic moments, E for the dipole moment and I for the polarisabilities. The
+U_c are built once, after which the Hamiltonian for any set of constants at
+any fields is a weighted sum of fixed matrices. The derivative of an energy
+with respect to a constant is the expectation value <psi|f_c U_c|psi>
+(Hellmann-Feynman), so the Jacobian of the fit costs nothing beyond the
+eigenstates that are already needed for the energies.
+
+Example:
+    Fit the scalar spin-spin coupling and the rotational constant to a list
+    of measured transitions between the states lower and upper (indices of
+    the eigenstates in order of energy) at the field points fields::
+
+        from diatom import Fitting
+        Constants,result = Fitting.Fit_Constants(1,RbCs,["Brot","C4"],
+                                fields,lower,upper,frequencies)
+'''
+
+h = scipy.constants.h
+eps0 = scipy.constants.epsilon_0
+c = scipy.constants.c
+
+# which field multiplies each constant, 0 for none then B, E and I
+_fields = {"Brot":0,"Drot":0,"Q1":0,"Q2":0,"C1":0,"C2":0,"C3":0,"C4":0,
+            "Mu1":1,"Mu2":1,"MuN":1,
+            "d0":2,
+            "a0":3,"a2":3}
+
+def Unit_Matrices(Nmax,I1,I2,Beta=0,sparse=False):
+    ''' The Hamiltonian per unit of each molecular constant
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        I1,I2 (float) - nuclear spins
+
+    kwargs:
+        Beta (float) - polarisation angle of the trapping laser in radians
+        sparse (bool) - return scipy.sparse.csr_matrix (default = False)
+
+    Returns:
+        units (dict) - matrix U_c for each constant c, which is multiplied by c and by the field given in Fitting._fields
+    '''
+    molecule = Hamiltonian.Compile_Molecule(Nmax,I1,I2)
+    return {name:molecule.Unit(name,Beta,sparse) for name in _fields}
+
+def Fit_Model(Nmax,Constants,parameters):
+    ''' Precompute everything needed to evaluate the Hamiltonian in a fit
+
+    The constants that are not being fitted are summed into one fixed matrix
+    for each field (none, B, E and I), the fitted ones are kept separate.
+    Everything is kept as scipy.sparse matrices, so the memory needed grows
+    with the number of nonzero elements rather than with dim^2 for every
+    fitted constant.
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants, the starting point of the fit
+        parameters (list of str) - names of the constants to fit
+
+    Returns:
+        model (dict) - the fixed and unit matrices, for Transition_Frequencies
+    '''
+    parameters = list(parameters)
+    for name in parameters:
+        if name not in _fields:
+            raise ValueError("{:s} is not a constant that can be fitted, "
+                        "choose from {:s}".format(name,", ".join(_fields)))
+
+    units = Unit_Matrices(Nmax,Constants['I1'],Constants['I2'],
+                                        Constants.get('Beta',0),sparse=True)
+    dim = units["Brot"].shape[0]
+    fixed = [scipy.sparse.csr_matrix((dim,dim),dtype=numpy.complex128)
+                                                        for k in range(4)]
+    for name,U in units.items():
+        if name not in parameters:
+            fixed[_fields[name]] = fixed[_fields[name]]+Constants[name]*U
+
+    return {"parameters":parameters,
+            "fixed":fixed,
+            "units":[units[name] for name in parameters],
+            "fields":numpy.array([_fields[name] for name in parameters],
+                                                                dtype=int)}
+
+def _multipliers(fields):
+    ''' (points,4) of 1,B,E,I at each point '''
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    return numpy.column_stack([numpy.ones(fields.shape[0]),fields])
+
+def Transition_Frequencies(model,values,fields,lower,upper,jacobian=False,
+                                                                chunk=None):
+    ''' Transition frequencies for a set of constants, and their derivatives
+
+    The transitions are grouped by field point so that each distinct point is
+    only solved once, and all of the points are solved in batches. The fitted
+    constants are added to the fixed matrices of Fit_Model first, so only
+    four dense matrices (none, B, E and I) are made for each call.
+
+    The derivatives come from the Hellmann-Feynman theorem, so they are only
+    correct if neither state is degenerate with another. Measurements at
+    exactly zero field, where the MF sublevels are degenerate, should be
+    taken at a small magnetic field instead.
+
+    Args:
+        model (dict) - from Fit_Model
+        values (numpy.ndarray) - value of each of the fitted parameters, in SI units
+        fields (numpy.ndarray) - (T,3) array of (B,E,I) for each transition
+        lower,upper (numpy.ndarray) - (T,) indices of the two states of each transition, in order of increasing energy at that field
+
+    kwargs:
+        jacobian (bool) - also return the derivatives with respect to the parameters (default = False)
+        chunk (int) - number of field points to solve at once
+
+    Returns:
+        frequencies (numpy.ndarray) - (T,) transition frequencies in Hz
+        jacobian (numpy.ndarray) - (T,P) derivative of each frequency with respect to each parameter, in Hz per SI unit
+    '''
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    lower = numpy.asarray(lower,dtype=int)
+    upper = numpy.asarray(upper,dtype=int)
+    values = numpy.asarray(values,dtype=float)
+
+    points,inverse = numpy.unique(fields,axis=0,return_inverse=True)
+    inverse = inverse.ravel()
+    multipliers = _multipliers(points)
+
+    terms = list(model["fixed"])
+    for p,U in enumerate(model["units"]):
+        terms[model["fields"][p]] = terms[model["fields"][p]]+values[p]*U
+
+    result = Calculate._Sweep_Core(terms,multipliers,jacobian,chunk)
+    energies = result[0] if jacobian else result
+    frequencies = (energies[inverse,upper]-energies[inverse,lower])/h
+    if not jacobian:
+        return frequencies
+
+    # <psi|U|psi> for the states of each transition only
+    states = result[1]
+    J = numpy.zeros((len(lower),len(values)))
+    for p,U in enumerate(model["units"]):
+        f = multipliers[inverse,model["fields"][p]]
+        for sign,index in ((1,upper),(-1,lower)):
+            psi = states[inverse,:,index]
+            X = numpy.einsum('ti,it->t',numpy.conj(psi),U.dot(psi.T)).real
+            J[:,p] += sign*f*X
+    return frequencies,J/h
+
+def Fit_Constants(Nmax,Constants,parameters,fields,lower,upper,frequencies,
+                    uncertainties=None,chunk=None,**kwargs):
+    ''' Least squares fit of molecular constants to transition frequencies
+
+    Uses scipy.optimize.least_squares with the analytic Jacobian from
+    Transition_Frequencies. The Hamiltonian is never rebuilt, each function
+    evaluation is a weighted sum of the precomputed matrices and one batched
+    diagonalisation of the distinct field points.
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants, the starting point of the fit
+        parameters (list of str) - names of the constants to fit
+        fields (numpy.ndarray) - (T,3) array of (B,E,I) for each transition in T, V/m and W/m^2
+        lower,upper (numpy.ndarray) - (T,) indices of the two states of each transition, in order of increasing energy at that field
+        frequencies (numpy.ndarray) - (T,) measured frequencies in Hz
+
+    kwargs:
+        uncertainties (numpy.ndarray) - (T,) uncertainty of each measurement in Hz. If given they are taken to be absolute, if not they are all equal and found from the scatter of the residuals
+        chunk (int) - number of field points to solve at once
+        any other kwargs are passed to scipy.optimize.least_squares
+
+    Returns:
+        Constants (Dictionary) - copy of Constants with the fitted values
+        result (scipy.optimize.OptimizeResult) - from least_squares, with the parameter covariance added as result.covariance
+    '''
+    model = Fit_Model(Nmax,Constants,parameters)
+    frequencies = numpy.asarray(frequencies,dtype=float)
+    absolute = uncertainties is not None
+    if uncertainties is None:
+        uncertainties = numpy.ones_like(frequencies)
+    uncertainties = numpy.asarray(uncertainties,dtype=float)
+
+    # the parameters span many orders of magnitude in SI units, so fit their
+    # ratio to the starting values instead
+    scale = numpy.array([abs(Constants[name]) for name in model["parameters"]])
+    scale[scale == 0] = 1
+
+    last = {}
+    def evaluate(x):
+        key = x.tobytes()
+        if last.get("key") != key:
+            last["key"] = key
+            last["value"] = Transition_Frequencies(model,x*scale,fields,
+                                    lower,upper,jacobian=True,chunk=chunk)
+        return last["value"]
+
+    def residuals(x):
+        return (evaluate(x)[0]-frequencies)/uncertainties
+
+    def jacobian(x):
+        return evaluate(x)[1]*scale[None,:]/uncertainties[:,None]
+
+    x0 = numpy.array([Constants[name] for name in model["parameters"]])/scale
+    kwargs.setdefault("x_scale","jac")
+    result = scipy.optimize.least_squares(residuals,x0,jac=jacobian,**kwargs)
+
+    try:
+        covariance = numpy.linalg.inv(result.jac.T.dot(result.jac))
+    except numpy.linalg.LinAlgError:
+        covariance = numpy.full((len(x0),len(x0)),numpy.nan)
+    if not absolute:
+        # no uncertainties, so estimate them from the reduced chi^2
+        dof = len(frequencies)-len(x0)
+        covariance = covariance*(2*result.cost/dof if dof > 0 else numpy.nan)
+    result.covariance = covariance*scale[:,None]*scale[None,:]
+
+    fitted = dict(Constants)
+    for name,x,s in zip(model["parameters"],result.x,scale):
+        fitted[name] = x*s
+    return fitted,result
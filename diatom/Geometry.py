@@ -0,0 +1,168 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+import numpy
+import warnings
+import scipy.constants
+'''
+This module handles magnetic and electric fields that point in any direction.
+
+The Zeeman and dc Stark Hamiltonians are vector operators, so for field
+vectors B = (Bx,By,Bz) and E = (Ex,Ey,Ez)
+
+H = H0 + Bx*Zx + By*Zy + Bz*Zz + Ex*Dx + Ey*Dy + Ez*Dz + I*HAC
+
+The x, y and z components are made once for each (Nmax,I1,I2) (see
+Hamiltonian.Zeeman_Components and Hamiltonian.DC_Components), after which the
+Hamiltonian for any field geometry is a weighted sum of the same eight
+matrices. Scans over the directions of the fields, for example the angle
+between B and E, are then solved in batches with the same code as
+Calculate.Sweep.
+
+The laser polarisation (Constants['Beta']) stays fixed in the lab frame, at an
+angle Beta to the z axis in the xz plane.
+
+Example:
+    Energies for B = 181.5 G along z and E = 1 kV/cm at 0 to 90 degrees to
+    it::
+
+        from diatom import Geometry
+        theta = numpy.linspace(0,numpy.pi/2,91)
+        energies,states = Geometry.Angle_Sweep(3,RbCs,181.5e-4,1e5,theta)
+'''
+
+eps0 = scipy.constants.epsilon_0
+c = scipy.constants.c
+
+def Geometry_Terms(Nmax,Constants,AC=False):
+    ''' Fixed matrices that make up the Hamiltonian for any field geometry
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+
+    kwargs:
+        AC (bool) - include the ac Stark shift (default = False)
+
+    Returns:
+        terms (list) - H0, Zx, Zy, Zz, Dx, Dy, Dz and HAC as scipy.sparse.csr_matrix, HAC is 0 if AC is False
+    '''
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,Constants,AC=AC,
+                                                                sparse=True)
+    zeeman = Hamiltonian.Zeeman_Components(Nmax,I1,I2,Constants,True)
+    dipole = Hamiltonian.DC_Components(Nmax,Constants['d0'],I1,I2,True)
+    return [H0]+zeeman+dipole+[HAC]
+
+def Geometry_Coefficients(B,E,I=0):
+    ''' Coefficient of each of the Geometry_Terms for each pair of fields
+
+    Args:
+        B (numpy.ndarray) - (n,3) or (3,) magnetic field vectors in T
+        E (numpy.ndarray) - (n,3) or (3,) electric field vectors in V/m
+
+    kwargs:
+        I (float or numpy.ndarray) - laser intensity in W/m^2, one value or (n,)
+
+    Returns:
+        coeffs (numpy.ndarray) - (n,8) weights of the Geometry_Terms
+    '''
+    B = numpy.atleast_2d(numpy.asarray(B,dtype=float))
+    E = numpy.atleast_2d(numpy.asarray(E,dtype=float))
+    if B.shape[-1] != 3 or E.shape[-1] != 3:
+        raise ValueError("field vectors must have three components")
+    n = max(B.shape[0],E.shape[0],numpy.size(I))
+    coeffs = numpy.zeros((n,8))
+    coeffs[:,0] = 1
+    coeffs[:,1:4] = B
+    coeffs[:,4:7] = E
+    coeffs[:,7] = I
+    return coeffs
+
+def Field_Vectors(B,E,theta,phi=0):
+    ''' Magnetic field along z and electric field at an angle to it
+
+    Any of the arguments can be an array, they are broadcast against each
+    other.
+
+    Args:
+        B (float) - magnetic field magnitude in T, along z
+        E (float) - electric field magnitude in V/m
+        theta (float) - angle between B and E in radians
+
+    kwargs:
+        phi (float) - azimuthal angle of E about z in radians, 0 is in the xz plane
+
+    Returns:
+        Bvec,Evec (numpy.ndarray) - (n,3) field vectors
+    '''
+    B,E,theta,phi = numpy.broadcast_arrays(*(numpy.atleast_1d(
+                    numpy.asarray(x,dtype=float)) for x in (B,E,theta,phi)))
+    zero = numpy.zeros_like(B)
+    Bvec = numpy.column_stack([zero,zero,B])
+    Evec = numpy.column_stack([E*numpy.sin(theta)*numpy.cos(phi),
+                                E*numpy.sin(theta)*numpy.sin(phi),
+                                E*numpy.cos(theta)])
+    return Bvec,Evec
+
+def Geometry_Sweep(Nmax,Constants,B,E,I=0,terms=None,return_states=True,
+                                                    chunk=None,subset=None):
+    ''' Eigenstates of the Hamiltonian over a list of field vectors
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+        B (numpy.ndarray) - (n,3) or (3,) magnetic field vectors in T
+        E (numpy.ndarray) - (n,3) or (3,) electric field vectors in V/m
+
+    kwargs:
+        I (float or numpy.ndarray) - laser intensity in W/m^2, one value or (n,)
+        terms (list) - from Geometry_Terms, built here if not given
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        chunk (int) - number of points to solve at once
+        subset (tuple) - (lo,hi) only keep eigenstates lo to hi-1 counting from the lowest
+
+    Returns:
+        energies (numpy.ndarray) - (n,k) eigenenergies, lowest to highest at each point
+        states (numpy.ndarray) - (n,dim,k) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    if terms is None:
+        terms = Geometry_Terms(Nmax,Constants,AC=numpy.any(I))
+    coeffs = Geometry_Coefficients(B,E,I)
+    # switched off terms are 0, drop them rather than build them
+    keep = [k for k,T in enumerate(terms) if numpy.ndim(T) == 2]
+    dropped = [k for k in range(len(terms)) if k not in keep]
+    if numpy.any(coeffs[:,dropped] != 0):
+        warnings.warn("a field is applied but its Hamiltonian is zero",
+                                                                UserWarning)
+    return Calculate._Sweep_Core([terms[k] for k in keep],coeffs[:,keep],
+                                    return_states,chunk,subset=subset)
+
+def Angle_Sweep(Nmax,Constants,B,E,theta,phi=0,I=0,terms=None,
+                                return_states=True,chunk=None,subset=None):
+    ''' Eigenstates of the Hamiltonian over the angle between B and E
+
+    B is along z and E is at an angle theta to it, see Field_Vectors.
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+        B (float) - magnetic field in T
+        E (float) - electric field in V/m
+        theta (numpy.ndarray) - angles between B and E in radians
+
+    kwargs:
+        phi (float) - azimuthal angle of E about z in radians
+        I (float) - laser intensity in W/m^2
+        terms (list) - from Geometry_Terms, built here if not given
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        chunk (int) - number of angles to solve at once
+        subset (tuple) - (lo,hi) only keep eigenstates lo to hi-1 counting from the lowest
+
+    Returns:
+        energies (numpy.ndarray) - (n,k) eigenenergies, lowest to highest at each angle
+        states (numpy.ndarray) - (n,dim,k) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    Bvec,Evec = Field_Vectors(B,E,theta,phi)
+    return Geometry_Sweep(Nmax,Constants,Bvec,Evec,I,terms,return_states,
+                                                            chunk,subset)
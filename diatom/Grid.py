@@ -0,0 +1,193 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+import numpy
+import numpy.lib.format
+import scipy.constants
+import json
+import os
+'''
+This module scans the Hamiltonian over a multi-dimensional grid of magnetic
+field, electric field, laser intensity and laser polarisation angle.
+
+The grid is worked through a chunk of points at a time and every chunk is
+written straight to .npy files on disk, so the full set of eigenstates never
+has to fit in memory. The files are memory mapped and the number of finished
+points is recorded after each chunk, so a scan that is interrupted picks up
+where it left off when it is run again.
+'''
+
+eps0 = scipy.constants.epsilon_0
+c = scipy.constants.c
+
+_axes = ("B","E","I","Beta")
+
+def Grid_Terms(Nmax,Constants,cache=False):
+    ''' Fixed matrices that make up the Hamiltonian at any grid point
+
+    At a point (B,E,I,Beta) the Hamiltonian is
+
+    H = H0 + B*Hz + E*HDC + I*(H_iso + sum_q Wigner_D(2,q,0,Beta,0)*H_q)
+
+    so that a whole grid can be built from the same nine matrices. H0, Hz and
+    HDC come from the on-disk cache in diatom.Cache when cache is True.
+
+    Args:
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+
+    kwargs:
+        cache (bool) - use the on-disk cache for H0, Hz and HDC (default = False)
+
+    Returns:
+        terms (numpy.ndarray) - (9,dim,dim) H0,Hz,HDC,H_iso and the q = -2..2 H_q
+    '''
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    H0,Hz,HDC,HAC = Calculate.Build_Hamiltonians(Nmax,Constants,True,True,
+                                                    False,cache=cache)
+    iso = Hamiltonian.AC_iso(Nmax,Constants['a0'],I1,I2)
+    aniso = Hamiltonian.AC_aniso_components(Nmax,Constants['a2'],I1,I2)
+
+    terms = [H0,Hz,HDC,iso/(2*eps0*c)]+[A/(2*eps0*c) for A in aniso]
+    return numpy.array(terms,dtype=numpy.complex128)
+
+def Grid_Coefficients(points):
+    ''' Coefficient of each of the Grid_Terms at each point
+
+    Args:
+        points (numpy.ndarray) - (n,4) array of (B,E,I,Beta)
+
+    Returns:
+        coeffs (numpy.ndarray) - (n,9) weights of the Grid_Terms
+    '''
+    points = numpy.atleast_2d(points)
+    B,E,I,Beta = points.T
+    coeffs = numpy.zeros((points.shape[0],9),dtype=numpy.complex128)
+    coeffs[:,0] = 1
+    coeffs[:,1] = B
+    coeffs[:,2] = E
+    coeffs[:,3] = I
+    coeffs[:,4:] = I[:,None]*Hamiltonian.Polarisation_Weights(Beta)
+    return coeffs
+
+def _open(fname,shape,dtype,resume):
+    ''' memory map an output array, creating it if needed '''
+    if resume and os.path.isfile(fname):
+        return numpy.lib.format.open_memmap(fname,mode="r+")
+    return numpy.lib.format.open_memmap(fname,mode="w+",dtype=dtype,
+                                                                shape=shape)
+
+def _write_progress(path,done):
+    ''' record the number of finished points, atomically '''
+    fname = os.path.join(path,"progress.json")
+    with open(fname+".tmp","w") as f:
+        json.dump({"done":int(done)},f)
+    os.replace(fname+".tmp",fname)
+
+def Grid_Scan(path,Nmax,Constants,B=0,E=0,I=0,Beta=0,return_states=False,
+                                        chunk=None,blocks=None,cache=False):
+    ''' Eigenstates over an N-dimensional grid of (B,E,I,Beta)
+
+    Each of B, E, I and Beta can be a single value or a 1D array of values,
+    the scan covers every combination of them. Results are written to the
+    directory path as energies.npy, with shape (nB,nE,nI,nBeta,dim), and
+    optionally states.npy with shape (nB,nE,nI,nBeta,dim,dim). The grid
+    itself is saved in grid.json.
+
+    If path already holds a scan of the same grid that was interrupted, the
+    scan carries on from the last chunk that was finished, whatever chunk is
+    this time. A finished scan is simply loaded.
+
+    Args:
+        path (str) - directory to write the results to
+        Nmax (int) - Maximum rotational level to include
+        Constants (Dictionary) - Dict of molecular constants
+
+    kwargs:
+        B,E,I,Beta (float or numpy.ndarray) - magnetic field (T), electric field (V/m), intensity (W/m^2) and polarisation angle (rad)
+        return_states (bool) - also save the eigenstates (default = False)
+        chunk (int) - number of grid points to solve at once
+        blocks (list of numpy.ndarray) - symmetry blocks from Calculate.MF_Blocks, only valid for Beta = 0 (mod pi)
+        cache (bool) - use the on-disk Hamiltonian cache (default = False)
+
+    Returns:
+        energies (numpy.memmap) - (nB,nE,nI,nBeta,dim) eigenenergies, lowest to highest at each point
+        states (numpy.memmap) - (nB,nE,nI,nBeta,dim,dim) eigenstates, only if return_states
+    '''
+    values = [numpy.atleast_1d(numpy.asarray(x,dtype=float))
+                                                    for x in (B,E,I,Beta)]
+    if blocks is not None and \
+                        numpy.any(numpy.abs(numpy.sin(values[3])) > 1e-12):
+        # the anisotropic light shift mixes MF unless the polarisation is
+        # along z
+        raise ValueError("MF is only conserved for Beta = 0 (mod pi), "
+                                                    "blocks can not be used")
+    grid_shape = tuple(len(v) for v in values)
+    npoints = int(numpy.prod(grid_shape))
+
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    dim = int((Nmax+1)**2*(2*I1+1)*(2*I2+1))
+
+    if chunk is None:
+        chunk = Calculate._default_chunk(dim)
+    chunk = int(chunk)
+
+    # only what decides the results, so that a scan can still be resumed
+    # after diatom is changed or with a different chunk
+    description = {"axes":{k:v.tolist() for k,v in zip(_axes,values)},
+                    "Nmax":int(Nmax),
+                    "constants":{k:repr(float(v))
+                                            for k,v in Constants.items()},
+                    "states":bool(return_states)}
+
+    os.makedirs(path,exist_ok=True)
+    gname = os.path.join(path,"grid.json")
+    done = 0
+    resume = False
+    if os.path.isfile(gname):
+        with open(gname,"r") as f:
+            previous = json.load(f)
+        if previous != description:
+            raise ValueError("{:s} holds a different scan, use a new "
+                                                "directory".format(path))
+        try:
+            with open(os.path.join(path,"progress.json"),"r") as f:
+                done = json.load(f)["done"]
+            resume = True
+        except (OSError,ValueError,KeyError):
+            done = 0
+    else:
+        with open(gname,"w") as f:
+            json.dump(description,f)
+
+    energies = _open(os.path.join(path,"energies.npy"),grid_shape+(dim,),
+                                                        numpy.float64,resume)
+    if return_states:
+        states = _open(os.path.join(path,"states.npy"),grid_shape+(dim,dim),
+                                                    numpy.complex128,resume)
+
+    if done < npoints:
+        terms = Grid_Terms(Nmax,Constants,cache)
+        flat_energies = energies.reshape(npoints,dim)
+        if return_states:
+            flat_states = states.reshape(npoints,dim,dim)
+
+        for start in range(done,npoints,chunk):
+            stop = min(start+chunk,npoints)
+            # the grid is C ordered, so Beta varies fastest
+            index = numpy.unravel_index(numpy.arange(start,stop),grid_shape)
+            points = numpy.column_stack([v[i] for v,i in zip(values,index)])
+            result = Calculate._Sweep_Core(terms,Grid_Coefficients(points),
+                                    return_states,stop-start,blocks)
+            if return_states:
+                flat_energies[start:stop],flat_states[start:stop] = result
+                flat_states.flush()
+            else:
+                flat_energies[start:stop] = result
+            flat_energies.flush()
+            _write_progress(path,stop)
+
+    if return_states:
+        return energies,states
+    return energies
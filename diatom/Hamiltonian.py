@@ -1,9 +1,12 @@
 import numpy
-from sympy.physics.wigner import wigner_3j,wigner_9j
 from scipy.linalg import block_diag,eig,eigvals
 import scipy.constants
-from scipy.special import sph_harm
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.special import sph_harm,gammaln
+from functools import lru_cache
 import warnings
+from diatom import Profiling
 
 '''
 This module contains the main code to calculate the hyperfine structure of
@@ -239,24 +242,58 @@ def Z_operator(J):
     J_minus = numpy.transpose(J_plus)
     return 0.5*(numpy.dot(J_plus,J_minus)-numpy.dot(J_minus,J_plus))
 
+@Profiling.profiled()
 def vector_dot(x,y):
     '''Cartesian dot product of two vectors of operators x,y
 
         A function that can do the dot product of a vector of matrices default
         behaviour of numpy.dot does the elementwise product of the matrices.
+        The operators can either be numpy arrays or scipy.sparse matrices.
 
         Args:
             x,y (numpy.ndarray): length-3 Vectors of Angular momentum operators, each element is a JxJ arrays
 
         Returns:
-            Z (numpy.ndarray): result of the dot product, JxJ array
+            Z (numpy.ndarray or scipy.sparse.csr_matrix): result of the dot product, JxJ array
     '''
-    X_Y = numpy.zeros(x[0].shape,dtype=numpy.complex)
+    if scipy.sparse.issparse(x[0]):
+        X_Y = scipy.sparse.csr_matrix(x[0].shape,dtype=numpy.complex128)
+        for i in range(x.shape[0]):
+            X_Y = X_Y + x[i].dot(y[i])
+        return X_Y.tocsr()
+
+    X_Y = numpy.zeros(x[0].shape,dtype=numpy.complex128)
     for i in range(x.shape[0]):
         X_Y += numpy.dot(x[i],y[i])
     return X_Y
 
-def Generate_vecs(Nmax,I1,I2):
+def _identity(n,sparse=False):
+    ''' n x n identity matrix, as a CSR matrix if sparse'''
+    if sparse:
+        return scipy.sparse.identity(n,format='csr')
+    return numpy.identity(n)
+
+@Profiling.profiled()
+def _expand(A,B,C,sparse=False):
+    ''' Kronecker product A x B x C, as a CSR matrix if sparse.
+
+    Used to take an operator on the rotational (A) and nuclear spin (B,C)
+    subspaces into the full uncoupled basis.
+    '''
+    if sparse:
+        return scipy.sparse.kron(scipy.sparse.csr_matrix(A),
+                    scipy.sparse.kron(B,C,format='csr'),format='csr')
+    return numpy.kron(A,numpy.kron(B,C))
+
+def _operator_vector(ops):
+    ''' pack a length-3 list of sparse matrices into a numpy object array'''
+    vec = numpy.empty(len(ops),dtype=object)
+    for i,op in enumerate(ops):
+        vec[i] = op
+    return vec
+
+@Profiling.profiled()
+def Generate_vecs(Nmax,I1,I2,sparse=False):
     ''' Build N, I1, I2 angular momentum vectors
 
         Generate the vectors of the angular momentum operators which we need
@@ -265,6 +302,8 @@ def Generate_vecs(Nmax,I1,I2):
         Args:
             Nmax (float): maximum rotational level to include in calculations
             I1,I2 (float): Nuclear spins of nuclei 1 and 2
+        kwargs:
+            sparse (bool): return each operator as a scipy.sparse.csr_matrix (default = False)
         Returns:
             N_vec,I1_vec,I2_vec (list of numpy.ndarray): length-3 list of (2Nmax+1)*(2I1+1)*(2I2+1) square numpy arrays
     '''
@@ -273,6 +312,22 @@ def Generate_vecs(Nmax,I1,I2):
     shape1 = int(2*I1+1)
     shape2 = int(2*I2+1)
 
+    if sparse:
+        # same construction as below, but never forms a dense matrix in the
+        # full basis. The vectors are object arrays of csr_matrix.
+        IdN = _identity(shapeN,True)
+        Id1 = _identity(shape1,True)
+        Id2 = _identity(shape2,True)
+
+        N_vec = _operator_vector([_expand(scipy.sparse.block_diag(
+                            [op(n) for n in range(0,Nmax+1)]),Id1,Id2,True)
+                            for op in (X_operator,Y_operator,Z_operator)])
+        I1_vec = _operator_vector([_expand(IdN,op(I1),Id2,True)
+                            for op in (X_operator,Y_operator,Z_operator)])
+        I2_vec = _operator_vector([_expand(IdN,Id1,op(I2),True)
+                            for op in (X_operator,Y_operator,Z_operator)])
+        return N_vec,I1_vec,I2_vec
+
     Nx = numpy.array([[]])
     Ny=numpy.array([[]])
     Nz= numpy.array([[]])
@@ -317,6 +372,51 @@ def Generate_vecs(Nmax,I1,I2):
 
     return N_vec,I1_vec,I2_vec
 
+@lru_cache(maxsize=16)
+@Profiling.profiled()
+def Angular_Momentum(Nmax,I1,I2):
+    ''' Cached library of angular momentum operators in the uncoupled basis
+
+        Builds the vectors N, I1 and I2 once for each (Nmax,I1,I2), together
+        with the total nuclear spin I = I1+I2, the total angular momentum
+        F = N+I1+I2, their squares and their z-projections. Everything is a
+        scipy.sparse.csr_matrix shared between all callers, so must not be
+        modified.
+
+        N^2, N_z, I1_z, I2_z, I_z and F_z are all diagonal in the uncoupled
+        basis, the diagonals are also given as arrays under 'diagonal' so
+        that expectation values of these need no matrix products at all.
+
+        Args:
+            Nmax (int) - maximum rotational level to include
+            I1,I2 (float) - Nuclear spins of nuclei 1 and 2
+
+        Returns:
+            ops (dict) - operators, with keys
+                'N','I1','I2','I','F' - length-3 operator vectors
+                'N2','I1_2','I2_2','I_2','F2' - squares of the vectors
+                'Nz','I1z','I2z','Iz','Fz' - z-projections
+                'diagonal' - dict of the diagonals of 'N2','I1_2','I2_2','Nz','I1z','I2z','Iz','Fz'
+    '''
+    N,S1,S2 = Generate_vecs(Nmax,I1,I2,sparse=True)
+    I = S1+S2
+    F = N+I
+
+    ops = {'N':N,'I1':S1,'I2':S2,'I':I,'F':F}
+    for key,name in (('N','N2'),('I1','I1_2'),('I2','I2_2'),('I','I_2'),
+                                                                ('F','F2')):
+        ops[name] = vector_dot(ops[key],ops[key])
+    for key in ('N','I1','I2','I','F'):
+        ops[key+'z'] = ops[key][2]
+
+    diagonal = {}
+    for name in ('N2','I1_2','I2_2','Nz','I1z','I2z','Iz','Fz'):
+        d = numpy.ascontiguousarray(ops[name].diagonal().real)
+        d.flags.writeable = False
+        diagonal[name] = d
+    ops['diagonal'] = diagonal
+    return ops
+
 def Wigner_D(l,m,alpha,beta,gamma):
     ''' The Wigner D matrix with labels l and m.
 
@@ -338,7 +438,187 @@ def Wigner_D(l,m,alpha,beta,gamma):
     function = numpy.conj(sph_harm(m,l,alpha,beta))
     return prefactor*function
 
-def T2_C(Nmax,I1,I2):
+# The angular momentum coupling coefficients are evaluated numerically from the
+# Racah formulae. Everything is done with log-factorials so that there is no
+# overflow for large N, and whole arrays of projections are done at once rather
+# than one sympy call per matrix element.
+
+def _log_factorial(n):
+    ''' natural log of n! for (arrays of) non-negative integers n'''
+    return gammaln(numpy.asarray(n,dtype=float)+1)
+
+def _log_triangle(a,b,c):
+    ''' log of the triangle coefficient (a+b-c)!(a-b+c)!(-a+b+c)!/(a+b+c+1)!'''
+    return _log_factorial(a+b-c)+_log_factorial(a-b+c)+\
+            _log_factorial(-a+b+c)-_log_factorial(a+b+c+1)
+
+def _triangle(a,b,c):
+    ''' True if a,b,c satisfy the triangle rule and sum to an integer'''
+    return abs(a-b)<=c<=a+b and numpy.isclose((a+b+c)%1,0)
+
+def Wigner_3j(j1,j2,j3,m1,m2,m3):
+    ''' Vectorised Wigner 3j symbol (j1 j2 j3; m1 m2 m3)
+
+    Evaluates the Racah formula for the 3j symbol. The projections m1,m2,m3 can
+    be numpy arrays of any (broadcastable) shape so that a whole block of
+    coefficients is calculated in one call. Any combination that breaks the
+    selection rules is returned as zero.
+
+    Args:
+        j1,j2,j3 (float) - angular momenta, integer or half-integer
+        m1,m2,m3 (float or numpy.ndarray) - projections of j1,j2,j3
+
+    Returns:
+        W (numpy.ndarray) - 3j symbols, with the broadcast shape of m1,m2,m3
+    '''
+    m1,m2,m3 = numpy.broadcast_arrays(*[numpy.asarray(m,dtype=float)
+                                            for m in (m1,m2,m3)])
+    W = numpy.zeros(m1.shape)
+    if not _triangle(j1,j2,j3):
+        return W
+
+    # work with integer multiples of 1/2 to make the selection rules exact
+    J = [int(numpy.rint(2*j)) for j in (j1,j2,j3)]
+    M = [numpy.rint(2*m).astype(int) for m in (m1,m2,m3)]
+
+    allowed = (M[0]+M[1]+M[2]) == 0
+    for Jx,Mx in zip(J,M):
+        allowed &= (numpy.abs(Mx)<=Jx) & ((Jx+Mx)%2 == 0)
+    if not numpy.any(allowed):
+        return W
+
+    j1,j2,j3 = [x/2 for x in J]
+    m1,m2,m3 = [Mx[allowed]/2 for Mx in M]
+
+    log_prefactor = _log_triangle(j1,j2,j3)+\
+                    _log_factorial(j1+m1)+_log_factorial(j1-m1)+\
+                    _log_factorial(j2+m2)+_log_factorial(j2-m2)+\
+                    _log_factorial(j3+m3)+_log_factorial(j3-m3)
+
+    tmin = numpy.maximum(0,numpy.maximum(j2-j3-m1,j1-j3+m2))
+    tmax = numpy.minimum(j1+j2-j3,numpy.minimum(j1-m1,j2+m2))
+
+    total = numpy.zeros(m1.shape)
+    for t in range(int(numpy.amin(tmin)),int(numpy.amax(tmax))+1):
+        valid = (t>=tmin) & (t<=tmax)
+        # clip everything to keep the log-factorials finite where not valid
+        args = [numpy.where(valid,x,0) for x in (j3-j2+t+m1,j3-j1+t-m2,
+                                    j1+j2-j3-t,j1-t-m1,j2-t+m2)]
+        log_denominator = _log_factorial(t)+sum(_log_factorial(x) for x in args)
+        total += numpy.where(valid,((-1)**t)*numpy.exp(0.5*log_prefactor-
+                                                    log_denominator),0)
+
+    phase = (-1.)**numpy.rint(j1-j2-m3)
+    W[allowed] = phase*total
+    return W
+
+@lru_cache(maxsize=None)
+def Wigner_3j_block(j1,j2,j3):
+    ''' Table of all the 3j symbols for fixed j1,j2,j3
+
+    Returns every 3j symbol (j1 j2 j3; m1 m2 m3) in a single array. Along each
+    axis the projection runs from +j to -j, the same order as the basis states
+    used throughout this module, so the index of m is j-m. The table is
+    memoized so it is only ever calculated once per (j1,j2,j3) and is shared
+    between every matrix element builder and every value of Nmax.
+
+    Args:
+        j1,j2,j3 (float) - angular momenta, integer or half-integer
+
+    Returns:
+        W (numpy.ndarray) - read-only array of shape (2j1+1,2j2+1,2j3+1)
+    '''
+    m1 = numpy.arange(j1,-(j1+1),-1)
+    m2 = numpy.arange(j2,-(j2+1),-1)
+    m3 = numpy.arange(j3,-(j3+1),-1)
+    W = Wigner_3j(j1,j2,j3,m1[:,None,None],m2[None,:,None],m3[None,None,:])
+    W.setflags(write=False)
+    return W
+
+@lru_cache(maxsize=None)
+def Wigner_6j(j1,j2,j3,j4,j5,j6):
+    ''' Wigner 6j symbol {j1 j2 j3; j4 j5 j6}
+
+    Args:
+        j1,j2,j3,j4,j5,j6 (float) - angular momenta, integer or half-integer
+
+    Returns:
+        W (float) - value of the 6j symbol
+    '''
+    triads = [(j1,j2,j3),(j1,j5,j6),(j4,j2,j6),(j4,j5,j3)]
+    if not all(_triangle(*x) for x in triads):
+        return 0.
+
+    a = [int(numpy.rint(sum(x))) for x in triads]
+    b = [int(numpy.rint(x)) for x in (j1+j2+j4+j5,j2+j3+j5+j6,j3+j1+j6+j4)]
+
+    log_prefactor = 0.5*sum(_log_triangle(*x) for x in triads)
+
+    total = 0.
+    for t in range(max(a),min(b)+1):
+        log_term = _log_factorial(t+1)-sum(_log_factorial(t-x) for x in a)-\
+                    sum(_log_factorial(x-t) for x in b)
+        total += ((-1)**t)*numpy.exp(log_prefactor+log_term)
+    return float(total)
+
+@lru_cache(maxsize=None)
+def Wigner_9j(j1,j2,j3,j4,j5,j6,j7,j8,j9):
+    ''' Wigner 9j symbol {j1 j2 j3; j4 j5 j6; j7 j8 j9}
+
+    Calculated as a sum over products of three 6j symbols.
+
+    Args:
+        j1 ... j9 (float) - angular momenta, row-by-row, integer or half-integer
+
+    Returns:
+        W (float) - value of the 9j symbol
+    '''
+    xmin = max(abs(j1-j9),abs(j4-j8),abs(j2-j6))
+    xmax = min(j1+j9,j4+j8,j2+j6)
+
+    total = 0.
+    for x in numpy.arange(xmin,xmax+0.5,1):
+        total += ((-1)**int(numpy.rint(2*x)))*(2*x+1)*\
+                Wigner_6j(j1,j4,j7,j8,j9,x)*Wigner_6j(j2,j5,j8,j4,x,j6)*\
+                Wigner_6j(j3,j6,j9,x,j1,j2)
+    return float(total)
+
+@Profiling.profiled()
+def Rotational_Tensor(Nmax,k,q):
+    ''' Matrix of the spherical harmonic tensor C^k_q in the N,MN basis
+
+    Calculates <N,MN|C^k_q|N',MN'> for all of the rotational states up to Nmax
+    using the memoized 3j tables. Only the (N,N') blocks that are allowed by
+    the triangle and parity selection rules are filled in. The matrix does not
+    include the nuclear spins.
+
+    Args:
+        Nmax (int) - Maximum rotational state to include
+        k (int) - rank of the tensor
+        q (int) - component of the tensor
+
+    Returns:
+        C (numpy.ndarray) - square array with sum([2*x+1 for x in range(Nmax+1)]) rows
+    '''
+    shape = sum([2*x+1 for x in range(0,Nmax+1)])
+    C = numpy.zeros((shape,shape))
+    start = numpy.cumsum([0]+[2*x+1 for x in range(0,Nmax+1)])
+
+    for N in range(0,Nmax+1):
+        MN = numpy.arange(N,-(N+1),-1)
+        for Np in range(abs(N-k),min(N+k,Nmax)+1):
+            if (N+k+Np)%2 !=0:
+                #(N k N';0 0 0) vanishes
+                continue
+            W = Wigner_3j_block(N,k,Np)
+            reduced = numpy.sqrt((2*N+1)*(2*Np+1))*W[N,k,Np]
+            # rows need -MN, which is index N+MN in the table
+            C[start[N]:start[N+1],start[Np]:start[Np+1]] = \
+                            ((-1.)**MN)[:,None]*reduced*W[::-1,k-q,:]
+    return C
+
+@Profiling.profiled()
+def T2_C(Nmax,I1,I2,sparse=False):
     '''
     The irreducible spherical tensors for the spherical harmonics in the
     rotational basis.
@@ -347,52 +627,36 @@ def T2_C(Nmax,I1,I2):
         Nmax (int) : Maximum rotational state to include
         I1,I2 (float) :  The nuclear spins of nucleus 1 and 2
 
+    kwargs:
+        sparse (bool) : return scipy.sparse.csr_matrix operators (default = False)
+
     Returns:
         T (list of numpy.ndarray) : spherical tensor T^2(C). Each element is a spherical operator
 
     '''
-    shape = sum([2*x+1 for x in range(0,Nmax+1)])
-    shape = (shape,shape)
-    Identity1 = numpy.identity(int(2*I1+1))
-    Identity2 = numpy.identity(int(2*I2+1))
-
-    Identity = numpy.kron(Identity1,Identity2)
-
-    T = [numpy.zeros(shape),numpy.zeros(shape),
-        numpy.zeros(shape),
-        numpy.zeros(shape),numpy.zeros(shape)]
-
-    x=-1
-    for N in range(0,Nmax+1):
-        for MN in range(N,-(N+1),-1):
-            x+=1
-            y=-1
-            for Np in range(0,Nmax+1):
-                for MNp in range(Np,-(Np+1),-1):
-                    y+=1
-                    for i,q in enumerate(range(-2,2+1)):
-                        T[i][x,y]=((-1)**MN)*numpy.sqrt((2*N+1)*(2*Np+1))*\
-                            wigner_3j(N,2,Np,0,0,0)*wigner_3j(N,2,Np,-MN,q,MNp)
+    Identity1 = _identity(int(2*I1+1),sparse)
+    Identity2 = _identity(int(2*I2+1),sparse)
 
-    for i,q in enumerate(range(-2,2+1)):
-        T[i] = numpy.kron(T[i],Identity)
+    T = [_expand(Rotational_Tensor(Nmax,2,q),Identity1,Identity2,sparse)
+                                            for q in range(-2,2+1)]
     return T
 
+@Profiling.profiled()
 def MakeT2(I1,I2):
     ''' Construct the spherical tensor T2 from two cartesian vectors of operators.
 
     Args:
-        I1,I2 (list of numpy.ndarray) - Length-3 list of cartesian angular momentum operators: the output of makevecs
+        I1,I2 (list of numpy.ndarray) - Length-3 list of cartesian angular momentum operators: the output of makevecs, dense or sparse
     Returns:
         T (list of numpy.ndarray) - T^2(I1,I2) length-5 list of spherical angular momentum operators
     '''
-    T2m2 = 0.5*(numpy.dot(I1[0],I2[0])-1.0j*numpy.dot(I1[0],I2[1])-1.0j*numpy.dot(I1[1],I2[0])-numpy.dot(I1[1],I2[1]))
-    T2p2 = 0.5*(numpy.dot(I1[0],I2[0])+1.0j*numpy.dot(I1[0],I2[1])+1.0j*numpy.dot(I1[1],I2[0])-numpy.dot(I1[1],I2[1]))
+    T2m2 = 0.5*(I1[0].dot(I2[0])-1.0j*I1[0].dot(I2[1])-1.0j*I1[1].dot(I2[0])-I1[1].dot(I2[1]))
+    T2p2 = 0.5*(I1[0].dot(I2[0])+1.0j*I1[0].dot(I2[1])+1.0j*I1[1].dot(I2[0])-I1[1].dot(I2[1]))
 
-    T2m1 = 0.5*(numpy.dot(I1[0],I2[2])-1.0j*numpy.dot(I1[1],I2[2])+numpy.dot(I1[2],I2[0])-1.0j*numpy.dot(I1[2],I2[1]))
-    T2p1 = -0.5*(numpy.dot(I1[0],I2[2])+1.0j*numpy.dot(I1[1],I2[2])+numpy.dot(I1[2],I2[0])+1.0j*numpy.dot(I1[2],I2[1]))
+    T2m1 = 0.5*(I1[0].dot(I2[2])-1.0j*I1[1].dot(I2[2])+I1[2].dot(I2[0])-1.0j*I1[2].dot(I2[1]))
+    T2p1 = -0.5*(I1[0].dot(I2[2])+1.0j*I1[1].dot(I2[2])+I1[2].dot(I2[0])+1.0j*I1[2].dot(I2[1]))
 
-    T20 = -numpy.sqrt(1/6)*(numpy.dot(I1[0],I2[0])+numpy.dot(I1[1],I2[1]))+numpy.sqrt(2/3)*numpy.dot(I1[2],I2[2])
+    T20 = -numpy.sqrt(1/6)*(I1[0].dot(I2[0])+I1[1].dot(I2[1]))+numpy.sqrt(2/3)*I1[2].dot(I2[2])
 
     T = [T2m2,T2m1,T20,T2p1,T2p2]
 
@@ -411,6 +675,12 @@ def TensorDot(T1,T2):
     Returns:
         X (numpy.ndarray) - scalar product of spherical tensors
     '''
+    if scipy.sparse.issparse(T1[0]):
+        x = scipy.sparse.csr_matrix(T1[0].shape,dtype=numpy.complex128)
+        for i,q in enumerate(range(-2,2+1)):
+            x = x + ((-1)**q)*T1[i].dot(T2[-(i+1)])
+        return x.tocsr()
+
     x = numpy.zeros(T1[0].shape,dtype=numpy.complex128)
     for i,q in enumerate(range(-2,2+1)):
         x += ((-1)**q)*numpy.dot(T1[i],T2[-(i+1)])
@@ -422,7 +692,7 @@ def TensorDot(T1,T2):
 # what is doing what.
 
 
-def ElectricGradient(Nmax,I1,I2):
+def ElectricGradient(Nmax,I1,I2,sparse=False):
     '''Calculate electric field gradient at the nucleus.
 
     spherical tensor for the electric field gradient at nucleus i. Depends
@@ -432,39 +702,43 @@ def ElectricGradient(Nmax,I1,I2):
     Args:
         Nmax (int) - Maximum rotational state to include
         I1,I2 (float)- The nuclear spins of nucleus 1 and 2
+    kwargs:
+        sparse (bool) - return scipy.sparse.csr_matrix operators (default = False)
     Returns:
         T (list of numpy.ndarray) - length-5 list of numpy.ndarrays
     '''
-    shape = sum([2*x+1 for x in range(0,Nmax+1)])
-    shape = (shape,shape)
-    Identity1 = numpy.identity(int(2*I1+1))
+    Identity1 = _identity(int(2*I1+1),sparse)
 
-    Identity2 = numpy.identity(int(2*I2+1))
+    Identity2 = _identity(int(2*I2+1),sparse)
 
-    Identity = numpy.kron(Identity1,Identity2)
+    # (-1)**(N-MN)*(-1)**N is the same phase as (-1)**MN for integer N, so the
+    # electric field gradient is proportional to C^2(theta,phi)
+    T = [_expand(Rotational_Tensor(Nmax,2,q),Identity1,Identity2,sparse)
+                                            for q in range(-2,2+1)]
+    return T
 
-    T = [numpy.zeros(shape),numpy.zeros(shape),
-        numpy.zeros(shape),
-        numpy.zeros(shape),numpy.zeros(shape)]
+def Spin_Quadrupole_Tensor(I,q):
+    ''' Component q of the rank-2 quadrupole tensor for a single nuclear spin
 
-    x=-1
-    for N in range(0,Nmax+1):
-        for MN in range(N,-(N+1),-1):
-            x+=1
-            y=-1
-            for Np in range(0,Nmax+1):
-                for MNp in range(Np,-(Np+1),-1):
-                    y+=1
-                    for i,q in enumerate(range(-2,2+1)):
-                        T[i][x,y]=(-1)**(N-MN)*wigner_3j(N,2,Np,-MN,q,MNp)*\
-                        (-1)**N*numpy.sqrt((2*N+1)*(2*Np+1))*\
-                        wigner_3j(N,2,Np,0,0,0)
+    Calculates the matrix (-1)^(I-M) (I 2 I;-M q M')/(I 2 I;-I 0 I) in the I,MI
+    basis from the memoized 3j table. This is normalised so that the
+    quadrupole coupling constant multiplies it directly.
 
-    for i,q in enumerate(range(-2,2+1)):
-        T[i] = numpy.kron(T[i],Identity)
-    return T
+    Args:
+        I (float) - nuclear spin
+        q (int) - component of the tensor
 
-def QuadMoment(Nmax,I1,I2):
+    Returns:
+        T (numpy.ndarray) - (2I+1) square array
+    '''
+    W = Wigner_3j_block(I,2,I)
+    MI = numpy.arange(I,-(I+1),-1)
+    phase = (-1.)**numpy.rint(I-MI)
+    # rows need -MI, which is index I+MI in the table, the normalisation
+    # needs (I 2 I;-I 0 I)
+    return phase[:,None]*W[::-1,2-q,:]/W[-1,2,0]
+
+def QuadMoment(Nmax,I1,I2,sparse=False):
     ''' Calculate the nuclear electric quadrupole moments of nuclei 1 and 2.
 
     spherical tensor for the nuclear quadrupole moment of both nuclei. Depends
@@ -472,55 +746,25 @@ def QuadMoment(Nmax,I1,I2):
     Args:
         Nmax (int) - Maximum rotational state to include
         I1,I2 (float) - The nuclear spins of nucleus 1 and 2
+    kwargs:
+        sparse (bool) - return scipy.sparse.csr_matrix operators (default = False)
     Returns:
         T (list of numpy.ndarray) - length-5 list of numpy.ndarrays
 
     '''
-    shape1 = int(2*I1+1)
-    shape1 = (shape1,shape1)
-
-    T1 = [numpy.zeros(shape1),numpy.zeros(shape1),
-        numpy.zeros(shape1),
-        numpy.zeros(shape1),numpy.zeros(shape1)]
-
-    shape2 = int(2*I2+1)
-    shape2 = (shape2,shape2)
-
-    T2 = [numpy.zeros(shape2),numpy.zeros(shape2),
-        numpy.zeros(shape2),
-        numpy.zeros(shape2),numpy.zeros(shape2)]
-
     ShapeN = int(sum([2*x+1 for x in range(0,Nmax+1)]))
 
-    IdentityN = numpy.identity(ShapeN)
-    Identity1 = numpy.identity(int(2*I1+1))
-    Identity2 = numpy.identity(int(2*I2+1))
-
-    x=-1
-    for M1 in numpy.arange(I1,-(I1+1),-1):
-        x+=1
-        y=-1
-        for M1p in numpy.arange(I1,-(I1+1),-1):
-            y+=1
-            for i,q in enumerate(range(-2,2+1)):
-                T1[i][x,y]=(-1)**(I1-M1)*wigner_3j(I1,2,I1,-M1,q,M1p)/\
-                wigner_3j(I1,2,I1,-I1,0,I1)
-    x=-1
-    for M2 in numpy.arange(I2,-(I2+1),-1):
-        x+=1
-        y=-1
-        for M2p in numpy.arange(I2,-(I2+1),-1):
-            y+=1
-            for i,q in enumerate(range(-2,2+1)):
-                T2[i][x,y]=(-1)**(I2-M2)*wigner_3j(I2,2,I2,-M2,q,M2p)/\
-                wigner_3j(I2,2,I2,-I2,0,I2)
+    IdentityN = _identity(ShapeN,sparse)
+    Identity1 = _identity(int(2*I1+1),sparse)
+    Identity2 = _identity(int(2*I2+1),sparse)
 
-    for i,q in enumerate(range(-2,2+1)):
-        T1[i] = numpy.kron(IdentityN,numpy.kron(T1[i],Identity2))
-        T2[i] = numpy.kron(IdentityN,numpy.kron(Identity1,T2[i]))
+    T1 = [_expand(IdentityN,Spin_Quadrupole_Tensor(I1,q),Identity2,sparse)
+                                            for q in range(-2,2+1)]
+    T2 = [_expand(IdentityN,Identity1,Spin_Quadrupole_Tensor(I2,q),sparse)
+                                            for q in range(-2,2+1)]
     return T1,T2
 
-def Quadrupole(Q,I1,I2,Nmax):
+def Quadrupole(Q,I1,I2,Nmax,sparse=False):
     ''' Calculate Hquad, the nuclear electric quadrupole interaction energy
 
     Calculates the Quadrupole terms for the hyperfine Hamiltonian using
@@ -532,13 +776,16 @@ def Quadrupole(Q,I1,I2,Nmax):
         Nmax (int) - Maximum rotational state to include
         I1,I2  (float) - The nuclear spins of nucleus 1 and 2
 
+    kwargs:
+        sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
+
     Returns:
         Hquad (numpy.ndarray) - numpy array with shape (2I1+1)*(2I2+1)*sum([(2*x+1) for x in range(Nmax+1)])
     '''
     Q1,Q2 = Q
 
-    TdE = ElectricGradient(Nmax,I1,I2)
-    Tq1,Tq2 = QuadMoment(Nmax,I1,I2)
+    TdE = ElectricGradient(Nmax,I1,I2,sparse)
+    Tq1,Tq2 = QuadMoment(Nmax,I1,I2,sparse)
 
     Hq = Q1*TensorDot(Tq1,TdE)+Q2*TensorDot(Tq2,TdE)
 
@@ -562,6 +809,8 @@ def Rotational(N,Brot,Drot):
             Hrot (numpy.ndarray) - hamiltonian for rotation in the N,MN basis
     '''
     N_squared = vector_dot(N,N)
+    if scipy.sparse.issparse(N_squared):
+        return Brot*N_squared-Drot*N_squared.multiply(N_squared)
     return Brot*N_squared-Drot*N_squared*N_squared
 
 def Zeeman(Cz,J):
@@ -602,34 +851,36 @@ def tensor_nuclear(C3,I1,I2,Nmax):
 
         Args:
             C3 (float) - spin-spin coupling constant
-            I1,I2 (float) - Cartesian Angular momentum operator Vectors
+            I1,I2 (float) - Cartesian Angular momentum operator Vectors, dense or sparse
             Nmax (int) - maximum rotational state to include
 
         Returns:
             Hss (numpy.ndarray) - Hamiltonian for tensor spin-spin interaction
     '''
     #find the value of I1 and I2 with less input arguments
-    I1_val = numpy.round(numpy.amax(I1[2]),1).real
-    I2_val = numpy.round(numpy.amax(I2[2]),1).real
+    I1_val = numpy.round(numpy.amax(I1[2].diagonal()),1).real
+    I2_val = numpy.round(numpy.amax(I2[2].diagonal()),1).real
 
     #steps for maths, creates the spherical tensors
-    T1 = T2_C(Nmax,I1_val,I2_val)
+    T1 = T2_C(Nmax,I1_val,I2_val,scipy.sparse.issparse(I1[0]))
     T2 = MakeT2(I1,I2)
     #return final Hamiltonian
     tensorss = numpy.sqrt(6)*C3*TensorDot(T1,T2)
 
     return tensorss
 
-def DC(Nmax,d0,I1,I2):
+@Profiling.profiled()
+def DC(Nmax,d0,I1,I2,sparse=False):
     ''' calculate HDC for a diatomic molecule
 
         Generates the effect of the dc Stark shift for a rigid-rotor like
         molecule.
 
         This term is calculated differently to all of the others in this work
-        and is based off Jesus Aldegunde's FORTRAN 77 code. It iterates over
-        N,MN,N',MN' to build a matrix without hyperfine structure then uses
-        kronecker products to expand it into all of the hyperfine states.
+        and is based off Jesus Aldegunde's FORTRAN 77 code. It builds the
+        matrix in N,MN without hyperfine structure (the q=0 component of C^1)
+        then uses kronecker products to expand it into all of the hyperfine
+        states.
 
 
         Args:
@@ -637,47 +888,75 @@ def DC(Nmax,d0,I1,I2):
             d0 (float) - Permanent electric dipole momentum
             I1,I2 (float) - Nuclear spin of nucleus 1,2
 
+        kwargs:
+            sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
 
         Returns:
             H (numpy.ndarray) - DC Stark Hamiltonian in joules
      '''
 
-    shape = numpy.sum(numpy.array([2*x+1 for x in range(0,Nmax+1)]))
-    HDC = numpy.zeros((shape,shape),dtype= numpy.complex)
+    I1shape = int(2*I1+1)
+    I2shape = int(2*I2+1)
+
+    HDC = -d0*Rotational_Tensor(Nmax,1,0).astype(numpy.complex128)
+
+    return _expand(HDC,_identity(I1shape,sparse),_identity(I2shape,sparse),
+                                                                    sparse)
 
+@lru_cache(maxsize=16)
+@Profiling.profiled()
+def _dipole_vector(Nmax,I1,I2):
+    ''' x,y,z components of C^1 in the full basis, cached '''
     I1shape = int(2*I1+1)
     I2shape = int(2*I2+1)
+    C = {q:Rotational_Tensor(Nmax,1,q).astype(numpy.complex128)
+                                                        for q in range(-1,2)}
+    cartesian = ((C[-1]-C[1])/numpy.sqrt(2),1j*(C[-1]+C[1])/numpy.sqrt(2),
+                                                                        C[0])
+    return tuple(_expand(X,_identity(I1shape,True),_identity(I2shape,True),
+                                                True) for X in cartesian)
 
-    i =0
-    j =0
-    for N1 in range(0,Nmax+1):
-        for M1 in range(N1,-(N1+1),-1):
-            for N2 in range(0,Nmax+1):
-                for M2 in range(N2,-(N2+1),-1):
-                    HDC[i,j]=-d0*numpy.sqrt((2*N1+1)*(2*N2+1))*(-1)**(M1)*\
-                    wigner_3j(N1,1,N2,-M1,0,M2)*wigner_3j(N1,1,N2,0,0,0)
-                    j+=1
-            j=0
-            i+=1
-    return (numpy.kron(HDC,numpy.kron(numpy.identity(I1shape),
-            numpy.identity(I2shape))))
-
-def AC_iso(Nmax,a0,I1,I2):
+def DC_Components(Nmax,d0,I1,I2,sparse=False):
+    ''' x, y and z components of the dc Stark Hamiltonian
+
+        H = -d.E, so for an electric field vector (Ex,Ey,Ez) the Hamiltonian
+        is Ex*Hx+Ey*Hy+Ez*Hz. The z component is the same as DC. The
+        components are built once for each (Nmax,I1,I2).
+
+        Args:
+            Nmax(int) -  maximum rotational quantum number to calculate
+            d0 (float) - Permanent electric dipole momentum
+            I1,I2 (float) - Nuclear spin of nucleus 1,2
+
+        kwargs:
+            sparse (bool) - return scipy.sparse.csr_matrix components (default = False)
+
+        Returns:
+            H (list of numpy.ndarray) - Hx,Hy,Hz in joules per V/m
+    '''
+    components = [-d0*X for X in _dipole_vector(Nmax,I1,I2)]
+    return [X.tocsr() if sparse else X.toarray() for X in components]
+
+@Profiling.profiled()
+def AC_iso(Nmax,a0,I1,I2,sparse=False):
     ''' Calculate isotropic Stark shifts
 
         Generates the effect of the isotropic AC Stark shift for a rigid-rotor
         like molecule.
 
         This term is calculated differently to all of the others in this work
-        and is based off Jesus Aldegunde's FORTRAN 77 code. It iterates over
-        N,MN,N',MN' to build a matrix without hyperfine structure then uses
-        kronecker products to expand it into all of the hyperfine states.
+        and is based off Jesus Aldegunde's FORTRAN 77 code. The isotropic
+        shift is diagonal in N,MN so the matrix without hyperfine structure is
+        just -a0 times the identity, kronecker products then expand it into all
+        of the hyperfine states.
 
         Args:
             Nmax (int) - maximum rotational quantum number to calculate (int)
             a0 (float) - isotropic polarisability in joules/ W/m^2
             I1,I2 (float) - Nuclear spin of nucleus 1,2
 
+        kwargs:
+            sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
 
         Returns:
             H (numpy.ndarray) - isotropic AC Stark Hamiltonian
@@ -686,36 +965,62 @@ def AC_iso(Nmax,a0,I1,I2):
     shape = numpy.sum(numpy.array([2*x+1 for x in range(0,Nmax+1)]))
     I1shape = int(2*I1+1)
     I2shape = int(2*I2+1)
-    HAC = numpy.zeros((shape,shape),dtype= numpy.complex)
-    i=0
-    j=0
-    for N1 in range(0,Nmax+1):
-        for M1 in range(N1,-(N1+1),-1):
-            for N2 in range(0,Nmax+1):
-                for M2 in range(N2,-(N2+1),-1):
-                    if N1==N2 and M1 ==M2:
-                        HAC[i,j]=-a0
-                    j+=1
-            j=0
-            i+=1
-    #final check for NaN errors, mostly this is due to division by zero or
-    # multiplication by a small prefactor. it is safe to set these terms to 0
-    HAC[numpy.isnan(HAC)] =0
+    HAC = -a0*numpy.identity(shape,dtype= numpy.complex128)
 
     #return the matrix, in the full uncoupled basis.
-    return (numpy.kron(HAC,numpy.kron(numpy.identity(I1shape),
-                                                    numpy.identity(I2shape))))
+    return _expand(HAC,_identity(I1shape,sparse),_identity(I2shape,sparse),
+                                                                    sparse)
+
+def Polarisation_Weights(Beta=0,polarisation=None):
+    ''' Weights of the five components of the anisotropic ac Stark shift
 
-def AC_aniso(Nmax,a2,Beta,I1,I2):
+        The anisotropic ac Stark shift for any polarisation is a weighted sum
+        of the q = -2..2 components from AC_aniso_components. For linear
+        polarisation at an angle Beta to the z axis the weights are
+        Wigner_D(2,q,0,Beta,0).
+
+        Any other polarisation can be given as a (complex) Cartesian vector.
+        Only the rank-2 part of the real symmetric tensor Re(e* e) enters, so
+        the weights depend on the ellipticity but not on the handedness.
+
+        Both Beta and polarisation can be given for many polarisations at
+        once, as an array of angles or an (n,3) array of vectors.
+
+        kwargs:
+            Beta (float or numpy.ndarray) - polarisation angle(s) in radians
+            polarisation (numpy.ndarray) - (3,) or (n,3) polarisation vector(s) (x,y,z), used instead of Beta if given
+
+        Returns:
+            weights (numpy.ndarray) - (5,) or (n,5) complex weights for q = -2..2
+    '''
+    if polarisation is None:
+        Beta = numpy.asarray(Beta,dtype=float)
+        return numpy.stack([Wigner_D(2,q,0,Beta,0) for q in range(-2,2+1)],
+                                                axis=-1).astype(numpy.complex128)
+
+    e = numpy.asarray(polarisation,dtype=numpy.complex128)
+    e = e/numpy.linalg.norm(e,axis=-1,keepdims=True)
+    # symmetric traceless part of e* e
+    S = numpy.real(numpy.conj(e)[...,:,None]*e[...,None,:])
+    S = S-numpy.eye(3)/3
+    xx,yy,zz = S[...,0,0],S[...,1,1],S[...,2,2]
+    xy,xz,yz = S[...,0,1],S[...,0,2],S[...,1,2]
+    # spherical components of S, weights are sqrt(3/2) times their conjugate
+    T = [(xx-yy-2j*xy)/2,(xz-1j*yz),numpy.sqrt(1.5)*zz+0j,-(xz+1j*yz),
+                                                    (xx-yy+2j*xy)/2]
+    return numpy.sqrt(1.5)*numpy.conj(numpy.stack(T,axis=-1))
+
+@Profiling.profiled()
+def AC_aniso(Nmax,a2,Beta,I1,I2,sparse=False,polarisation=None):
     ''' Calculate anisotropic ac stark shift.
 
         Generates the effect of the anisotropic AC Stark shift for a rigid-rotor
         like molecule.
 
         This term is calculated differently to all of the others in this work
-        and is based off Jesus Aldegunde's FORTRAN 77 code. It iterates over
-        N,MN,N',MN' to build a matrix without hyperfine structure then uses
-        kronecker products to expand it into all of the hyperfine states.
+        and is based off Jesus Aldegunde's FORTRAN 77 code. It is the sum of
+        the five components of C^2 from AC_aniso_components, weighted by the
+        Wigner D matrix for the polarisation (see Polarisation_Weights).
 
         Args:
 
@@ -724,40 +1029,70 @@ def AC_aniso(Nmax,a2,Beta,I1,I2):
             Beta (float) - polarisation angle of the laser in Radians
             I1,I2 (float) - Nuclear spin of nucleus 1,2
 
+        kwargs:
+            sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
+            polarisation (numpy.ndarray) - (3,) Cartesian polarisation vector, used instead of Beta if given
+
         Returns:
             H (numpy.ndarray): Hamiltonian in joules
      '''
+    weights = Polarisation_Weights(Beta,polarisation)
+    if weights.ndim != 1:
+        raise ValueError("AC_aniso takes one polarisation, use "
+                "AC_aniso_components with Polarisation_Weights for many")
+    components = _aniso_components(Nmax,I1,I2)
+    HAC = 0
+    for q in range(-2,2+1):
+        HAC = HAC+(-a2*weights[q+2])*components[q+2]
+
+    #return the matrix, in the full uncoupled basis.
+    return HAC.tocsr() if sparse else HAC.toarray()
+
+@lru_cache(maxsize=16)
+@Profiling.profiled()
+def _aniso_components(Nmax,I1,I2):
+    ''' the five components of C^2 in the full basis, cached '''
     I1shape = int(2*I1+1)
     I2shape = int(2*I2+1)
-    shape = numpy.sum(numpy.array([2*x+1 for x in range(0,Nmax+1)]))
-    HAC = numpy.zeros((shape,shape),dtype= numpy.complex)
-    i=0
-    j=0
-    for N1 in range(0,Nmax+1):
-        for M1 in range(N1,-(N1+1),-1):
-            for N2 in range(0,Nmax+1):
-                for M2 in range(N2,-(N2+1),-1):
-                    M = M2-M1
-                    HAC[i,j]= -a2*(Wigner_D(2,M,0,Beta,0)*(-1)**M2*\
-                                numpy.sqrt((2*N1+1)*(2*N2+1))*\
-                                wigner_3j(N2,2,N1,0,0,0)*\
-                                wigner_3j(N2,2,N1,-M2,M,M1))
-                    j+=1
-            j=0
-            i+=1
-    #final check for NaN errors, mostly this is due to division by zero or
-    # multiplication by a small prefactor. it is safe to set these terms to 0
-    HAC[numpy.isnan(HAC)] =0
 
-    #return the matrix, in the full uncoupled basis.
-    return (numpy.kron(HAC,numpy.kron(numpy.identity(I1shape),
-            numpy.identity(I2shape))))
+    # element <N,MN|H|N',MN'> couples through the component q = MN'-MN which
+    # is the transpose of <N',MN'|C^2_q|N,MN>
+    return tuple(_expand(Rotational_Tensor(Nmax,2,q).T.astype(
+                        numpy.complex128),_identity(I1shape,True),
+                        _identity(I2shape,True),True) for q in range(-2,2+1))
+
+def AC_aniso_components(Nmax,a2,I1,I2,sparse=False):
+    ''' The five spherical components of the anisotropic ac stark shift.
+
+        The polarisation angle only enters AC_aniso through the Wigner D
+        matrix weighting each component of C^2, so
+
+        AC_aniso(Beta) = sum_q Wigner_D(2,q,0,Beta,0)*components[q+2]
+
+        This lets the Hamiltonian be found for any number of polarisations
+        without rebuilding any matrices. The components are only built once
+        for each (Nmax,I1,I2).
+
+        Args:
+            Nmax (int) - maximum rotational quantum number to calculate
+            a2 (float) - anisotropic polarisability
+            I1,I2 (float) - Nuclear spin of nucleus 1,2
+
+        kwargs:
+            sparse (bool) - return scipy.sparse.csr_matrix components (default = False)
+
+        Returns:
+            components (list of numpy.ndarray): the q = -2,-1,0,1,2 components in joules
+    '''
+    components = [-a2*A for A in _aniso_components(Nmax,I1,I2)]
+    return [A.tocsr() if sparse else A.toarray() for A in components]
 
 #Now some functions to take these functions and assemble them into the physical
 #Hamiltonians where necessary.
 
 
-def Hyperfine_Ham(Nmax,I1_mag,I2_mag,Consts):
+@Profiling.profiled()
+def Hyperfine_Ham(Nmax,I1_mag,I2_mag,Consts,sparse=False):
     '''Calculate the field-free Hyperfine hamiltonian
 
         Wrapper to call all of the functions that are appropriate for the singlet-sigma hyperfine hamiltonian.
@@ -766,17 +1101,24 @@ def Hyperfine_Ham(Nmax,I1_mag,I2_mag,Consts):
             Nmax (int) - Maximum rotational level to include
             I1_mag,I2_mag (float) - magnitude of the nuclear spins
             Consts (Dictionary): Dict of molecular constants
+        kwargs:
+            sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
         Returns:
             H0 : Hamiltonian for the hyperfine structure in joules
     '''
-    N,I1,I2 = Generate_vecs(Nmax,I1_mag,I2_mag)
+    if sparse:
+        ops = Angular_Momentum(Nmax,I1_mag,I2_mag)
+        N,I1,I2 = ops['N'],ops['I1'],ops['I2']
+    else:
+        N,I1,I2 = Generate_vecs(Nmax,I1_mag,I2_mag)
     H = Rotational(N,Consts['Brot'],Consts['Drot'])+\
     scalar_nuclear(Consts['C1'],N,I1)+scalar_nuclear(Consts['C2'],N,I2)+\
     scalar_nuclear(Consts['C4'],I1,I2)+tensor_nuclear(Consts['C3'],I1,I2,Nmax)+\
-    Quadrupole((Consts['Q1'],Consts['Q2']),I1_mag,I2_mag,Nmax)
+    Quadrupole((Consts['Q1'],Consts['Q2']),I1_mag,I2_mag,Nmax,sparse)
     return H
 
-def Zeeman_Ham(Nmax,I1_mag,I2_mag,Consts):
+@Profiling.profiled()
+def Zeeman_Ham(Nmax,I1_mag,I2_mag,Consts,sparse=False):
     '''Assembles the Zeeman term and generates operator vectors
 
         Calculates the Zeeman effect for a magnetic field on a singlet-sigma molecule.
@@ -787,52 +1129,459 @@ def Zeeman_Ham(Nmax,I1_mag,I2_mag,Consts):
             I1_mag,I2_mag (float) - magnitude of the nuclear spins
             Consts (Dictionary): Dict of molecular constants
 
+        kwargs:
+            sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
+
         Returns:
             Hz (numpy.ndarray): Hamiltonian for the zeeman effect
     '''
-    N,I1,I2 = Generate_vecs(Nmax,I1_mag,I2_mag)
+    if sparse:
+        ops = Angular_Momentum(Nmax,I1_mag,I2_mag)
+        N,I1,I2 = ops['N'],ops['I1'],ops['I2']
+    else:
+        N,I1,I2 = Generate_vecs(Nmax,I1_mag,I2_mag)
     H = Zeeman(Consts['Mu1'],I1)+Zeeman(Consts['Mu2'],I2)+\
                 Zeeman(Consts['MuN'],N)
     return H
+
+def Zeeman_Components(Nmax,I1_mag,I2_mag,Consts,sparse=False):
+    ''' x, y and z components of the Zeeman Hamiltonian
+
+        For a magnetic field vector (Bx,By,Bz) the Zeeman Hamiltonian is
+        Bx*Hx+By*Hy+Bz*Hz. The z component is the same as Zeeman_Ham. The
+        angular momentum operators come from the cache in Angular_Momentum.
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            I1_mag,I2_mag (float) - magnitude of the nuclear spins
+            Consts (Dictionary): Dict of molecular constants
+
+        kwargs:
+            sparse (bool) - return scipy.sparse.csr_matrix components (default = False)
+
+        Returns:
+            H (list of numpy.ndarray): Hx,Hy,Hz in joules per tesla
+    '''
+    ops = Angular_Momentum(Nmax,I1_mag,I2_mag)
+    components = []
+    for i in range(3):
+        H = -(Consts['Mu1']*ops['I1'][i]+Consts['Mu2']*ops['I2'][i]+
+                                            Consts['MuN']*ops['N'][i])
+        H = scipy.sparse.csr_matrix(H,dtype=numpy.complex128)
+        components.append(H if sparse else H.toarray())
+    return components
+
 # This is the main build function and one that the user will actually have to
 # use.
 
-def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False):
+@Profiling.profiled()
+def Build_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,AC=False,
+                                                                sparse=False):
     ''' Return the hyperfine hamiltonian.
 
         This function builds the hamiltonian matrices for evalutation so that
         the user doesn't have to rebuild them every time and we can benefit from
         numpy's ability to do distributed multiplcation.
 
+        With sparse=True every term is built directly as a
+        scipy.sparse.csr_matrix, without ever forming a dense matrix in the
+        full basis. Most elements are zero by the selection rules, so this
+        needs far less memory for large Nmax.
+
         Args:
             Nmax (int) - Maximum rotational level to include
             I1_mag,I2_mag (float) - magnitude of the nuclear spins
             Constants (Dictionary) - Dict of molecular constants
             zeeman,EDC,AC (Boolean) - Switches for turning off parts of the total Hamiltonian can save significant time on calculations where DC and AC fields are not required due to nested for loops
 
+        kwargs:
+            sparse (bool) - return scipy.sparse.csr_matrix terms (default = False)
+
         Returns:
             H0,Hz,HDC,HAC (numpy.ndarray): Each of the terms in the Hamiltonian.
     '''
     I1 = Constants['I1']
     I2 = Constants['I2']
 
-    H0 = Hyperfine_Ham(Nmax,I1,I2,Constants)
+    # the terms are always assembled from sparse operators, the products of
+    # the angular momentum matrices are much cheaper that way. They are only
+    # made dense at the end if that is what the user asked for.
+    H0 = Hyperfine_Ham(Nmax,I1,I2,Constants,True)
+    if zeeman:
+        Hz = Zeeman_Ham(Nmax,I1,I2,Constants,True)
+    else:
+        Hz =0.
+    if EDC:
+        HDC = DC(Nmax,Constants['d0'],I1,I2,True)
+    else:
+        HDC =0.
+    if AC:
+        HAC = (1./(2*eps0*c))*(AC_iso(Nmax,Constants['a0'],I1,I2,True)+\
+        AC_aniso(Nmax,Constants['a2'],Constants['Beta'],I1,I2,True))
+    else:
+        HAC =0.
+
+    Hams = [H0,Hz,HDC,HAC]
+    for i,H in enumerate(Hams):
+        if scipy.sparse.issparse(H):
+            H = H.astype(numpy.complex128)
+            Hams[i] = H.tocsr() if sparse else H.toarray()
+    H0,Hz,HDC,HAC = Hams
+    return H0,Hz,HDC,HAC
+
+
+# The terms in the Hamiltonian are all sums of Kronecker products of a small
+# operator on the rotational states with a small operator on the nuclear spin
+# states. The functions below keep them in that form so that very large Nmax
+# can be used without ever storing the full matrix.
+
+def Kronecker_Factors(Nmax,I1,I2,Beta=0):
+    ''' Factorise each term of the Hamiltonian into rotational x spin parts
+
+        For every molecular constant this returns the operator that it
+        multiplies in the Hamiltonian (i.e. the term with the constant set to
+        one) as a list of pairs (A,B) such that the operator is the sum of
+        kron(A,B). A acts on the N,MN states and is a scipy.sparse.csr_matrix,
+        B acts on the combined M1,M2 nuclear spin states and is a small dense
+        array. Either can be None, meaning the identity.
+
+        The polarisabilities include the factor of 1/(2*eps0*c) used in
+        Build_Hamiltonians, so that HAC = a0*U['a0']+a2*U['a2'].
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            I1,I2 (float) - Nuclear spins of nuclei 1 and 2
+        kwargs:
+            Beta (float) - polarisation angle of the trapping laser in radians
+        Returns:
+            U (dict) - keys are the names used in the molecular constants dictionaries
+    '''
+    # the rotational operators are the same as in the full space with no
+    # nuclear spins, and the spin operators the same with only N=0
+    N,_,_ = Generate_vecs(Nmax,0,0,sparse=True)
+    _,S1,S2 = Generate_vecs(0,I1,I2)
+    C2 = T2_C(Nmax,0,0,sparse=True)
+    T2 = MakeT2(S1,S2)
+    Q1 = [Spin_Quadrupole_Tensor(I1,q) for q in range(-2,2+1)]
+    Q2 = [Spin_Quadrupole_Tensor(I2,q) for q in range(-2,2+1)]
+    shape2 = int(2*I2+1)
+    shape1 = int(2*I1+1)
+
+    N2 = vector_dot(N,N)
+
+    U = {}
+    U['Brot'] = [(N2,None)]
+    U['Drot'] = [(-1*N2.multiply(N2),None)]
+    U['C1'] = [(N[i],S1[i]) for i in range(3)]
+    U['C2'] = [(N[i],S2[i]) for i in range(3)]
+    U['C4'] = [(None,vector_dot(S1,S2))]
+    U['C3'] = [(numpy.sqrt(6)*((-1)**q)*C2[i],T2[-(i+1)])
+                                    for i,q in enumerate(range(-2,2+1))]
+    U['Q1'] = [(0.25*((-1)**q)*C2[-(i+1)],numpy.kron(Q1[i],
+                    numpy.identity(shape2))) for i,q in enumerate(range(-2,2+1))]
+    U['Q2'] = [(0.25*((-1)**q)*C2[-(i+1)],numpy.kron(numpy.identity(shape1),
+                                Q2[i])) for i,q in enumerate(range(-2,2+1))]
+    U['MuN'] = [(-1*N[2],None)]
+    U['Mu1'] = [(None,-1*S1[2])]
+    U['Mu2'] = [(None,-1*S2[2])]
+    U['d0'] = [(scipy.sparse.csr_matrix(-1*Rotational_Tensor(Nmax,1,0)),None)]
+    U['a0'] = [(None,-1/(2*eps0*c)*numpy.identity(shape1*shape2))]
+    U['a2'] = [(scipy.sparse.csr_matrix(-1/(2*eps0*c)*
+                sum(Wigner_D(2,q,0,Beta,0)*Rotational_Tensor(Nmax,2,q).T
+                for q in range(-2,2+1))),None)]
+    return U
+
+class KroneckerHamiltonian(scipy.sparse.linalg.LinearOperator):
+    ''' Matrix-free Hamiltonian stored as a sum of Kronecker products
+
+        The operator is sum(coeff*kron(A,B)) where A acts on the rotational
+        states and B on the nuclear spin states. H.v is evaluated by
+        reshaping v into a (rotational x spin) array and contracting with
+        each factor in turn, so the full matrix is never formed. This can be
+        passed to anything that takes a scipy.sparse.linalg.LinearOperator,
+        e.g. eigsh or lobpcg.
+
+        Instances can be scaled by numbers and added together, so the total
+        Hamiltonian is made exactly as for the dense matrices:
+        H = H0+B*Hz+E*HDC+I*HAC
+
+        Args:
+            terms (list) - list of (coeff,A,B) tuples, A or B can be None for the identity
+            shapes (tuple of ints) - dimension of the rotational and spin spaces
+    '''
+
+    def __init__(self,terms,shapes):
+        self.terms = list(terms)
+        self.shapes = tuple(shapes)
+        dim = self.shapes[0]*self.shapes[1]
+        super().__init__(dtype=numpy.complex128,shape=(dim,dim))
+
+    def _matmat(self,X):
+        shapeN,shapeS = self.shapes
+        k = X.shape[1]
+        V = numpy.asarray(X,dtype=numpy.complex128).reshape(shapeN,shapeS,k)
+        HV = numpy.zeros(V.shape,dtype=numpy.complex128)
+        for coeff,A,B in self.terms:
+            if coeff == 0:
+                continue
+            AV = V if A is None else \
+                        A.dot(V.reshape(shapeN,shapeS*k)).reshape(V.shape)
+            if B is not None:
+                AV = numpy.matmul(B,AV)
+            HV += coeff*AV
+        return HV.reshape(shapeN*shapeS,k)
+
+    def _matvec(self,x):
+        return self._matmat(numpy.reshape(x,(-1,1))).ravel()
+
+    def _adjoint(self):
+        return KroneckerHamiltonian([(numpy.conj(coeff),
+                            None if A is None else A.conj().T,
+                            None if B is None else B.conj().T)
+                            for coeff,A,B in self.terms],self.shapes)
+
+    def __add__(self,other):
+        if isinstance(other,KroneckerHamiltonian):
+            if other.shapes != self.shapes:
+                raise ValueError("Hamiltonians are for different bases")
+            return KroneckerHamiltonian(self.terms+other.terms,self.shapes)
+        elif numpy.isscalar(other) and other == 0:
+            # terms that were switched off in the build are zero
+            return self
+        return super().__add__(other)
+
+    def __radd__(self,other):
+        return self.__add__(other)
+
+    def __mul__(self,other):
+        if numpy.isscalar(other):
+            return KroneckerHamiltonian([(other*coeff,A,B)
+                                for coeff,A,B in self.terms],self.shapes)
+        return super().__mul__(other)
+
+    def __rmul__(self,other):
+        if numpy.isscalar(other):
+            return self.__mul__(other)
+        return super().__rmul__(other)
+
+    def diagonal(self):
+        ''' diagonal of the full matrix, e.g. for preconditioning'''
+        shapeN,shapeS = self.shapes
+        diag = numpy.zeros(shapeN*shapeS,dtype=numpy.complex128)
+        for coeff,A,B in self.terms:
+            a = numpy.ones(shapeN) if A is None else A.diagonal()
+            b = numpy.ones(shapeS) if B is None else numpy.diagonal(B)
+            diag += coeff*numpy.kron(a,b)
+        return diag
+
+    def tosparse(self):
+        ''' the full matrix as a scipy.sparse.csr_matrix'''
+        shapeN,shapeS = self.shapes
+        H = scipy.sparse.csr_matrix(self.shape,dtype=numpy.complex128)
+        for coeff,A,B in self.terms:
+            A = scipy.sparse.identity(shapeN) if A is None else A
+            B = scipy.sparse.identity(shapeS) if B is None else B
+            H = H + coeff*scipy.sparse.kron(A,B,format='csr')
+        return H.tocsr()
+
+def Build_Kronecker_Hamiltonians(Nmax,Constants,zeeman=False,EDC=False,
+                                                                    AC=False):
+    ''' Return the hyperfine hamiltonian as matrix-free operators.
+
+        Equivalent to Build_Hamiltonians but each term is a
+        KroneckerHamiltonian, which only stores the small rotational and
+        nuclear spin factors. Memory use grows as Nmax^2 rather than Nmax^4
+        for the full matrices, so much larger Nmax are possible.
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            Constants (Dictionary) - Dict of molecular constants
+            zeeman,EDC,AC (Boolean) - Switches for turning off parts of the total Hamiltonian
+
+        Returns:
+            H0,Hz,HDC,HAC (KroneckerHamiltonian): Each of the terms in the Hamiltonian.
+    '''
+    I1 = Constants['I1']
+    I2 = Constants['I2']
+    U = Kronecker_Factors(Nmax,I1,I2,Constants['Beta'])
+    shapes = (int(sum([2*x+1 for x in range(0,Nmax+1)])),
+                                            int((2*I1+1)*(2*I2+1)))
+
+    def assemble(keys):
+        return KroneckerHamiltonian([(Constants[key],A,B) for key in keys
+                                        for A,B in U[key]],shapes)
+
+    H0 = assemble(['Brot','Drot','C1','C2','C3','C4','Q1','Q2'])
     if zeeman:
-        Hz = Zeeman_Ham(Nmax,I1,I2,Constants)
+        Hz = assemble(['Mu1','Mu2','MuN'])
     else:
         Hz =0.
     if EDC:
-        HDC = DC(Nmax,Constants['d0'],I1,I2)
+        HDC = assemble(['d0'])
     else:
         HDC =0.
     if AC:
-        HAC = (1./(2*eps0*c))*(AC_iso(Nmax,Constants['a0'],I1,I2)+\
-        AC_aniso(Nmax,Constants['a2'],Constants['Beta'],I1,I2))
+        HAC = assemble(['a0','a2'])
     else:
         HAC =0.
     return H0,Hz,HDC,HAC
 
 
+# Every term in the Hamiltonian is linear in one molecular constant, so the
+# matrices only need to be built once for each basis. The class below keeps
+# them and makes the Hamiltonian for any set of constants as a weighted sum.
+
+# the constants in each of H0, Hz, HDC and HAC. a2 appears once for each of
+# the five spherical components of the anisotropic polarisability.
+_linear_terms = (("Brot","Drot","Q1","Q2","C1","C2","C3","C4"),
+                ("Mu1","Mu2","MuN"),
+                ("d0",),
+                ("a0","a2","a2","a2","a2","a2"))
+
+class CompiledMolecule:
+    ''' The Hamiltonian of any molecule with a given pair of nuclear spins
+
+        Each term of the Hamiltonian is stored once, per unit of its
+        molecular constant, on the sparsity pattern shared by all of the
+        terms in each of H0, Hz, HDC and HAC. Build then gives H0,Hz,HDC,HAC
+        for any constants as a single matrix product with the constants,
+        which is much cheaper than Build_Hamiltonians.
+
+        The same instance serves every molecule with the same I1 and I2 (e.g.
+        RbCs and 41KCs), and scanning over a constant does not need any
+        matrices to be rebuilt. Use Compile_Molecule to share instances.
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            I1,I2 (float) - nuclear spins
+    '''
+    __slots__ = ("Nmax","I1","I2","shape","patterns","data")
+
+    def __init__(self,Nmax,I1,I2):
+        self.Nmax = int(Nmax)
+        self.I1 = I1
+        self.I2 = I2
+
+        ops = Angular_Momentum(Nmax,I1,I2)
+        N,S1,S2 = ops['N'],ops['I1'],ops['I2']
+        units = {"Brot":Rotational(N,1,0),
+                "Drot":Rotational(N,0,1),
+                "Q1":Quadrupole((1,0),I1,I2,Nmax,True),
+                "Q2":Quadrupole((0,1),I1,I2,Nmax,True),
+                "C1":scalar_nuclear(1,N,S1),
+                "C2":scalar_nuclear(1,N,S2),
+                "C3":tensor_nuclear(1,S1,S2,Nmax),
+                "C4":scalar_nuclear(1,S1,S2),
+                "Mu1":Zeeman(1,S1),
+                "Mu2":Zeeman(1,S2),
+                "MuN":Zeeman(1,N),
+                "d0":DC(Nmax,1,I1,I2,True),
+                "a0":AC_iso(Nmax,1,I1,I2,True)/(2*eps0*c)}
+        aniso = [A/(2*eps0*c) for A in AC_aniso_components(Nmax,1,I1,I2,True)]
+
+        self.shape = units["Brot"].shape
+        self.patterns = []
+        self.data = []
+        for names in _linear_terms:
+            mats = [scipy.sparse.csr_matrix(units[n],dtype=numpy.complex128)
+                                                for n in names if n != "a2"]
+            if "a2" in names:
+                mats += [scipy.sparse.csr_matrix(A,dtype=numpy.complex128)
+                                                            for A in aniso]
+            # the union of the nonzero elements of every term
+            union = abs(mats[0])
+            for M in mats[1:]:
+                union = union+abs(M)
+            union = scipy.sparse.csr_matrix(union)
+            union.sort_indices()
+            rows = numpy.repeat(numpy.arange(self.shape[0]),
+                                                    numpy.diff(union.indptr))
+            cols = union.indices
+            self.patterns.append((union.indices.copy(),union.indptr.copy()))
+            self.data.append(numpy.array([numpy.asarray(M[rows,cols]).ravel()
+                                        for M in mats],dtype=numpy.complex128))
+
+    def Weights(self,Constants):
+        ''' coefficient of each stored term for a set of constants '''
+        aniso = Polarisation_Weights(Constants.get('Beta',0))
+        weights = []
+        for names in _linear_terms:
+            w = [Constants[n] for n in names if n != "a2"]
+            if "a2" in names:
+                w += [Constants["a2"]*d for d in aniso]
+            weights.append(numpy.array(w,dtype=numpy.complex128))
+        return weights
+
+    def _term(self,i,weights,sparse):
+        indices,indptr = self.patterns[i]
+        H = scipy.sparse.csr_matrix((weights.dot(self.data[i]),
+                        indices.copy(),indptr.copy()),shape=self.shape)
+        return H if sparse else H.toarray()
+
+    def Build(self,Constants,zeeman=False,EDC=False,AC=False,sparse=False):
+        ''' Return the hyperfine hamiltonian for a set of constants.
+
+            Gives the same result as Build_Hamiltonians.
+
+            Args:
+                Constants (Dictionary) - Dict of molecular constants, the nuclear spins must match those compiled
+                zeeman,EDC,AC (Boolean) - Switches for turning off parts of the total Hamiltonian
+
+            kwargs:
+                sparse (bool) - return scipy.sparse.csr_matrix terms (default = False)
+
+            Returns:
+                H0,Hz,HDC,HAC (numpy.ndarray): Each of the terms in the Hamiltonian.
+        '''
+        if Constants['I1'] != self.I1 or Constants['I2'] != self.I2:
+            raise ValueError("the constants are for nuclear spins ({:.1f},"
+                "{:.1f}), not ({:.1f},{:.1f})".format(Constants['I1'],
+                                        Constants['I2'],self.I1,self.I2))
+        weights = self.Weights(Constants)
+        switches = (True,zeeman,EDC,AC)
+        return tuple(self._term(i,weights[i],sparse) if on else 0.
+                                            for i,on in enumerate(switches))
+
+    def Unit(self,name,Beta=0,sparse=False):
+        ''' The Hamiltonian per unit of one molecular constant
+
+            This is the derivative of H0, Hz, HDC or HAC with respect to the
+            constant, so for example a scan over C4 is just
+            H0 + (C4 - Constants['C4'])*Unit('C4').
+
+            Args:
+                name (str) - name of the constant, as in the constants dictionaries
+
+            kwargs:
+                Beta (float) - polarisation angle, only used for a2
+                sparse (bool) - return a scipy.sparse.csr_matrix (default = False)
+
+            Returns:
+                U (numpy.ndarray) - the term per unit of the constant
+        '''
+        for i,names in enumerate(_linear_terms):
+            if name in names:
+                w = numpy.array([1 if n == name else 0 for n in names],
+                                                        dtype=numpy.complex128)
+                if name == "a2":
+                    w[1:] = Polarisation_Weights(Beta)
+                return self._term(i,w,sparse)
+        raise ValueError("{:s} is not a constant of the Hamiltonian".format(
+                                                                        name))
+
+@lru_cache(maxsize=8)
+def Compile_Molecule(Nmax,I1,I2):
+    ''' Shared CompiledMolecule for each (Nmax,I1,I2)
+
+        Args:
+            Nmax (int) - Maximum rotational level to include
+            I1,I2 (float) - nuclear spins
+
+        Returns:
+            molecule (CompiledMolecule) - the compiled Hamiltonian terms
+    '''
+    return CompiledMolecule(Nmax,I1,I2)
+
 if __name__=="__main__":
 
     #This code only executes if the module is directly executed so acts as a
@@ -841,6 +1590,7 @@ if __name__=="__main__":
     import matplotlib.pyplot as pyplot
     import scipy.constants
     import time
+    from diatom.Legacy import Vary_magnetic
     ''' My test is building a zeeman structure plot for N<= 5 takes ~20 mins'''
     B = 0
     I = 0
@@ -1,7 +1,14 @@
-from diatom.Hamiltonian import vector_dot
+from diatom.Hamiltonian import vector_dot,AC_aniso_components,\
+                                                        Polarisation_Weights
+from diatom import Calculate
 import numpy
+import warnings
+import scipy.constants
 from scipy.linalg import block_diag
 
+eps0 = scipy.constants.epsilon_0
+c = scipy.constants.c
+
 '''
 This module contains code that is incorrect beyond the diagonal elements of the
 Hamiltonian in N,MN and is left purely for legacy purposes. In almost all
@@ -129,20 +136,32 @@ def Quadrupole(Q,I1,I2,N):
 #obviously these can be added to by writing custom scripts but these should
 # cover most needs
 
-def Vary_magnetic(Hams,fields0,Bz,return_states = False):
+def _vary(Hams,fields,return_states,blocks=None):
+    ''' run Calculate.Sweep and return the results in the legacy layout
+
+    The functions below used to return energies as (states,points) and
+    eigenstates as (basis,states,points), the sweep engine puts the points
+    first.
+    '''
+    result = Calculate.Sweep(Hams,fields,return_states,blocks=blocks)
+    if return_states:
+        energies,states = result
+        return energies.T,numpy.moveaxis(states,0,-1)
+    return result.T
+
+def Vary_magnetic(Hams,fields0,Bz,return_states = False,blocks = None):
     ''' Vary magnetic field
 
     find Eigenvalues (and optionally Eigenstates) of the total Hamiltonian
-    This function works differently to the applied field ones. Because beta
-    changes the matrix elements in the Hamiltonian we cannot simply
-    multiply it through. Therefore we have to recalculate the matrix
-    elements on each interation. This makes the function slower.
+    at each magnetic field. This is now a thin wrapper around
+    Calculate.Sweep, which should be used for new code.
 
     Args:
         Hams: list or tuple of hamiltonians. Should all be the same size
-        fields0: initial field conditions, allows for zeeman + Stark effects
+        fields0: initial field conditions (E,B,I), allows for zeeman + Stark effects
         Bz: magnetic fields to iterate over
         return_states: Switch to return EigenStates as well as Eigenenergies
+        blocks: optional symmetry blocks from Calculate.MF_Blocks, only valid when all fields are along z
 
     Returns:
         energy:array of Eigenenergies, sorted from smallest to largest along the 0 axis
@@ -158,38 +177,22 @@ def Vary_magnetic(Hams,fields0,Bz,return_states = False):
     if type(Hz) != numpy.ndarray:
         warnings.warn("Hamiltonian is zero: nothing will change!")
     else:
-        EigenValues = numpy.zeros((H0.shape[0],len(Bz)))
-        if return_states:
-            States = numpy.zeros((H0.shape[0],H0.shape[0],len(Bz)))
-        for i,b in enumerate(Bz):
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore",category=numpy.ComplexWarning)
-                H = H0+E*HDC+I*HAC+b*Hz
-                if return_states:
-                    Eigen = eig(H)
-                    order = numpy.argsort(Eigen[0])
-                    EigenValues[:,i]=Eigen[0][order]
-                    States[:,:,i] = Eigen[1][:,order]
-                else:
-                    Eigen = eigvals(H)
-                    EigenValues[:,i]=numpy.sort(Eigen)
-        if return_states:
-            return EigenValues,States
-        else:
-            return EigenValues
+        fields = numpy.zeros((len(Bz),3))
+        fields[:,0] = Bz
+        fields[:,1] = E
+        fields[:,2] = I
+        return _vary(Hams,fields,return_states,blocks)
 
 def Vary_ElectricDC(Hams,fields0,Ez,return_states = False):
     ''' vary electric field DC
 
     find Eigenvalues (and optionally Eigenstates) of the total Hamiltonian
-    This function works differently to the applied field ones. Because beta
-    changes the matrix elements in the Hamiltonian we cannot simply
-    multiply it through. Therefore we have to recalculate the matrix
-    elements on each interation. This makes the function slower.
+    at each electric field. This is now a thin wrapper around
+    Calculate.Sweep, which should be used for new code.
 
     Args:
         Hams: list or tuple of hamiltonians. Should all be the same size
-        fields0: initial field conditions, allows for zeeman + Stark effects
+        fields0: initial field conditions (E,B,I), allows for zeeman + Stark effects
         Ez: Electric fields to iterate over
         return_states: Switch to return EigenStates as well as Eigenenergies
 
@@ -201,7 +204,6 @@ def Vary_ElectricDC(Hams,fields0,Ez,return_states = False):
 
     E,B,I = fields0
     H0,Hz,HDC,HAC = Hams
-    EigenValues = numpy.zeros((H0.shape[0],len(Ez)))
 
     #warn the user if they've done something silly, so they don't waste time
 
@@ -209,37 +211,22 @@ def Vary_ElectricDC(Hams,fields0,Ez,return_states = False):
         warnings.warn("Hamiltonian is zero: nothing will change!")
 
     else:
-        if return_states:
-            States = numpy.zeros((H0.shape[0],H0.shape[0],len(Ez)))
-        for i,e in enumerate(Ez):
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore",category=numpy.ComplexWarning)
-                H = H0+e*HDC+I*HAC+B*Hz
-                if return_states:
-                    Eigen = eig(H)
-                    order = numpy.argsort(Eigen[0])
-                    EigenValues[:,i]=Eigen[0][order]
-                    States[:,:,i] = Eigen[1][:,order]
-                else:
-                    Eigen = eigvals(H)
-                    EigenValues[:,i]=numpy.sort(Eigen)
-        if return_states:
-            return EigenValues,States
-        else:
-            return EigenValues
+        fields = numpy.zeros((len(Ez),3))
+        fields[:,0] = B
+        fields[:,1] = Ez
+        fields[:,2] = I
+        return _vary(Hams,fields,return_states)
 
 def Vary_Intensity(Hams,fields0,I_app,return_states = False):
     ''' vary intensity of off-resonant laser field
 
     find Eigenvalues (and optionally Eigenstates) of the total Hamiltonian
-    This function works differently to the applied field ones. Because beta
-    changes the matrix elements in the Hamiltonian we cannot simply
-    multiply it through. Therefore we have to recalculate the matrix
-    elements on each interation. This makes the function slower.
+    at each laser intensity. This is now a thin wrapper around
+    Calculate.Sweep, which should be used for new code.
 
     Args:
         Hams: list or tuple of hamiltonians. Should all be the same size
-        fields0: initial field conditions, allows for zeeman + Stark effects
+        fields0: initial field conditions (E,B,I), allows for zeeman + Stark effects
         Intensity: Intensities to iterate over
         return_states: Switch to return EigenStates as well as Eigenenergies
 
@@ -258,43 +245,34 @@ def Vary_Intensity(Hams,fields0,I_app,return_states = False):
     if type(HAC) != numpy.ndarray:
         warnings.warn("Hamiltonian is zero: nothing will change")
     else:
-        EigenValues = numpy.zeros((H0.shape[0],len(I_app)))
-        if return_states:
-            States = numpy.zeros((H0.shape[0],H0.shape[0],len(I_app)))
-        else:
-            for i,Int in enumerate(I_app):
-                with warnings.catch_warnings():
-                    warnings.filterwarnings("ignore",
-                                            category=numpy.ComplexWarning)
-                    H = H0+E*HDC+Int*HAC+B*Hz
-                    if return_states:
-                        Eigen = eig(H)
-                        order = numpy.argsort(Eigen[0])
-                        EigenValues[:,i]=Eigen[0][order]
-                        States[:,:,i] = Eigen[1][:,order]
-                    else:
-                        Eigen = eigvals(H)
-                        EigenValues[:,i]=numpy.sort(Eigen)
-            if return_states:
-                return EigenValues,States
-            else:
-                return EigenValues
-
-def Vary_Beta(Hams,fields0,Angles,Molecule_pars,return_states = False):
+        fields = numpy.zeros((len(I_app),3))
+        fields[:,0] = B
+        fields[:,1] = E
+        fields[:,2] = I_app
+        return _vary(Hams,fields,return_states)
+
+def Vary_Beta(Hams,fields0,Angles,Molecule_pars,return_states = False,
+                                                                chunk = None):
     ''' vary polarisation of laser field
 
     find Eigenvalues (and optionally Eigenstates) of the total Hamiltonian
     This function works differently to the applied field ones. Because beta
     changes the matrix elements in the Hamiltonian we cannot simply
-    multiply it through. Therefore we have to recalculate the matrix
-    elements on each interation. This makes the function slower.
+    multiply it through. Instead the anisotropic part is the sum of its five
+    spherical components weighted by Wigner_D(2,q,0,Beta,0), so these are
+    made once and the Hamiltonians for every angle are solved in batches.
+
+    The isotropic part of the ac Stark shift is taken from HAC. It is the
+    only part with a trace, as the anisotropic part is traceless in every
+    rotational manifold.
 
     Args:
         Hams: list or tuple of hamiltonians. Should all be the same size
-        fields0: initial field conditions, allows for zeeman + Stark effects
+        fields0: initial field conditions (E,B,I), allows for zeeman + Stark effects
         Angles: Polarisation angles to iterate over
         Molecule_pars: Nmax,I1,I2,a2, arguments to feed to regenerate the anisotropic Stark shift matrix.
         return_states: Switch to return EigenStates as well as Eigenenergies
+        chunk: number of angles to diagonalise at once
 
     Returns:
         energy: array of Eigenenergies, sorted from smallest to largest along the 0 axis
@@ -311,23 +289,18 @@ def Vary_Beta(Hams,fields0,Angles,Molecule_pars,return_states = False):
     if I == 0:
         warnings.warn("Intensity is zero: nothing will change")
     else:
-        EigenValues = numpy.zeros((H0.shape[0],len(Angles)))
-        if return_states:
-            States = numpy.zeros((H0.shape[0],H0.shape[0],len(Angles)))
-        for i,beta in enumerate(Angles):
-            HAC = AC_aniso(Nmax,a2,beta,I1,I2)/(2*eps0*c)
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore",category=numpy.ComplexWarning)
-                H = H0+E*HDC+I*HAC+B*Hz
-                if return_states:
-                    Eigen = eig(H)
-                    order = numpy.argsort(Eigen[0])
-                    EigenValues[:,i]=Eigen[0][order]
-                    States[:,:,i] = Eigen[1][:,order]
-                else:
-                    Eigen = eigvals(H)
-                    EigenValues[:,i]=numpy.sort(Eigen)
+        H = H0+E*HDC+B*Hz
+        dim = H.shape[0]
+        # -a0/(2 eps0 c) times the identity
+        iso = HAC.diagonal().sum()/dim if numpy.ndim(HAC) == 2 else 0
+        H = H+I*iso*numpy.identity(dim)
+
+        terms = [H]+[I*A/(2*eps0*c) for A in
+                                    AC_aniso_components(Nmax,a2,I1,I2,True)]
+        weights = numpy.atleast_2d(Polarisation_Weights(Angles))
+        coeffs = numpy.column_stack([numpy.ones(weights.shape[0]),weights])
+        result = Calculate._Sweep_Core(terms,coeffs,return_states,chunk)
         if return_states:
-            return EigenValues,States
+            return result[0].T,numpy.moveaxis(result[1],0,-1)
         else:
-            return EigenValues
+            return result.T
@@ -0,0 +1,189 @@
+from diatom import Calculate
+import numpy
+import os
+import multiprocessing
+import scipy.sparse
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # new in Python 3.8, without it Parallel_Sweep only runs on one process
+    shared_memory = None
+'''
+This module runs field sweeps across several processes.
+
+The Hamiltonian terms are put in shared memory once, so the workers can attach
+to them without each receiving a pickled copy, and the workers write their
+eigenvalues and eigenvectors straight into a shared output buffer. Each
+worker solves contiguous chunks of field points in the same way as
+Calculate.Sweep.
+
+The workers are started with the "spawn" method, so scripts that use this
+module must protect their entry point with if __name__ == "__main__":
+'''
+
+# environment variables read by the common BLAS libraries when they load
+_blas_variables = ("OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS",
+                    "BLIS_NUM_THREADS","VECLIB_MAXIMUM_THREADS",
+                    "NUMEXPR_NUM_THREADS")
+
+# the shared arrays, as seen from inside a worker process
+_worker = {}
+
+def _share(array):
+    ''' copy an array into a new block of shared memory '''
+    memory = _empty(array.shape,array.dtype)
+    view = numpy.ndarray(array.shape,dtype=array.dtype,buffer=memory.buf)
+    view[...] = array
+    return memory,view
+
+def _empty(shape,dtype):
+    ''' new block of shared memory big enough for an array '''
+    size = int(numpy.prod(shape))*numpy.dtype(dtype).itemsize
+    return shared_memory.SharedMemory(create=True,size=max(size,1))
+
+def _attach(spec):
+    ''' view of a shared array described by (name,shape,dtype) '''
+    name,shape,dtype = spec
+    memory = shared_memory.SharedMemory(name=name)
+    return memory,numpy.ndarray(shape,dtype=dtype,buffer=memory.buf)
+
+def _initialise(terms,energies,states,blas_threads):
+    ''' attach a worker to the shared arrays and limit its BLAS threads '''
+    try:
+        from threadpoolctl import threadpool_limits
+        _worker['limits'] = threadpool_limits(limits=blas_threads)
+    except ImportError:
+        # the environment variables set by the parent have done the job
+        pass
+    _worker['memory'] = []
+    for key,spec in (('terms',terms),('energies',energies),
+                                                        ('states',states)):
+        if spec is None:
+            _worker[key] = None
+            continue
+        memory,view = _attach(spec)
+        _worker['memory'].append(memory)
+        _worker[key] = view
+
+def _solve(task):
+    ''' solve one chunk of field points inside a worker '''
+    start,stop,coeffs,blocks = task
+    terms = _worker['terms']
+    return_states = _worker['states'] is not None
+    result = Calculate._Sweep_Core(terms,coeffs,return_states,
+                                                        blocks=blocks)
+    if return_states:
+        _worker['energies'][start:stop],_worker['states'][start:stop] = result
+    else:
+        _worker['energies'][start:stop] = result
+    return start
+
+def Parallel_Sweep(Hams,fields,return_states=True,workers=None,chunk=None,
+                                                blocks=None,blas_threads=1):
+    ''' Calculate.Sweep spread over several processes
+
+    Finds the eigenenergies (and optionally eigenstates) of
+    H = H0 + B*Hz + E*HDC + I*HAC for every row (B,E,I) of fields, sharing the
+    points between a pool of worker processes. The results are identical to
+    Calculate.Sweep.
+
+    Each worker is limited to blas_threads BLAS threads so that the pool does
+    not oversubscribe the machine, workers*blas_threads should be at most the
+    number of cores.
+
+    More than one worker needs Python 3.8 or later.
+
+    Args:
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians, switched off terms can be 0
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) in T, V/m and W/m^2
+
+    kwargs:
+        return_states (bool) - return the eigenstates as well as the energies (default = True)
+        workers (int) - number of processes, defaults to the number of cores / blas_threads
+        chunk (int) - number of contiguous points given to a worker at a time
+        blocks (list of numpy.ndarray) - symmetry blocks from Calculate.MF_Blocks
+        blas_threads (int) - BLAS threads in each worker (default = 1)
+
+    Returns:
+        energies (numpy.ndarray) - (points,dim) eigenenergies, lowest to highest at each point
+        states (numpy.ndarray) - (points,dim,dim) eigenstates, states[p,:,i] -> energies[p,i]
+    '''
+    terms,coeffs = Calculate._Sweep_Terms(Hams,fields)
+    points = coeffs.shape[0]
+
+    if workers is None:
+        workers = max(1,(os.cpu_count() or 1)//int(blas_threads))
+    workers = int(min(workers,points))
+    if workers <= 1:
+        return Calculate.Sweep(Hams,fields,return_states,chunk,blocks)
+    if shared_memory is None:
+        raise ImportError("Parallel_Sweep needs multiprocessing.shared_memory "
+                "(Python 3.8 or later) for more than one worker, use "
+                "workers=1 or Calculate.Sweep instead")
+
+    terms = numpy.array([T.toarray() if scipy.sparse.issparse(T) else T
+                                    for T in terms],dtype=numpy.complex128)
+    dim = terms.shape[-1]
+
+    if chunk is None:
+        # a few chunks per worker evens out the load, but keep each one
+        # within the memory that Calculate.Sweep would use
+        chunk = min(-(-points//(4*workers)),Calculate._default_chunk(dim))
+    chunk = int(chunk)
+
+    memory = []
+    try:
+        shared,view = _share(terms)
+        memory.append(shared)
+        specs = {'terms':(shared.name,terms.shape,terms.dtype)}
+        del terms,view
+
+        shared = _empty((points,dim),numpy.float64)
+        memory.append(shared)
+        specs['energies'] = (shared.name,(points,dim),numpy.float64)
+
+        if return_states:
+            shared = _empty((points,dim,dim),numpy.complex128)
+            memory.append(shared)
+            specs['states'] = (shared.name,(points,dim,dim),numpy.complex128)
+        else:
+            specs['states'] = None
+
+        tasks = [(start,min(start+chunk,points),coeffs[start:start+chunk],
+                                blocks) for start in range(0,points,chunk)]
+
+        # BLAS reads its thread count when it is loaded, so the spawned
+        # workers have to be started with these already set
+        saved = {key:os.environ.get(key) for key in _blas_variables}
+        for key in _blas_variables:
+            os.environ[key] = str(int(blas_threads))
+        try:
+            context = multiprocessing.get_context("spawn")
+            pool = context.Pool(workers,initializer=_initialise,
+                initargs=(specs['terms'],specs['energies'],specs['states'],
+                                                            int(blas_threads)))
+        finally:
+            for key,value in saved.items():
+                if value is None:
+                    os.environ.pop(key,None)
+                else:
+                    os.environ[key] = value
+
+        with pool:
+            for done in pool.imap_unordered(_solve,tasks):
+                pass
+
+        # copy out of shared memory before it is released
+        energies = numpy.ndarray(specs['energies'][1],dtype=numpy.float64,
+                                                buffer=memory[1].buf).copy()
+        if return_states:
+            states = numpy.ndarray(specs['states'][1],
+                        dtype=numpy.complex128,buffer=memory[2].buf).copy()
+    finally:
+        for shared in memory:
+            shared.close()
+            shared.unlink()
+
+    if return_states:
+        return energies,states
+    return energies
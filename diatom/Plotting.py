@@ -121,9 +121,8 @@ def TDM_plot(energies,States,gs,Nmax,I1,I2,TDMs=None,
         dz = TDMs[1,:]
         dp = TDMs[2,:]
     elif TDMs == None:
-        dm = numpy.round(Calculate.TDM(Nmax,I1,I2,+1,States,gs),6)
-        dz = numpy.round(Calculate.TDM(Nmax,I1,I2,0,States,gs),6)
-        dp = numpy.round(Calculate.TDM(Nmax,I1,I2,-1,States,gs),6)
+        dm,dz,dp = numpy.round(Calculate.Transition_Dipoles(Nmax,I1,I2,
+                                                States,bra=[gs])[:,0].real,6)
 
     if abs(pm)>1:
         pm = int(pm/abs(pm))
@@ -361,7 +360,9 @@ if __name__ == '__main__':
 
     H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(3,Hamiltonian.RbCs,zeeman=True)
 
-    eigvals,eigstate = numpy.linalg.eigh(H0+181.5e-4*Hz)
+    # only N = 0 and 1 are plotted, so only find those states
+    eigvals,eigstate = Calculate.Solve_Subset(H0+181.5e-4*Hz,N=[0,1],
+                    I1=Hamiltonian.RbCs['I1'],I2=Hamiltonian.RbCs['I2'])
 
     TDM_plot(eigvals,eigstate,1,
     Nmax = 3,I1 = Hamiltonian.RbCs['I1'], I2 = Hamiltonian.RbCs['I2'],
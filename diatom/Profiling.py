@@ -0,0 +1,284 @@
+import numpy
+import scipy.sparse
+import functools
+import tracemalloc
+import time
+import json
+import atexit
+import sys
+import os
+'''
+This module is a lightweight profiler for the stages of a calculation.
+
+The expensive functions in diatom are marked as stages. While profiling is
+switched on, every call of a stage records its wall time, the number of
+calls, the largest matrix that it returned and (optionally) the peak memory
+that it allocated, measured with tracemalloc. When profiling is off a stage
+costs one extra function call and a test of an empty list.
+
+Nested stages are each timed in full, so the time of Build_Hamiltonians
+includes the time of the terms that it builds.
+
+Profiling is switched on either for a block of code::
+
+    from diatom import Profiling
+    with Profiling.Profile(memory=True) as profile:
+        energies,states = Calculate.Sweep(Hams,fields)
+        energies,states = Calculate.Sort_Smooth(energies,states)
+    print(profile.Table())
+    profile.Save("profile.json")
+
+or for a whole program, by setting the environment variable DIATOM_PROFILE
+before diatom is imported. DIATOM_PROFILE=1 prints the table when the
+program exits, and DIATOM_PROFILE=name.json saves the results there instead.
+DIATOM_PROFILE_MEMORY=1 measures memory as well, which slows everything
+down considerably. Before Python 3.9 the memory of each stage is only an
+upper bound.
+'''
+
+# the profiles that are recording, empty when profiling is off
+_active = []
+
+# tracemalloc.reset_peak is new in Python 3.9. Without it the peak is the
+# highest since tracing started, so a stage can be given the peak of an
+# earlier one and the memory of each stage is only an upper bound.
+_reset_peak = getattr(tracemalloc,"reset_peak",None)
+
+# [memory at the start, peak memory so far] for each stage that is running
+# with memory measured, outermost first
+_frames = []
+
+def _shape(result):
+    ''' shape of the largest array in result, looking inside tuples, lists
+    and object arrays such as the sparse operators from Generate_vecs '''
+    if isinstance(result,numpy.ndarray) and result.dtype == object:
+        items = result.flat
+    elif isinstance(result,(tuple,list)):
+        items = result
+    elif isinstance(result,numpy.ndarray) or scipy.sparse.issparse(result):
+        return tuple(int(x) for x in result.shape)
+    else:
+        return None
+    best = None
+    for item in items:
+        shape = _shape(item)
+        if shape is not None and (best is None or
+                                    numpy.prod(shape) > numpy.prod(best)):
+            best = shape
+    return best
+
+class _Timer:
+    ''' records one call of a stage in every active profile '''
+    __slots__ = ("name","profiles","memory","frame","start")
+
+    def __init__(self,name):
+        self.name = name
+        self.profiles = list(_active)
+        self.memory = tracemalloc.is_tracing() and \
+                                    any(p.memory for p in self.profiles)
+        self.frame = None
+        if self.memory:
+            current,peak = tracemalloc.get_traced_memory()
+            for frame in _frames:
+                frame[1] = max(frame[1],peak)
+            if _reset_peak is not None:
+                _reset_peak()
+            self.frame = [current,current]
+            _frames.append(self.frame)
+        self.start = time.perf_counter()
+
+    def stop(self,result=None):
+        elapsed = time.perf_counter()-self.start
+        allocated = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            if _frames and _frames[-1] is self.frame:
+                _frames.pop()
+            for frame in _frames+[self.frame]:
+                frame[1] = max(frame[1],peak)
+            allocated = self.frame[1]-self.frame[0]
+        shape = _shape(result)
+        for profile in self.profiles:
+            profile._record(self.name,elapsed,allocated,shape)
+
+def profiled(name=None):
+    ''' decorator that makes a function a stage
+
+    kwargs:
+        name (str) - name of the stage, module.function by default
+    '''
+    def decorate(func):
+        label = name or "{:s}.{:s}".format(func.__module__.split(".")[-1],
+                                                            func.__name__)
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _active:
+                return func(*args,**kwargs)
+            timer = _Timer(label)
+            result = None
+            try:
+                result = func(*args,**kwargs)
+                return result
+            finally:
+                timer.stop(result)
+        return wrapper
+    return decorate
+
+class section:
+    ''' context manager that makes a block of code a stage
+
+    Args:
+        name (str) - name of the stage
+    '''
+    __slots__ = ("name","timer","result")
+
+    def __init__(self,name):
+        self.name = name
+        self.timer = None
+        self.result = None
+
+    def __enter__(self):
+        if _active:
+            self.timer = _Timer(self.name)
+        return self
+
+    def __exit__(self,*exc):
+        if self.timer is not None:
+            self.timer.stop(self.result)
+        return False
+
+class Profile:
+    ''' Records the stages that are called while it is active
+
+    kwargs:
+        memory (bool) - also measure the peak memory allocated by each stage with tracemalloc (default = False)
+    '''
+    def __init__(self,memory=False):
+        self.memory = memory
+        self.stages = {}
+        self._started = False
+
+    def __enter__(self):
+        return self.Start()
+
+    def __exit__(self,*exc):
+        self.Stop()
+        return False
+
+    def Start(self):
+        ''' start recording '''
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        if self not in _active:
+            _active.append(self)
+        return self
+
+    def Stop(self):
+        ''' stop recording, the results are kept '''
+        if self in _active:
+            _active.remove(self)
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+        return self
+
+    def Reset(self):
+        ''' throw away everything that has been recorded '''
+        self.stages = {}
+
+    def _record(self,name,elapsed,allocated,shape):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"calls":0,"time":0.,"max_time":0.,
+                                            "allocated":None,"shape":None}
+        stage["calls"] += 1
+        stage["time"] += elapsed
+        stage["max_time"] = max(stage["max_time"],elapsed)
+        if allocated is not None:
+            stage["allocated"] = max(stage["allocated"] or 0,allocated)
+        if shape is not None and (stage["shape"] is None or
+                        numpy.prod(shape) > numpy.prod(stage["shape"])):
+            stage["shape"] = shape
+
+    def Results(self):
+        ''' The recorded stages, slowest first
+
+        Returns:
+            stages (dict) - for each stage the number of calls, the total and longest wall time in s, the largest peak allocation in bytes (None if memory was not measured) and the shape of the largest matrix returned
+        '''
+        order = sorted(self.stages,key=lambda n:-self.stages[n]["time"])
+        return {name:dict(self.stages[name],
+                        shape=None if self.stages[name]["shape"] is None
+                                    else list(self.stages[name]["shape"]))
+                                                        for name in order}
+
+    def Save(self,fname):
+        ''' save the results as JSON
+
+        Args:
+            fname (str) - file name, appends .json if not present
+        '''
+        if fname[-5:] != ".json":
+            fname = fname+".json"
+        with open(fname,"w") as file:
+            json.dump({"memory":self.memory,"stages":self.Results()},file,
+                                                                    indent=2)
+
+    def Table(self):
+        ''' the results as a human-readable table '''
+        rows = ["{:<34s} {:>8s} {:>11s} {:>11s} {:>12s}  {:s}".format(
+                    "stage","calls","total (s)","mean (ms)","peak (MB)",
+                    "largest matrix")]
+        for name,stage in self.Results().items():
+            peak = "-" if stage["allocated"] is None else \
+                                "{:.3f}".format(stage["allocated"]/2**20)
+            shape = "-" if stage["shape"] is None else \
+                                "x".join(str(x) for x in stage["shape"])
+            rows.append("{:<34s} {:>8d} {:>11.4f} {:>11.4f} {:>12s}  {:s}"
+                        .format(name,stage["calls"],stage["time"],
+                        1e3*stage["time"]/stage["calls"],peak,shape))
+        return "\n".join(rows)
+
+def Progress_Bar(width=40,stream=None):
+    ''' A text progress bar, to use as a callback for Sort_Smooth
+
+    kwargs:
+        width (int) - number of characters in the bar
+        stream - where to write the bar, sys.stderr by default
+
+    Returns:
+        callback (function) - callback(step,total) that redraws the bar
+    '''
+    start = time.perf_counter()
+
+    def callback(step,total):
+        out = sys.stderr if stream is None else stream
+        done = int(width*step/max(total,1))
+        elapsed = time.perf_counter()-start
+        out.write("\r[{:s}{:s}] {:d}/{:d} {:.1f} s".format("#"*done,
+                            " "*(width-done),step,total,elapsed))
+        if step >= total:
+            out.write("\n")
+        out.flush()
+    return callback
+
+def _from_environment():
+    ''' switch profiling on for the whole program if DIATOM_PROFILE is set '''
+    setting = os.environ.get("DIATOM_PROFILE","")
+    if setting in ("","0"):
+        return None
+    memory = os.environ.get("DIATOM_PROFILE_MEMORY","") not in ("","0")
+    profile = Profile(memory).Start()
+
+    def report():
+        profile.Stop()
+        if setting.endswith(".json"):
+            profile.Save(setting)
+        else:
+            sys.stderr.write(profile.Table()+"\n")
+    atexit.register(report)
+    return profile
+
+# the profile of the whole program, None unless DIATOM_PROFILE is set
+Global = _from_environment()
@@ -0,0 +1,344 @@
+from diatom import Calculate
+import numpy
+import json
+import os
+import shutil
+'''
+This module saves the results of field sweeps in a binary format, which is
+far smaller and faster to write than the CSV files from Calculate.Export_Energy
+and Calculate.Export_State_Comp.
+
+A store is a directory holding a JSON manifest and a set of .npy files. Every
+quantity (energies, states, fields and any labels) is a column with one row
+per field point, and is split into the chunks that were appended to the
+store, so a sweep can write its results as it goes. The .npy files are memory
+mapped when they are read, so a few points can be taken out of a large store
+without reading the rest of it.
+
+Example:
+    Save a sweep a chunk at a time and read back the energies::
+
+        from diatom import Store
+        Store.Store_Sweep("results",(H0,Hz,HDC,HAC),fields,Nmax,Constants)
+        energies = Store.Read_Store("results","energies")
+'''
+
+_manifest = "manifest.json"
+
+def _read_manifest(path):
+    ''' the manifest of the store in path '''
+    with open(os.path.join(path,_manifest),"r") as f:
+        return json.load(f)
+
+def _write_manifest(path,manifest):
+    ''' replace the manifest atomically, so readers never see half of one '''
+    fname = os.path.join(path,_manifest)
+    with open(fname+".tmp","w") as f:
+        json.dump(manifest,f)
+    os.replace(fname+".tmp",fname)
+
+def _chunk_file(path,manifest,name,n):
+    ''' file holding chunk n of column name
+
+    Column names can hold characters that are not allowed in file names
+    (labels are "label:<name>"), so each column has its own file name in the
+    manifest. Stores without one use the column name.
+    '''
+    stem = manifest["columns"][name].get("file",name)
+    return os.path.join(path,"{:s}.{:05d}.npy".format(stem,n))
+
+def _file_stem(name,n):
+    ''' file name for column number n, called name '''
+    if name.startswith("label:"):
+        return "label{:03d}".format(n)
+    return name
+
+def Create_Store(path,Nmax=None,Constants=None,metadata=None,overwrite=False):
+    ''' Make a new, empty result store
+
+    Args:
+        path (str) - directory for the store
+
+    kwargs:
+        Nmax (int) - maximum rotational level of the calculation
+        Constants (Dictionary) - Dict of molecular constants
+        metadata (dict) - anything else to keep with the results, must be JSON serialisable
+        overwrite (bool) - replace an existing store at path (default = False)
+    '''
+    if os.path.isfile(os.path.join(path,_manifest)):
+        if not overwrite:
+            raise ValueError("{:s} already holds a store".format(path))
+        shutil.rmtree(path)
+    os.makedirs(path,exist_ok=True)
+
+    manifest = {"Nmax":None if Nmax is None else int(Nmax),
+                "constants":None if Constants is None else
+                                {k:float(v) for k,v in Constants.items()},
+                "metadata":{} if metadata is None else metadata,
+                "columns":{},
+                "chunks":[]}
+    _write_manifest(path,manifest)
+
+def Append_Store(path,energies,fields=None,states=None,labels=None):
+    ''' Add the results for some more field points to a store
+
+    The first chunk fixes which columns the store has and their shapes, every
+    later chunk has to give the same ones. The data are written before the
+    manifest, so if this is interrupted the store is left as it was.
+
+    Args:
+        path (str) - directory of a store from Create_Store
+        energies (numpy.ndarray) - (points,dim) eigenenergies, as from Calculate.Sweep
+
+    kwargs:
+        fields (numpy.ndarray) - (points,3) array of (B,E,I), or any (points,...) array of field values
+        states (numpy.ndarray) - (points,dim,dim) eigenstates
+        labels (dict) - named (points,dim) arrays of labels, e.g. {"N":N,"MF":MF}
+    '''
+    manifest = _read_manifest(path)
+    energies = numpy.atleast_2d(energies)
+    points = energies.shape[0]
+
+    columns = {"energies":energies}
+    if fields is not None:
+        columns["fields"] = numpy.asarray(fields).reshape(points,-1)
+    if states is not None:
+        columns["states"] = numpy.asarray(states)
+    if labels is not None:
+        for name,value in labels.items():
+            columns["label:"+name] = numpy.asarray(value).reshape(points,-1)
+
+    for name,value in columns.items():
+        if value.shape[0] != points:
+            raise ValueError("{:s} has {:d} points, expected {:d}".format(
+                                                name,value.shape[0],points))
+
+    if len(manifest["chunks"]) == 0:
+        manifest["columns"] = {name:{"dtype":value.dtype.str,
+                                "shape":list(value.shape[1:]),
+                                "file":_file_stem(name,k)}
+                            for k,(name,value) in enumerate(columns.items())}
+    else:
+        expected = manifest["columns"]
+        if set(expected) != set(columns):
+            raise ValueError("chunk has columns {:s}, the store has {:s}".format(
+                                    str(sorted(columns)),str(sorted(expected))))
+        for name,value in columns.items():
+            if list(value.shape[1:]) != expected[name]["shape"]:
+                raise ValueError("{:s} has the wrong shape for this "
+                                                        "store".format(name))
+
+    n = len(manifest["chunks"])
+    start = manifest["chunks"][-1]["stop"] if n > 0 else 0
+    for name,value in columns.items():
+        dtype = numpy.dtype(manifest["columns"][name]["dtype"])
+        numpy.save(_chunk_file(path,manifest,name,n),
+                    numpy.ascontiguousarray(value,dtype=dtype))
+
+    manifest["chunks"].append({"start":int(start),"stop":int(start+points)})
+    _write_manifest(path,manifest)
+
+def Store_Sweep(path,Hams,fields,Nmax=None,Constants=None,return_states=False,
+                    chunk=None,blocks=None,labels=None,metadata=None,
+                    overwrite=False):
+    ''' Calculate.Sweep, writing the results to a store as they are found
+
+    The sweep is done a chunk of field points at a time and each chunk is
+    appended to the store, so the whole set of eigenstates never has to fit
+    in memory.
+
+    Args:
+        path (str) - directory for the store
+        Hams (list) - H0,Hz,HDC,HAC as from Build_Hamiltonians
+        fields (numpy.ndarray) - (points,3) array of (B,E,I) in T, V/m and W/m^2
+
+    kwargs:
+        Nmax (int) - maximum rotational level, needed for labels
+        Constants (Dictionary) - Dict of molecular constants, needed for labels
+        return_states (bool) - save the eigenstates as well as the energies (default = False)
+        chunk (int) - number of points to solve and write at once
+        blocks (list of numpy.ndarray) - symmetry blocks from Calculate.MF_Blocks
+        labels (list of str) - labels to calculate and save for each state, any of "N","MN","F","MF","I","MI"
+        metadata (dict) - anything else to keep with the results
+        overwrite (bool) - replace an existing store at path (default = False)
+    '''
+    fields = numpy.atleast_2d(numpy.asarray(fields,dtype=float))
+    points = fields.shape[0]
+    dim = Hams[0].shape[0]
+    if chunk is None:
+        chunk = Calculate._default_chunk(dim)
+    chunk = int(chunk)
+    if labels is not None and (Nmax is None or Constants is None):
+        raise ValueError("Nmax and Constants are needed for labels")
+
+    Create_Store(path,Nmax,Constants,metadata,overwrite)
+    terms,coeffs = Calculate._Sweep_Terms(Hams,fields)
+
+    for start in range(0,points,chunk):
+        stop = min(start+chunk,points)
+        # the states are needed for the labels even if they are not saved
+        result = Calculate._Sweep_Core(terms,coeffs[start:stop],
+                        return_states or labels is not None,stop-start,blocks)
+        if return_states or labels is not None:
+            energies,states = result
+        else:
+            energies = result
+        found = None
+        if labels is not None:
+            found = _labels(states,labels,Nmax,Constants['I1'],
+                                                    Constants['I2'])
+        Append_Store(path,energies,fields[start:stop],
+                    states if return_states else None,found)
+
+def _labels(states,names,Nmax,I1,I2):
+    ''' the named labels of a (points,dim,dim) stack of states '''
+    functions = {"N":Calculate.LabelStates_N_MN,"MN":Calculate.LabelStates_N_MN,
+                "F":Calculate.LabelStates_F_MF,"MF":Calculate.LabelStates_F_MF,
+                "I":Calculate.LabelStates_I_MI,"MI":Calculate.LabelStates_I_MI}
+    found = {}
+    for name in names:
+        if name not in functions:
+            raise ValueError("unknown label {:s}".format(name))
+        pair = functions[name](states,Nmax,I1,I2)
+        found[name] = pair[0 if name in ("N","F","I") else 1].real
+    return found
+
+def Store_Info(path):
+    ''' Description of a store
+
+    Args:
+        path (str) - directory of the store
+
+    Returns:
+        info (dict) - Nmax, constants, metadata, the number of points and the columns with their dtypes, shapes and file names
+    '''
+    manifest = _read_manifest(path)
+    chunks = manifest["chunks"]
+    return {"Nmax":manifest["Nmax"],
+            "constants":manifest["constants"],
+            "metadata":manifest["metadata"],
+            "points":chunks[-1]["stop"] if len(chunks) > 0 else 0,
+            "columns":manifest["columns"]}
+
+def Read_Store(path,name,start=None,stop=None,mmap=True):
+    ''' Read some or all of the points of one column of a store
+
+    Only the chunks that overlap [start,stop) are opened. If these are all in
+    one chunk and mmap is True the result is a read-only memory map, so
+    nothing is read from disk until it is used.
+
+    Args:
+        path (str) - directory of the store
+        name (str) - column to read, "energies", "fields", "states" or the name of a label
+
+    kwargs:
+        start,stop (int) - range of points to read, default is all of them
+        mmap (bool) - memory map the files (default = True)
+
+    Returns:
+        values (numpy.ndarray) - (stop-start,...) array of the column
+    '''
+    manifest = _read_manifest(path)
+    if name not in manifest["columns"] and "label:"+name in manifest["columns"]:
+        name = "label:"+name
+    if name not in manifest["columns"]:
+        raise KeyError("the store has no column {:s}".format(name))
+
+    chunks = manifest["chunks"]
+    points = chunks[-1]["stop"] if len(chunks) > 0 else 0
+    start,stop,step = slice(start,stop).indices(points)
+
+    mode = "r" if mmap else None
+    parts = []
+    for n,c in enumerate(chunks):
+        if c["stop"] <= start or c["start"] >= stop:
+            continue
+        values = numpy.load(_chunk_file(path,manifest,name,n),mmap_mode=mode)
+        parts.append(values[max(start,c["start"])-c["start"]:
+                                        min(stop,c["stop"])-c["start"]])
+
+    column = manifest["columns"][name]
+    if len(parts) == 0:
+        return numpy.zeros([0]+column["shape"],dtype=column["dtype"])
+    if len(parts) == 1:
+        return parts[0]
+    return numpy.concatenate(parts)
+
+def Load_Store(path,mmap=True,states=True):
+    ''' Read a whole store
+
+    Args:
+        path (str) - directory of the store
+
+    kwargs:
+        mmap (bool) - memory map the files where possible (default = True)
+        states (bool) - read the eigenstates, if the store has them (default = True)
+
+    Returns:
+        results (dict) - "energies", "fields" and "states" arrays (where present), "labels" dict and the "Nmax", "constants" and "metadata" of the store
+    '''
+    info = Store_Info(path)
+    results = {"Nmax":info["Nmax"],"constants":info["constants"],
+                "metadata":info["metadata"],"labels":{}}
+    for name in info["columns"]:
+        if name == "states" and not states:
+            continue
+        values = Read_Store(path,name,mmap=mmap)
+        if name.startswith("label:"):
+            results["labels"][name[len("label:"):]] = values
+        else:
+            results[name] = values
+    return results
+
+def Store_To_CSV(path,fname,field=0,point=-1,dp=6,scale=1/Calculate.h):
+    ''' Write a store out in the CSV layout of Calculate.Export_Energy
+
+    The energies are written to fname with one row per state, using the
+    labels of the states at the given point. If the store has eigenstates
+    the composition of the states at that point is written by
+    Calculate.Export_State_Comp to fname with "_States" appended.
+
+    Args:
+        path (str) - directory of the store
+        fname (str) - file name for the energies, .csv is appended if not present
+
+    kwargs:
+        field (int) - column of the fields to use for the field values (default = 0, B)
+        point (int) - field point to take the labels and state composition from (default = -1, the last)
+        dp (int) - number of decimal places in the output (default = 6)
+        scale (float) - factor applied to the energies, the default converts from J to Hz
+    '''
+    info = Store_Info(path)
+    columns = info["columns"]
+    if fname[-4:] == ".csv":
+        fname = fname[:-4]
+
+    energies = scale*numpy.asarray(Read_Store(path,"energies"))
+    dim = energies.shape[1]
+    point = range(energies.shape[0])[point]
+
+    names = [name[len("label:"):] for name in columns
+                                    if name.startswith("label:")]
+    if len(names) > 0:
+        labels = [numpy.asarray(Read_Store(path,name,point,point+1))[0]
+                                                            for name in names]
+        headers = list(names)
+    else:
+        labels = [numpy.arange(dim)]
+        headers = ["State"]
+
+    Fields = None
+    if "fields" in columns:
+        Fields = numpy.asarray(Read_Store(path,"fields"))[:,field]
+
+    Calculate.Export_Energy(fname,energies,Fields,labels=list(labels),
+                                headers=list(headers),dp=dp)
+
+    if "states" in columns:
+        if info["Nmax"] is None or info["constants"] is None:
+            raise ValueError("the store needs Nmax and constants to label "
+                                                            "the basis states")
+        States = numpy.asarray(Read_Store(path,"states",point,point+1))[0]
+        Calculate.Export_State_Comp(fname+"_States",info["Nmax"],
+                    info["constants"]["I1"],info["constants"]["I2"],States,
+                    labels=list(labels),headers=list(headers),dp=dp)
@@ -0,0 +1,112 @@
+from diatom import Hamiltonian
+from diatom import Cache
+import numpy
+import scipy.sparse
+import os
+import pytest
+'''
+Checks that the on-disk cache gives back exactly what was built, and never
+serves an entry built from anything else.
+'''
+
+Constants = Hamiltonian.RbCs
+
+def _mapped(a):
+    ''' True if a is a memory map or a view of one '''
+    while a is not None:
+        if isinstance(a,numpy.memmap):
+            return True
+        a = getattr(a,"base",None)
+    return False
+
+def _equal(A,B):
+    if scipy.sparse.issparse(A):
+        return scipy.sparse.issparse(B) and (A != B).nnz == 0
+    return numpy.array_equal(A,B)
+
+@pytest.mark.parametrize("sparse",[False,True])
+def test_cache_round_trip(tmp_path,sparse):
+    fresh = Hamiltonian.Build_Hamiltonians(1,Constants,True,True,False,
+                                                                sparse=sparse)
+    first = Cache.Build_Hamiltonians(1,Constants,True,True,False,
+                                                sparse=sparse,path=tmp_path)
+    second = Cache.Build_Hamiltonians(1,Constants,True,True,False,
+                                                sparse=sparse,path=tmp_path)
+    for F,A,B in zip(fresh,first,second):
+        assert _equal(F,A) and _equal(F,B)
+    # the terms that are switched on come back memory mapped and read-only
+    for H in second[:3]:
+        data = H.data if sparse else H
+        assert _mapped(data)
+        assert not data.flags.writeable
+    assert second[3] == 0
+
+def test_cache_key():
+    key = Cache.Cache_Key(1,Constants,True)
+    assert key == Cache.Cache_Key(1,dict(Constants),True)
+    changed = dict(Constants)
+    changed['C4'] = 1.01*Constants['C4']
+    assert key != Cache.Cache_Key(1,changed,True)
+    assert key != Cache.Cache_Key(2,Constants,True)
+    assert key != Cache.Cache_Key(1,Constants,True,True)
+    assert key != Cache.Cache_Key(1,Constants,True,sparse=True)
+
+def test_cache_key_format(monkeypatch):
+    key = Cache.Cache_Key(1,Constants,True)
+    monkeypatch.setattr(Cache,"_format",Cache._format+1)
+    assert key != Cache.Cache_Key(1,Constants,True)
+    monkeypatch.undo()
+    monkeypatch.setattr(Cache,"_source","0"*64)
+    assert key != Cache.Cache_Key(1,Constants,True)
+
+def _fill(path,count):
+    ''' count entries in the cache, oldest first, and their keys '''
+    keys = []
+    for Nmax in range(count):
+        Cache.Build_Hamiltonians(Nmax,Constants,path=path)
+        key = Cache.Cache_Key(Nmax,Constants)
+        os.utime(os.path.join(path,key,"manifest.json"),(1000+Nmax,1000+Nmax))
+        keys.append(key)
+    return keys
+
+def _sizes(path,keys):
+    return [Cache._size(os.path.join(path,k)) for k in keys]
+
+def test_evict_least_recently_used(tmp_path):
+    keys = _fill(tmp_path,3)
+    sizes = _sizes(tmp_path,keys)
+    # room for the two newest only
+    Cache.Evict(size=sizes[1]+sizes[2],path=tmp_path)
+    assert sorted(os.listdir(tmp_path)) == sorted(keys[1:])
+
+    # using an entry makes it the most recent
+    keys = _fill(tmp_path,3)
+    Cache.Build_Hamiltonians(0,Constants,path=tmp_path)
+    Cache.Evict(size=sizes[0]+sizes[2],path=tmp_path)
+    assert sorted(os.listdir(tmp_path)) == sorted([keys[0],keys[2]])
+
+def test_evict_keep(tmp_path):
+    keys = _fill(tmp_path,3)
+    Cache.Evict(size=0,path=tmp_path,keep=(keys[0],))
+    assert os.listdir(tmp_path) == [keys[0]]
+
+def test_orphaned_temporary(tmp_path):
+    key = Cache.Cache_Key(1,Constants,True)
+    # left behind by a process that died while writing the entry
+    orphan = os.path.join(tmp_path,key+".tmp-1-"+"0"*32)
+    os.makedirs(orphan)
+    numpy.save(os.path.join(orphan,"H0.npy"),numpy.zeros((2,2)))
+
+    fresh = Hamiltonian.Build_Hamiltonians(1,Constants,True)
+    Hams = Cache.Build_Hamiltonians(1,Constants,True,path=tmp_path)
+    for F,H in zip(fresh,Hams):
+        assert _equal(F,H)
+    assert os.path.isfile(os.path.join(tmp_path,key,"manifest.json"))
+
+    # a recent one may still be being written, so it is not removed
+    Cache.Evict(size=0,path=tmp_path)
+    assert os.listdir(tmp_path) == [os.path.basename(orphan)]
+    # but one more than an hour old is
+    os.utime(orphan,(0,0))
+    Cache.Evict(size=0,path=tmp_path)
+    assert os.listdir(tmp_path) == []
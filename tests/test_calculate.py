@@ -0,0 +1,441 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Legacy
+import numpy
+import scipy.linalg
+import pytest
+'''
+Checks of the solvers and of the analysis of the eigenstates in Calculate
+against direct dense diagonalisation.
+'''
+
+Constants = Hamiltonian.RbCs
+I1 = Constants['I1']
+I2 = Constants['I2']
+B = 181.5e-4
+
+@pytest.fixture(scope="module")
+def Hams():
+    return Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True)
+
+@pytest.fixture(scope="module")
+def sparse_Hams():
+    return Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True,
+                                                                sparse=True)
+
+###############################################################################
+# Solve_Iterative                                                             #
+###############################################################################
+
+@pytest.mark.filterwarnings("error::UserWarning")
+@pytest.mark.parametrize("method",["arpack","lobpcg"])
+@pytest.mark.parametrize("field,k",[(B,10),
+                                    # the lowest two F levels, 5 and 7 fold
+                                    # degenerate at zero field
+                                    (0,12)])
+def test_solve_iterative(sparse_Hams,method,field,k):
+    H0,Hz,HDC,HAC = sparse_Hams
+    H = (H0+field*Hz).tocsr()
+    expected = numpy.linalg.eigvalsh(H.toarray())[:k]
+    energies,states = Calculate.Solve_Iterative(H,k=k,method=method)
+    scale = numpy.amax(numpy.abs(H.diagonal()))
+    assert energies.shape == (k,)
+    assert states.shape == (H.shape[0],k)
+    assert numpy.allclose(energies,expected,rtol=0,atol=1e-8*scale)
+    assert numpy.allclose(states.conj().T.dot(states),numpy.eye(k),atol=1e-8)
+
+@pytest.mark.filterwarnings("error::UserWarning")
+def test_solve_iterative_manifold(Hams):
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Kronecker_Hamiltonians(2,Constants,True)
+    H = H0+B*Hz
+    expected = numpy.linalg.eigvalsh(Hams[0]+B*Hams[1])
+    energies,states = Calculate.Solve_Iterative(H,N=1)
+    lo,hi = Calculate.Manifold_Indices(1,I1,I2)
+    scale = numpy.amax(numpy.abs(H.diagonal()))
+    assert numpy.allclose(energies,expected[lo:hi],rtol=0,atol=1e-8*scale)
+
+###############################################################################
+# Solve_Subset                                                                #
+###############################################################################
+
+@pytest.mark.parametrize("kind",["dense","sparse","kronecker"])
+@pytest.mark.parametrize("selection",["window","count","N"])
+def test_solve_subset(Hams,kind,selection):
+    dense = Hams[0]+B*Hams[1]
+    if kind == "dense":
+        H = dense
+    elif kind == "sparse":
+        H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(2,Constants,True,
+                                                                sparse=True)
+        H = (H0+B*Hz).tocsr()
+    else:
+        H0,Hz,HDC,HAC = Hamiltonian.Build_Kronecker_Hamiltonians(2,Constants,
+                                                                        True)
+        H = H0+B*Hz
+    expected = numpy.linalg.eigvalsh(dense)
+    if selection == "window":
+        # edges half way between levels, so that none sit on the boundary
+        window = (0.5*(expected[9]+expected[10]),
+                                        0.5*(expected[29]+expected[30]))
+        energies,states = Calculate.Solve_Subset(H,window=window)
+        expected = expected[10:30]
+    elif selection == "count":
+        energies,states = Calculate.Solve_Subset(H,count=10)
+        expected = expected[:10]
+    else:
+        energies,states = Calculate.Solve_Subset(H,N=1,I1=I1,I2=I2)
+        lo,hi = Calculate.Manifold_Indices(1,I1,I2)
+        expected = expected[lo:hi]
+        N,MN = Calculate.LabelStates_N_MN(states,2,I1,I2)
+        assert numpy.all(N == 1)
+
+    scale = numpy.amax(numpy.abs(dense))
+    assert numpy.allclose(energies,expected,rtol=0,atol=1e-10*scale)
+    residual = dense.dot(states)-states*energies[None,:]
+    assert numpy.amax(numpy.abs(residual)) < 1e-8*scale
+
+###############################################################################
+# Sweep and the legacy Vary_* functions                                       #
+###############################################################################
+
+def _fields(points=5):
+    fields = numpy.zeros((points,3))
+    fields[:,0] = numpy.linspace(0,2*B,points)
+    fields[:,1] = numpy.linspace(0,1e3,points)
+    fields[:,2] = numpy.linspace(0,1e6,points)
+    return fields
+
+def _direct(Hams,fields):
+    H0,Hz,HDC,HAC = Hams
+    return numpy.array([numpy.linalg.eigvalsh(H0+b*Hz+e*HDC+i*HAC)
+                                                    for b,e,i in fields])
+
+@pytest.mark.parametrize("use_blocks",[False,True])
+def test_sweep(Hams,use_blocks):
+    fields = _fields()
+    expected = _direct(Hams,fields)
+    blocks = Calculate.MF_Blocks(2,I1,I2)[1] if use_blocks else None
+    energies,states = Calculate.Sweep(Hams,fields,blocks=blocks)
+    scale = numpy.amax(numpy.abs(expected))
+    assert energies.shape == expected.shape
+    assert numpy.allclose(energies,expected,rtol=0,atol=1e-12*scale)
+    # the states are eigenvectors of the Hamiltonian at each point
+    H0,Hz,HDC,HAC = Hams
+    for (b,e,i),E,S in zip(fields,energies,states):
+        H = H0+b*Hz+e*HDC+i*HAC
+        assert numpy.allclose(H.dot(S),S*E[None,:],rtol=0,
+                                                        atol=1e-12*scale)
+    only = Calculate.Sweep(Hams,fields,return_states=False,blocks=blocks)
+    assert numpy.allclose(only,expected,rtol=0,atol=1e-12*scale)
+
+def test_sweep_chunks(Hams):
+    fields = _fields(7)
+    whole = Calculate.Sweep(Hams,fields,return_states=False)
+    chunked = Calculate.Sweep(Hams,fields,return_states=False,chunk=2)
+    assert numpy.array_equal(whole,chunked)
+
+def test_legacy_vary(Hams):
+    H0,Hz,HDC,HAC = Hams
+    E,Bz,I = 1e3,B,1e6
+    values = numpy.linspace(0,1,4)
+    scale = numpy.amax(numpy.abs(H0))
+
+    # fields0 is (E,B,I) for the legacy functions
+    for function,column,scan in ((Legacy.Vary_magnetic,0,values*B),
+                                (Legacy.Vary_ElectricDC,1,values*1e4),
+                                (Legacy.Vary_Intensity,2,values*1e7)):
+        fields = numpy.tile([Bz,E,I],(len(values),1))
+        fields[:,column] = scan
+        expected = _direct(Hams,fields).T
+        energies = function(Hams,(E,Bz,I),scan)
+        assert energies.shape == (H0.shape[0],len(values))
+        assert numpy.allclose(energies,expected,rtol=0,atol=1e-12*scale)
+        energies,states = function(Hams,(E,Bz,I),scan,return_states=True)
+        assert states.shape == (H0.shape[0],H0.shape[0],len(values))
+        assert numpy.allclose(energies,expected,rtol=0,atol=1e-12*scale)
+
+    # Vary_Beta rebuilds the anisotropic part at each angle, and keeps the
+    # isotropic part from HAC
+    Nmax = 2
+    a2 = Constants['a2']
+    angles = numpy.linspace(0,numpy.pi/2,4)
+    expected = numpy.array([numpy.linalg.eigvalsh(H0+E*HDC+Bz*Hz+I*
+                        (Hamiltonian.AC_iso(Nmax,Constants['a0'],I1,I2)+
+                        Hamiltonian.AC_aniso(Nmax,a2,beta,I1,I2))/
+                        (2*Hamiltonian.eps0*Hamiltonian.c))
+                        for beta in angles]).T
+    energies = Legacy.Vary_Beta(Hams,(E,Bz,I),angles,(Nmax,I1,I2,a2))
+    assert energies.shape == (H0.shape[0],len(angles))
+    assert numpy.allclose(energies,expected,rtol=0,atol=1e-12*scale)
+
+###############################################################################
+# State tracking                                                              #
+###############################################################################
+
+def _crossing(points=6,n=6,seed=1):
+    ''' slowly rotating states with levels 2 and 3 crossing half way, and
+    the same data with those columns swapped after the crossing, as an
+    energy-ordered solver would give them '''
+    rng = numpy.random.default_rng(seed)
+    U,_ = numpy.linalg.qr(rng.standard_normal((n,n))+
+                                            1j*rng.standard_normal((n,n)))
+    A = rng.standard_normal((n,n))
+    A = 0.02*(A+A.T)
+    t = numpy.linspace(0,1,points)
+    energies = numpy.array([numpy.arange(n,dtype=float) for x in t])
+    energies[:,2] = 2.5-t
+    energies[:,3] = 2+t
+    states = numpy.array([U.dot(scipy.linalg.expm(1j*x*A)) for x in t])
+    swapped_E = energies.copy()
+    swapped_S = states.copy()
+    late = t > 0.5
+    swapped_E[late] = swapped_E[late][:,[0,1,3,2,4,5]]
+    swapped_S[late] = swapped_S[late][:,:,[0,1,3,2,4,5]]
+    return energies,states,swapped_E,swapped_S
+
+@pytest.mark.parametrize("window",[None,0.6])
+def test_sort_smooth_crossing(window):
+    energies,states,E,S = _crossing()
+    E,S = Calculate.Sort_Smooth(E,S,method='optimal',window=window)
+    assert numpy.array_equal(E,energies)
+    assert numpy.array_equal(S,states)
+
+def test_sort_smooth_window():
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(1,Constants,True)
+    fields = numpy.zeros((60,3))
+    fields[:,0] = numpy.linspace(1e-4,3e-2,60)
+    energies,states = Calculate.Sweep((H0,Hz,HDC,HAC),fields)
+    window = 2*numpy.amax(numpy.abs(numpy.diff(energies,axis=0)))
+
+    E,S = Calculate.Sort_Smooth(energies.copy(),states.copy(),
+                                                        method='optimal')
+    Ew,Sw = Calculate.Sort_Smooth(energies.copy(),states.copy(),
+                                            method='optimal',window=window)
+    assert numpy.array_equal(E,Ew)
+    assert numpy.array_equal(S,Sw)
+    # everything is along z, so the levels that cross have different MF and
+    # each tracked level keeps its MF
+    MF = numpy.array([Calculate.LabelStates_F_MF(s,1,I1,I2)[1] for s in S])
+    assert numpy.all(MF == MF[0][None,:])
+    # and some of them did cross
+    assert numpy.any(numpy.diff(E,axis=1) < 0)
+
+###############################################################################
+# Continuation                                                                #
+###############################################################################
+
+def test_sweep_continuation():
+    Hams = Hamiltonian.Build_Hamiltonians(1,Constants,True,True)
+    fields = numpy.zeros((100,3))
+    fields[:,0] = numpy.linspace(1e-4,3e-2,100)
+    fields[:,1] = 1e3
+    energies,states = Calculate.Sweep_Continuation(Hams,fields)
+    direct_E,direct_S = Calculate.Sweep(Hams,fields)
+    scale = numpy.amax(numpy.abs(direct_E))
+
+    assert numpy.allclose(numpy.sort(energies,axis=1),direct_E,rtol=0,
+                                                            atol=1e-12*scale)
+    # the columns follow the levels through the crossings
+    tracked_E,tracked_S = Calculate.Sort_Smooth(direct_E,direct_S,
+                                                        method='optimal')
+    assert numpy.allclose(energies,tracked_E,rtol=0,atol=1e-12*scale)
+    overlap = numpy.abs(numpy.einsum('pik,pik->pk',
+                                            numpy.conj(states),tracked_S))
+    assert numpy.allclose(overlap,1,atol=1e-6)
+    assert numpy.any(numpy.diff(energies,axis=1) < 0)
+
+    assert numpy.array_equal(Calculate.Sweep_Continuation(Hams,fields,
+                                        return_states=False),energies)
+
+###############################################################################
+# Transition dipole moments                                                   #
+###############################################################################
+
+@pytest.fixture(scope="module")
+def States(Hams):
+    # no electric field, so that N and MF are good labels
+    return numpy.linalg.eigh(Hams[0]+B*Hams[1])[1]
+
+@pytest.mark.parametrize("M",[-1,0,1])
+def test_tdm(States,M):
+    D = Calculate.dipole(2,I1,I2,1,M)
+    expected = numpy.einsum('i,ij,jk->k',numpy.conj(States[:,0]),D,
+                                                                States).real
+    assert numpy.allclose(Calculate.TDM(2,I1,I2,M,States,0),expected,
+                                                            rtol=0,atol=1e-12)
+    locs = [1,5,40,71]
+    assert numpy.allclose(Calculate.TDM(2,I1,I2,M,States,0,locs=locs),
+                                            expected[locs],rtol=0,atol=1e-12)
+
+def test_transition_dipoles(States):
+    bra = numpy.arange(0,128)
+    ket = numpy.arange(32,160)
+    full = Calculate.Transition_Dipoles(2,I1,I2,States,bra,ket)
+    for p,M in enumerate([1,0,-1]):
+        D = Calculate.dipole(2,I1,I2,1,M)
+        expected = numpy.einsum('ia,ij,jb->ab',numpy.conj(States[:,bra]),D,
+                                                States[:,ket],optimize=True)
+        assert numpy.allclose(full[p],expected,rtol=0,atol=1e-12)
+
+    selected = Calculate.Transition_Dipoles(2,I1,I2,States,bra,ket,
+                                                            selection=True)
+    # the N = 0 and N = 2 states are mixed very slightly by the quadrupole
+    # coupling, the selection rules ignore that
+    assert numpy.allclose(selected,full,rtol=0,atol=1e-8)
+    # some elements are skipped, the rest are the same
+    assert numpy.any(selected == 0)
+
+    stack = Calculate.Transition_Dipoles(2,I1,I2,numpy.array([States]*2),
+                                                    bra,ket,selection=True)
+    assert stack.shape == (2,3,128,128)
+    assert numpy.array_equal(stack[1],selected)
+
+###############################################################################
+# Compressed states                                                           #
+###############################################################################
+
+def test_compress_states(States):
+    tol = 1e-3
+    compressed,discarded = Calculate.Compress_States(States,tol)
+    dense = compressed.toarray()
+    kept = numpy.abs(States) >= tol
+    assert numpy.array_equal(dense != 0,kept)
+    # only the small components are lost, and the norm that is lost is what
+    # is reported
+    assert numpy.allclose(discarded,
+            numpy.linalg.norm(numpy.where(kept,0,States),axis=0),atol=1e-12)
+    assert numpy.all(discarded <= tol*numpy.sqrt(numpy.sum(~kept,axis=0)))
+    # complex64 rounding of what is kept
+    assert numpy.allclose(dense,numpy.where(kept,States,0),rtol=0,atol=1e-7)
+    assert numpy.allclose(numpy.linalg.norm(dense,axis=0)**2+discarded**2,1,
+                                                                    atol=1e-6)
+
+def test_save_load_compressed(tmp_path,States):
+    compressed,discarded = Calculate.Compress_States(States)
+    fname = str(tmp_path/"single")
+    Calculate.Save_Compressed(fname,compressed,discarded)
+    loaded,loaded_discarded = Calculate.Load_Compressed(fname)
+    assert (loaded != compressed).nnz == 0
+    assert numpy.array_equal(loaded_discarded,discarded.astype(numpy.float32))
+
+    stack,discarded = Calculate.Compress_States(numpy.array([States,
+                                                        States[:,::-1]]))
+    fname = str(tmp_path/"stack.npz")
+    Calculate.Save_Compressed(fname,stack)
+    loaded,loaded_discarded = Calculate.Load_Compressed(fname)
+    assert loaded_discarded is None
+    assert len(loaded) == 2
+    for a,b in zip(loaded,stack):
+        assert (a != b).nnz == 0
+
+def test_export_state_sparse(tmp_path,States):
+    tol = 1e-3
+    N,MN = Calculate.LabelStates_N_MN(States,2,I1,I2)
+    fname = str(tmp_path/"sparse")
+    Calculate.Export_State_Sparse(fname,2,I1,I2,States,labels=[N],
+                                                headers=["N"],dp=9,tol=tol)
+    with open(fname+".csv") as f:
+        assert f.readline() == "# State,N,Basis (N:MN:M1:M2),Re,Im\n"
+    rows = numpy.genfromtxt(fname+".csv",delimiter=',',comments='#',
+                                            usecols=(0,1,3,4))
+    kept = numpy.abs(States) >= tol
+    assert rows.shape[0] == numpy.sum(kept)
+    state = rows[:,0].astype(int)
+    assert numpy.array_equal(rows[:,1],N.real[state])
+    # the components of each state, in basis order
+    expected = States.T[kept.T]
+    assert numpy.allclose(rows[:,2]+1j*rows[:,3],expected,rtol=0,atol=1e-7)
+    # sparse input gives the same file
+    Calculate.Export_State_Sparse(fname+"_compressed",2,I1,I2,
+            Calculate.Compress_States(States,tol)[0],labels=[N],
+                                                headers=["N"],dp=9,tol=tol)
+    assert numpy.allclose(numpy.genfromtxt(fname+"_compressed.csv",
+            delimiter=',',comments='#',usecols=(0,1,3,4)),rows,rtol=0,
+                                                                atol=1e-7)
+
+###############################################################################
+# Field derivatives                                                           #
+###############################################################################
+
+@pytest.fixture(scope="module")
+def derivative_Hams():
+    return Hamiltonian.Build_Hamiltonians(1,Constants,True,True,True)
+
+_point = numpy.array([B,1e3,1e6])
+# steps for the finite differences in B, E and I, small as some of the
+# levels are only ~100 Hz apart here
+_steps = numpy.array([1e-7,1e-1,1e2])
+
+def test_field_derivatives_first(derivative_Hams):
+    fields = numpy.array([_point])
+    energies,states = Calculate.Sweep(derivative_Hams,fields)
+    first = Calculate.Field_Derivatives(derivative_Hams,energies,states)
+    assert first.shape == (3,1,energies.shape[1])
+    for a,step in enumerate(_steps):
+        shift = numpy.zeros(3)
+        shift[a] = step
+        above = Calculate.Sweep(derivative_Hams,fields+shift,
+                                                        return_states=False)
+        below = Calculate.Sweep(derivative_Hams,fields-shift,
+                                                        return_states=False)
+        numerical = (above-below)/(2*step)
+        assert numpy.allclose(first[a],numerical,rtol=0,
+                                    atol=1e-5*numpy.amax(numpy.abs(first[a])))
+
+def test_field_derivatives_second(derivative_Hams):
+    fields = numpy.array([_point])
+    energies,states = Calculate.Sweep(derivative_Hams,fields)
+    first,second = Calculate.Field_Derivatives(derivative_Hams,energies,
+                                                        states,second=True)
+    assert second.shape == (3,3,1,energies.shape[1])
+
+    # the sum over states, written out
+    E = energies[0]
+    S = states[0]
+    M = [S.conj().T.dot(H).dot(S) for H in derivative_Hams[1:]]
+    for i in (0,10,50,90):
+        for a in range(3):
+            for b in range(3):
+                expected = 2*sum((M[a][i,j]*M[b][j,i]).real/(E[i]-E[j])
+                                    for j in range(len(E)) if j != i)
+                assert second[a,b,0,i] == pytest.approx(expected,rel=1e-8)
+    assert numpy.allclose(second,second.transpose(1,0,2,3))
+
+    # and against the change in the first derivatives
+    for a,step in enumerate(_steps):
+        shift = numpy.zeros(3)
+        shift[a] = step
+        above = Calculate.Field_Derivatives(derivative_Hams,
+                                *Calculate.Sweep(derivative_Hams,fields+shift))
+        below = Calculate.Field_Derivatives(derivative_Hams,
+                                *Calculate.Sweep(derivative_Hams,fields-shift))
+        numerical = (above-below)/(2*step)
+        for b in range(3):
+            assert numpy.allclose(second[a,b],numerical[b],rtol=0,
+                                atol=1e-4*numpy.amax(numpy.abs(second[a,b])))
+
+###############################################################################
+# Polarisation                                                                #
+###############################################################################
+
+def test_sweep_polarisation(Hams):
+    angles = numpy.array([0,0.3,numpy.pi/4,1.2,numpy.pi/2])
+    I = 1e7
+    energies,states = Calculate.Sweep_Polarisation(Hams,2,Constants,B=B,
+                                            E=1e2,I=I,Beta=angles,chunk=2)
+    for Beta,E,S in zip(angles,energies,states):
+        H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(2,
+                            dict(Constants,Beta=Beta),True,True,True)
+        H = H0+B*Hz+1e2*HDC+I*HAC
+        scale = numpy.amax(numpy.abs(H))
+        assert numpy.allclose(E,numpy.linalg.eigvalsh(H),rtol=0,
+                                                        atol=1e-12*scale)
+        assert numpy.amax(numpy.abs(H.dot(S)-S*E[None,:])) < 1e-10*scale
+
+    vectors = numpy.column_stack([numpy.sin(angles),numpy.zeros(5),
+                                                            numpy.cos(angles)])
+    assert numpy.allclose(Calculate.Sweep_Polarisation(Hams,2,Constants,B=B,
+                    E=1e2,I=I,polarisation=vectors,return_states=False),
+                    energies,rtol=0,atol=1e-12*numpy.amax(numpy.abs(energies)))
+    with pytest.raises(ValueError):
+        Calculate.Sweep_Polarisation(Hams,2,Constants,B=B)
@@ -0,0 +1,46 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Crossings
+import numpy
+import pytest
+'''
+Checks of the avoided crossings from Crossings.Find_Crossings against a dense
+sweep.
+'''
+
+Constants = Hamiltonian.RbCs
+h = Calculate.h
+
+def test_find_crossings():
+    Hams = Calculate.Build_Hamiltonians(1,Constants,zeeman=True)
+    MF,blocks = Calculate.MF_Blocks(1,Constants['I1'],Constants['I2'])
+    found = Crossings.Find_Crossings(Hams,[0,0,0],[200e-4,0,0],blocks=blocks)
+    assert numpy.all(numpy.diff(found["t"]) >= 0)
+    assert found["solves"] < 2000
+
+    # the N = 0, MF = 2 crossing just above 181.5 G
+    c = numpy.flatnonzero((MF[found["block"]] == 2)&
+                                        (found["fields"][:,0] > 180e-4))
+    assert len(c) == 1
+    c = c[0]
+    assert numpy.array_equal(found["levels"][c],[7,8])
+
+    # brute force, every 1 mG across the crossing
+    block = blocks[found["block"][c]]
+    H0,Hz = [H[block][:,block] for H in Hams[:2]]
+    fields = numpy.zeros((6001,3))
+    fields[:,0] = numpy.linspace(181e-4,187e-4,6001)
+    energies = Calculate.Sweep([H0,Hz,0,0],fields,return_states=False)
+    gap = energies[:,8]-energies[:,7]
+    k = numpy.argmin(gap)
+    assert 0 < k < len(gap)-1
+    assert found["fields"][c,0] == pytest.approx(fields[k,0],abs=1e-7)
+    assert found["gap"][c] <= gap[k]
+    assert found["gap"][c] == pytest.approx(gap[k],rel=1e-3)
+    assert found["gap"][c]/h == pytest.approx(90,rel=0.05)
+
+    # the two states are eigenstates of the full Hamiltonian there
+    H = Hams[0]+found["fields"][c,0]*Hams[1]
+    V = found["states"][c]
+    residual = H.dot(V)-V*found["energies"][c][None,:]
+    assert numpy.amax(numpy.abs(residual)) < 1e-10*numpy.amax(numpy.abs(H))
@@ -0,0 +1,33 @@
+from diatom import Hamiltonian
+from diatom import Effective
+import numpy
+import pytest
+'''
+Checks of the Van Vleck effective Hamiltonians in Effective against the full
+Hamiltonian.
+'''
+
+Constants = Hamiltonian.RbCs
+B = 181.5e-4
+
+@pytest.fixture(scope="module")
+def Hams():
+    return Hamiltonian.Build_Hamiltonians(3,Constants,True,True,True)
+
+def test_effective_error_N0(Hams):
+    terms,powers,P = Effective.Van_Vleck(3,Constants,0,Hams=Hams)
+    fields = numpy.zeros((3,3))
+    fields[:,0] = B
+    fields[:,1] = [250,500,1000]
+    error = Effective.Effective_Error(3,Constants,0,terms,powers,fields,
+                                                                    Hams=Hams)
+    full = Effective.Effective_Sweep(terms,powers,fields,return_states=False)
+    zero = Effective.Effective_Sweep(terms,powers,[[B,0,0]],
+                                                        return_states=False)
+    # tiny compared to the Stark shift the effective Hamiltonian describes
+    shift = numpy.amax(numpy.abs(full-zero),axis=1)
+    assert numpy.all(error < 1e-3*shift)
+    assert error[0] < 1e-9*Constants['Brot']
+    # and the leading error is second order in E
+    ratio = error[1:]/error[:-1]
+    assert numpy.all((ratio > 3.5) & (ratio < 5))
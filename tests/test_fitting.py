@@ -0,0 +1,80 @@
+from diatom import Hamiltonian
+from diatom import Fitting
+import numpy
+import pytest
+'''
+Checks of the fit of molecular constants in Fitting, with synthetic
+measurements made from known constants.
+'''
+
+Constants = Hamiltonian.RbCs
+h = Fitting.h
+
+parameters = ["Brot","C4","Q1","Mu1"]
+
+def _transitions():
+    ''' N = 0 to N = 1 transitions at a few magnetic fields '''
+    rng = numpy.random.default_rng(2)
+    fields = numpy.zeros((24,3))
+    fields[:,0] = numpy.repeat([100e-4,181.5e-4,300e-4],8)
+    fields[:,1] = numpy.repeat([0,1e2,0],8)
+    lower = rng.integers(0,32,24)
+    upper = rng.integers(32,128,24)
+    return fields,lower,upper
+
+def _direct(Constants,fields,lower,upper):
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(1,Constants,True,True,
+                                                                        True)
+    energies = numpy.array([numpy.linalg.eigvalsh(H0+b*Hz+e*HDC+i*HAC)
+                                                    for b,e,i in fields])
+    index = numpy.arange(len(lower))
+    return (energies[index,upper]-energies[index,lower])/h
+
+def test_transition_frequencies():
+    fields,lower,upper = _transitions()
+    model = Fitting.Fit_Model(1,Constants,parameters)
+    values = numpy.array([Constants[name] for name in parameters])
+    frequencies,J = Fitting.Transition_Frequencies(model,values,fields,
+                                                lower,upper,jacobian=True)
+    expected = _direct(Constants,fields,lower,upper)
+    assert numpy.allclose(frequencies,expected,rtol=1e-12,atol=1e-3)
+    assert numpy.allclose(frequencies,Fitting.Transition_Frequencies(
+                        model,values,fields,lower,upper),rtol=1e-12,atol=1e-3)
+
+    # the Hellmann-Feynman Jacobian against finite differences
+    for p,x in enumerate(values):
+        step = 1e-5*abs(x)
+        shifted = values.copy()
+        shifted[p] = x+step
+        above = Fitting.Transition_Frequencies(model,shifted,fields,lower,
+                                                                        upper)
+        shifted[p] = x-step
+        below = Fitting.Transition_Frequencies(model,shifted,fields,lower,
+                                                                        upper)
+        numerical = (above-below)/(2*step)
+        assert numpy.allclose(J[:,p],numerical,rtol=0,
+                                atol=1e-5*numpy.amax(numpy.abs(J[:,p])))
+
+def test_fit_constants():
+    fields,lower,upper = _transitions()
+    frequencies = _direct(Constants,fields,lower,upper)
+
+    start = dict(Constants)
+    for name,factor in zip(parameters,(1+1e-4,1.05,0.97,1.02)):
+        start[name] = factor*Constants[name]
+
+    fitted,result = Fitting.Fit_Constants(1,start,parameters,fields,lower,
+                                            upper,frequencies,
+                                            uncertainties=numpy.ones(24))
+    assert result.success
+    for name in parameters:
+        assert fitted[name] == pytest.approx(Constants[name],rel=1e-7)
+    for name in Constants:
+        if name not in parameters:
+            assert fitted[name] == Constants[name]
+    assert result.covariance.shape == (4,4)
+    assert numpy.all(numpy.diag(result.covariance) > 0)
+
+def test_fit_unknown_constant():
+    with pytest.raises(ValueError):
+        Fitting.Fit_Model(1,Constants,["Brot","spam"])
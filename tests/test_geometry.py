@@ -0,0 +1,69 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Geometry
+import numpy
+import warnings
+import pytest
+'''
+Checks of the Hamiltonian for fields in any direction in Geometry.
+'''
+
+Constants = Hamiltonian.RbCs
+
+@pytest.fixture(scope="module")
+def terms():
+    return Geometry.Geometry_Terms(1,Constants)
+
+def _rotation(rng):
+    ''' a random proper rotation matrix '''
+    Q,R = numpy.linalg.qr(rng.standard_normal((3,3)))
+    Q = Q*numpy.sign(numpy.diag(R))[None,:]
+    if numpy.linalg.det(Q) < 0:
+        Q[:,0] = -Q[:,0]
+    return Q
+
+def test_geometry_along_z(terms):
+    fields = numpy.zeros((4,3))
+    fields[:,0] = numpy.linspace(0,3e-2,4)
+    fields[:,1] = numpy.linspace(0,1e4,4)
+    zero = numpy.zeros(4)
+    Bvec = numpy.column_stack([zero,zero,fields[:,0]])
+    Evec = numpy.column_stack([zero,zero,fields[:,1]])
+    energies = Geometry.Geometry_Sweep(1,Constants,Bvec,Evec,terms=terms,
+                                                        return_states=False)
+    Hams = Hamiltonian.Build_Hamiltonians(1,Constants,True,True)
+    expected = Calculate.Sweep(Hams,fields,return_states=False)
+    assert numpy.allclose(energies,expected,rtol=0,
+                                    atol=1e-12*numpy.amax(numpy.abs(expected)))
+
+def test_geometry_rotation(terms):
+    ''' with no laser the spectrum only depends on the fields relative to
+    each other '''
+    rng = numpy.random.default_rng(3)
+    Bvec,Evec = Geometry.Field_Vectors(181.5e-4,1e4,0.6,0.2)
+    rotations = [_rotation(rng) for k in range(4)]
+    Bs = numpy.array([R.dot(Bvec[0]) for R in rotations])
+    Es = numpy.array([R.dot(Evec[0]) for R in rotations])
+    energies = Geometry.Geometry_Sweep(1,Constants,Bs,Es,terms=terms,
+                                                        return_states=False)
+    expected = Geometry.Geometry_Sweep(1,Constants,Bvec,Evec,terms=terms,
+                                                        return_states=False)
+    assert numpy.allclose(energies,expected,rtol=0,
+                                    atol=1e-12*numpy.amax(numpy.abs(expected)))
+
+    # the angle between the fields does matter
+    theta = numpy.array([0,0.6,numpy.pi/2])
+    angles = Geometry.Angle_Sweep(1,Constants,181.5e-4,1e4,theta,
+                                        terms=terms,return_states=False)
+    assert numpy.allclose(angles[1],expected[0],rtol=0,
+                                    atol=1e-12*numpy.amax(numpy.abs(expected)))
+    assert not numpy.allclose(angles[0],angles[2],rtol=1e-9,atol=0)
+
+def test_geometry_dropped_field(terms):
+    Bvec,Evec = Geometry.Field_Vectors(181.5e-4,1e4,0.6)
+    # terms were made without the ac Stark shift
+    with pytest.warns(UserWarning):
+        Geometry.Geometry_Sweep(1,Constants,Bvec,Evec,I=1e7,terms=terms)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        Geometry.Geometry_Sweep(1,Constants,Bvec,Evec,terms=terms)
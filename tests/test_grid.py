@@ -0,0 +1,75 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Grid
+import numpy
+import json
+import os
+import pytest
+'''
+Checks of the grid scanner against a direct build and diagonalisation at
+each point, and of resuming an interrupted scan.
+'''
+
+Constants = Hamiltonian.RbCs
+I1 = Constants['I1']
+I2 = Constants['I2']
+Nmax = 1
+
+axes = {"B":[0,1e-2],"E":[0,1e4],"I":[1e6,1e7],"Beta":[0,0.3,numpy.pi/2]}
+
+def _direct(B,E,I,Beta):
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(Nmax,Constants,True,True)
+    AC = (Hamiltonian.AC_iso(Nmax,Constants['a0'],I1,I2)+
+            Hamiltonian.AC_aniso(Nmax,Constants['a2'],Beta,I1,I2))/\
+            (2*Hamiltonian.eps0*Hamiltonian.c)
+    return numpy.linalg.eigvalsh(H0+B*Hz+E*HDC+I*AC)
+
+def test_grid_scan(tmp_path):
+    energies,states = Grid.Grid_Scan(str(tmp_path),Nmax,Constants,
+                                        return_states=True,chunk=5,**axes)
+    dim = energies.shape[-1]
+    assert energies.shape == (2,2,2,3,dim)
+    assert states.shape == (2,2,2,3,dim,dim)
+    scale = numpy.amax(numpy.abs(energies))
+    for index in numpy.ndindex(*energies.shape[:-1]):
+        point = [axes[k][i] for k,i in zip(Grid._axes,index)]
+        assert numpy.allclose(energies[index],_direct(*point),rtol=0,
+                                                        atol=1e-12*scale)
+
+def test_grid_resume(tmp_path):
+    reference = numpy.array(Grid.Grid_Scan(str(tmp_path/"whole"),Nmax,
+                                                    Constants,**axes))
+    path = str(tmp_path/"parts")
+    Grid.Grid_Scan(path,Nmax,Constants,chunk=5,**axes)
+
+    # interrupted after 10 points, and then carried on in different chunks
+    energies = numpy.load(os.path.join(path,"energies.npy"),mmap_mode="r+")
+    energies.reshape(-1,energies.shape[-1])[10:] = 0
+    energies.flush()
+    del energies
+    with open(os.path.join(path,"progress.json"),"w") as f:
+        json.dump({"done":10},f)
+    energies = Grid.Grid_Scan(path,Nmax,Constants,chunk=7,**axes)
+    assert numpy.array_equal(energies,reference)
+
+    # interrupted before the first progress was written
+    os.remove(os.path.join(path,"progress.json"))
+    energies = Grid.Grid_Scan(path,Nmax,Constants,chunk=3,**axes)
+    assert numpy.array_equal(energies,reference)
+
+def test_grid_different_scan(tmp_path):
+    Grid.Grid_Scan(str(tmp_path),Nmax,Constants,B=[0,1e-2])
+    with pytest.raises(ValueError):
+        Grid.Grid_Scan(str(tmp_path),Nmax,Constants,B=[0,2e-2])
+
+def test_grid_blocks(tmp_path):
+    blocks = Calculate.MF_Blocks(Nmax,I1,I2)[1]
+    energies = Grid.Grid_Scan(str(tmp_path),Nmax,Constants,B=[0,1e-2],
+                        E=1e4,I=1e7,Beta=[0,numpy.pi],blocks=blocks)
+    for b,B in enumerate([0,1e-2]):
+        for a,Beta in enumerate([0,numpy.pi]):
+            assert numpy.allclose(energies[b,0,0,a],_direct(B,1e4,1e7,Beta),
+                    rtol=0,atol=1e-12*numpy.amax(numpy.abs(energies)))
+    with pytest.raises(ValueError):
+        Grid.Grid_Scan(str(tmp_path/"angle"),Nmax,Constants,I=1e7,
+                                                    Beta=0.3,blocks=blocks)
@@ -0,0 +1,196 @@
+from diatom import Hamiltonian
+import numpy
+import scipy.constants
+import os
+import pytest
+'''
+Checks of the angular momentum coupling coefficients and of the matrices made
+by Build_Hamiltonians, so that a faster version of either can not silently
+change the answer.
+'''
+
+h = scipy.constants.h
+
+Outputs = os.path.join(os.path.dirname(os.path.dirname(
+                        os.path.abspath(__file__))),"Example Scripts","Outputs")
+
+molecules = {"RbCs":Hamiltonian.RbCs,
+             "K41Cs":Hamiltonian.K41Cs,
+             "K40Rb":Hamiltonian.K40Rb}
+
+###############################################################################
+# Wigner symbols                                                              #
+###############################################################################
+
+@pytest.mark.parametrize("args,value",[
+    ((1,1,0,0,0,0),-1/numpy.sqrt(3)),
+    ((1,1,2,0,0,0),numpy.sqrt(2/15)),
+    ((0.5,0.5,1,0.5,-0.5,0),1/numpy.sqrt(6)),
+    ((2,2,2,0,0,0),-numpy.sqrt(2/35)),
+    # selection rules: m's do not sum to zero, |m| > j and triangle
+    ((1,1,1,1,1,0),0),
+    ((1,1,0,2,-2,0),0),
+    ((1,1,3,0,0,0),0)])
+def test_wigner_3j_values(args,value):
+    assert Hamiltonian.Wigner_3j(*args) == pytest.approx(value,abs=1e-14)
+
+@pytest.mark.parametrize("args,value",[
+    ((1,1,1,1,1,1),1/6),
+    ((0.5,0.5,1,0.5,0.5,0),1/2),
+    ((2,2,2,2,2,2),-3/70),
+    ((1,1,3,1,1,1),0)])
+def test_wigner_6j_values(args,value):
+    assert Hamiltonian.Wigner_6j(*args) == pytest.approx(value,abs=1e-14)
+
+@pytest.mark.parametrize("args,value",[
+    ((1,1,0,1,1,0,0,0,0),1/3),
+    ((1,1,1,1,1,1,1,1,1),0),
+    ((1,1,2,1,1,2,2,2,2),-1/150)])
+def test_wigner_9j_values(args,value):
+    assert Hamiltonian.Wigner_9j(*args) == pytest.approx(value,abs=1e-14)
+
+def test_wigner_3j_block():
+    j1,j2,j3 = 3.5,2,1.5
+    W = Hamiltonian.Wigner_3j_block(j1,j2,j3)
+    assert W.shape == (8,5,4)
+    for a,m1 in enumerate(numpy.arange(j1,-j1-1,-1)):
+        for b,m2 in enumerate(numpy.arange(j2,-j2-1,-1)):
+            for c,m3 in enumerate(numpy.arange(j3,-j3-1,-1)):
+                assert W[a,b,c] == pytest.approx(
+                        Hamiltonian.Wigner_3j(j1,j2,j3,m1,m2,m3),abs=1e-15)
+
+def test_wigner_against_sympy():
+    wigner = pytest.importorskip("sympy.physics.wigner")
+    js = numpy.arange(0,2.5,0.5)
+    for j1 in js:
+        for j2 in js:
+            for j3 in js:
+                if (j1+j2+j3)%1:
+                    continue
+                for m1 in numpy.arange(-j1,j1+1):
+                    for m2 in numpy.arange(-j2,j2+1):
+                        m3 = -m1-m2
+                        if abs(m3) > j3:
+                            continue
+                        expected = float(wigner.wigner_3j(
+                                            *[wigner.Rational(int(2*x),2)
+                                            for x in (j1,j2,j3,m1,m2,m3)]))
+                        assert Hamiltonian.Wigner_3j(j1,j2,j3,m1,m2,m3) == \
+                                        pytest.approx(expected,abs=1e-13)
+    for j in ((1,2,3,1,2,2),(1.5,1,2.5,2,1.5,1),(2,2,2,1,1,1)):
+        expected = float(wigner.wigner_6j(*[wigner.Rational(int(2*x),2)
+                                                                for x in j]))
+        assert Hamiltonian.Wigner_6j(*j) == pytest.approx(expected,abs=1e-13)
+    for j in ((1,1,2,1,2,1,2,1,1),(0.5,0.5,1,1.5,1.5,1,1,2,1)):
+        expected = float(wigner.wigner_9j(*[wigner.Rational(int(2*x),2)
+                                                    for x in j],prec=None))
+        assert Hamiltonian.Wigner_9j(*j) == pytest.approx(expected,abs=1e-13)
+
+###############################################################################
+# Polarisation                                                                #
+###############################################################################
+
+angles = [0,0.3,numpy.pi/4,1.2,numpy.pi/2,2.5]
+
+def test_polarisation_weights():
+    I1,I2 = 1.5,3.5
+    a2 = Hamiltonian.RbCs['a2']
+    components = Hamiltonian.AC_aniso_components(2,a2,I1,I2)
+    weights = Hamiltonian.Polarisation_Weights(numpy.array(angles))
+    assert weights.shape == (len(angles),5)
+    for Beta,w in zip(angles,weights):
+        expected = Hamiltonian.AC_aniso(2,a2,Beta,I1,I2)
+        scale = numpy.amax(abs(expected))
+        assert numpy.allclose(sum(x*A for x,A in zip(w,components)),expected,
+                                                    rtol=0,atol=1e-14*scale)
+        # linear polarisation in the xz plane at Beta to z
+        vector = Hamiltonian.Polarisation_Weights(
+                        polarisation=[numpy.sin(Beta),0,numpy.cos(Beta)])
+        assert numpy.allclose(vector,w,rtol=0,atol=1e-14)
+        assert numpy.allclose(Hamiltonian.AC_aniso(2,a2,0,I1,I2,
+                polarisation=[numpy.sin(Beta),0,numpy.cos(Beta)]),expected,
+                                                    rtol=0,atol=1e-14*scale)
+
+###############################################################################
+# Build_Hamiltonians                                                          #
+###############################################################################
+
+@pytest.mark.parametrize("molecule",list(molecules))
+def test_build_sparse_matches_dense(molecule):
+    Constants = molecules[molecule]
+    dense = Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True)
+    sparse = Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True,
+                                                                sparse=True)
+    for D,S in zip(dense,sparse):
+        assert numpy.allclose(S.toarray(),D,rtol=0,
+                                            atol=1e-12*numpy.amax(abs(D)))
+        assert numpy.allclose(D,D.conj().T,rtol=0,
+                                            atol=1e-12*numpy.amax(abs(D)))
+
+@pytest.mark.parametrize("molecule",list(molecules))
+def test_build_kronecker_matches_dense(molecule):
+    Constants = molecules[molecule]
+    dense = Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True)
+    kron = Hamiltonian.Build_Kronecker_Hamiltonians(2,Constants,True,True,
+                                                                        True)
+    X = numpy.random.default_rng(0).standard_normal((dense[0].shape[0],3))
+    for D,K in zip(dense,kron):
+        assert numpy.allclose(K.dot(X),D.dot(X),rtol=0,
+                                atol=1e-12*numpy.amax(abs(D))*X.shape[0])
+
+def test_build_reference_energies():
+    ''' RbCs at Nmax = 3 and 181.5 G against Example Scripts/Outputs '''
+    Constants = Hamiltonian.RbCs
+    H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(3,Constants,True)
+    energies = numpy.linalg.eigvalsh(H0+181.5e-4*Hz)/h
+    reference = numpy.genfromtxt(os.path.join(Outputs,
+                    "TDMB_181.5G Nmax_3.csv"),delimiter=',',comments='#')[:,5]
+    # the reference file has 6 decimal places
+    assert numpy.amax(numpy.abs(energies-reference)) < 1e-3
+
+###############################################################################
+# CompiledMolecule                                                            #
+###############################################################################
+
+def _close(A,B):
+    if not numpy.isscalar(B) or B != 0:
+        scale = numpy.amax(abs(B))
+        assert numpy.allclose(A,B,rtol=0,atol=1e-13*scale)
+    else:
+        assert A == 0
+
+def test_compiled_molecule_build():
+    # RbCs and 41KCs have the same nuclear spins, so share one compiled basis
+    molecule = Hamiltonian.Compile_Molecule(2,1.5,3.5)
+    assert Hamiltonian.Compile_Molecule(2,1.5,3.5) is molecule
+    for name in ("RbCs","K41Cs"):
+        Constants = molecules[name]
+        expected = Hamiltonian.Build_Hamiltonians(2,Constants,True,True,True)
+        for H,D in zip(molecule.Build(Constants,True,True,True),expected):
+            _close(H,D)
+        for H,D in zip(molecule.Build(Constants,True,True,True,sparse=True),
+                                                                    expected):
+            _close(H.toarray(),D)
+        # switched off terms are zero, as from Build_Hamiltonians
+        for H,D in zip(molecule.Build(Constants,zeeman=True),
+                        Hamiltonian.Build_Hamiltonians(2,Constants,True)):
+            _close(H,D)
+    with pytest.raises(ValueError):
+        molecule.Build(Hamiltonian.K40Rb)
+
+@pytest.mark.parametrize("Beta",[0,0.7])
+def test_compiled_molecule_unit(Beta):
+    molecule = Hamiltonian.Compile_Molecule(2,1.5,3.5)
+    for name in ("RbCs","K41Cs"):
+        Constants = dict(molecules[name],Beta=Beta)
+        H0,Hz,HDC,HAC = Hamiltonian.Build_Hamiltonians(2,Constants,True,True,
+                                                                        True)
+        groups = ((H0,("Brot","Drot","Q1","Q2","C1","C2","C3","C4")),
+                  (Hz,("Mu1","Mu2","MuN")),
+                  (HDC,("d0",)),
+                  (HAC,("a0","a2")))
+        for D,names in groups:
+            _close(sum(Constants[n]*molecule.Unit(n,Beta) for n in names),D)
+        _close(molecule.Build(Constants,AC=True)[3],HAC)
+    with pytest.raises(ValueError):
+        molecule.Unit("spam")
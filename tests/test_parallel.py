@@ -0,0 +1,46 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Parallel
+import numpy
+import pytest
+'''
+Checks that the process pool gives the same results as Calculate.Sweep.
+'''
+
+Constants = Hamiltonian.RbCs
+
+@pytest.fixture(scope="module")
+def Hams():
+    return Hamiltonian.Build_Hamiltonians(1,Constants,True,True,True)
+
+def _fields(points=9):
+    fields = numpy.zeros((points,3))
+    fields[:,0] = numpy.linspace(0,2e-2,points)
+    fields[:,1] = numpy.linspace(0,1e4,points)
+    return fields
+
+@pytest.mark.skipif(Parallel.shared_memory is None,
+                                    reason="needs multiprocessing.shared_memory")
+def test_parallel_sweep(Hams):
+    fields = _fields()
+    energies,states = Calculate.Sweep(Hams,fields)
+    scale = numpy.amax(numpy.abs(energies))
+    # chunks of 2 points give the workers an uneven share
+    result = Parallel.Parallel_Sweep(Hams,fields,workers=2,chunk=2)
+    assert numpy.allclose(result[0],energies,rtol=0,atol=1e-14*scale)
+    overlap = numpy.abs(numpy.sum(numpy.conj(result[1])*states,axis=1))
+    assert numpy.allclose(overlap,1)
+    only = Parallel.Parallel_Sweep(Hams,fields,return_states=False,workers=2)
+    assert numpy.allclose(only,energies,rtol=0,atol=1e-14*scale)
+
+def test_parallel_one_worker(Hams):
+    fields = _fields()
+    energies,states = Calculate.Sweep(Hams,fields)
+    result = Parallel.Parallel_Sweep(Hams,fields,workers=1)
+    assert numpy.array_equal(result[0],energies)
+    assert numpy.array_equal(result[1],states)
+    # never more workers than points
+    only = Parallel.Parallel_Sweep(Hams,fields[:1],return_states=False,
+                                                                workers=4)
+    assert numpy.array_equal(only,Calculate.Sweep(Hams,fields[:1],
+                                                        return_states=False))
@@ -0,0 +1,91 @@
+from diatom import Hamiltonian
+from diatom import Profiling
+import numpy
+import scipy.sparse
+import json
+import time
+import pytest
+'''
+Checks of what Profiling records for nested stages, and that nothing is
+recorded while it is switched off.
+'''
+
+@Profiling.profiled("test.inner")
+def _inner(n):
+    time.sleep(0.01)
+    return numpy.zeros((n,n))
+
+@Profiling.profiled("test.outer")
+def _outer():
+    small = _inner(2)
+    large = _inner(5)
+    operators = numpy.empty(2,dtype=object)
+    operators[0] = scipy.sparse.identity(3,format='csr')
+    operators[1] = scipy.sparse.identity(7,format='csr')
+    return small,[large,operators]
+
+def test_nested_stages():
+    with Profiling.Profile() as profile:
+        _outer()
+        with Profiling.section("test.section") as stage:
+            _inner(3)
+            stage.result = numpy.zeros(4)
+    stages = profile.Results()
+    assert stages["test.inner"]["calls"] == 3
+    assert stages["test.outer"]["calls"] == 1
+    assert stages["test.section"]["calls"] == 1
+    # nested stages are each timed in full
+    assert stages["test.inner"]["time"] >= 0.03
+    assert stages["test.outer"]["time"] >= 0.02
+    assert stages["test.section"]["time"] >= 0.01
+    assert stages["test.inner"]["max_time"] <= stages["test.inner"]["time"]
+    assert stages["test.inner"]["allocated"] is None
+    # the largest matrix, found inside the tuple, list and object array
+    assert stages["test.inner"]["shape"] == [5,5]
+    assert stages["test.outer"]["shape"] == [7,7]
+    assert stages["test.section"]["shape"] == [4]
+    # slowest first
+    times = [s["time"] for s in stages.values()]
+    assert times == sorted(times,reverse=True)
+
+def test_diatom_stages():
+    with Profiling.Profile() as profile:
+        Hamiltonian.Build_Hamiltonians(1,Hamiltonian.RbCs,True,sparse=True)
+    stages = profile.Results()
+    assert stages["Hamiltonian.Build_Hamiltonians"]["calls"] == 1
+    assert stages["Hamiltonian.Build_Hamiltonians"]["shape"] == [128,128]
+    assert stages["Hamiltonian.Hyperfine_Ham"]["time"] <= \
+                            stages["Hamiltonian.Build_Hamiltonians"]["time"]
+
+def test_profiling_off():
+    profile = Profiling.Profile()
+    _outer()
+    profile.Start()
+    _inner(2)
+    profile.Stop()
+    _outer()
+    with Profiling.section("test.section"):
+        _inner(2)
+    assert list(profile.Results()) == ["test.inner"]
+    assert profile.Results()["test.inner"]["calls"] == 1
+    profile.Reset()
+    assert profile.Results() == {}
+
+def test_memory():
+    with Profiling.Profile(memory=True) as profile:
+        _outer()
+    stages = profile.Results()
+    # 5x5 float64 is 200 bytes
+    assert stages["test.inner"]["allocated"] >= 200
+    assert stages["test.outer"]["allocated"] >= \
+                                            stages["test.inner"]["allocated"]
+
+def test_save(tmp_path):
+    with Profiling.Profile() as profile:
+        _outer()
+    fname = str(tmp_path/"profile")
+    profile.Save(fname)
+    with open(fname+".json") as f:
+        saved = json.load(f)
+    assert saved == {"memory":False,"stages":profile.Results()}
+    assert "test.outer" in profile.Table()
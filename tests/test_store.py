@@ -0,0 +1,97 @@
+from diatom import Hamiltonian
+from diatom import Calculate
+from diatom import Store
+import numpy
+import os
+import pytest
+'''
+Checks that results written to a store come back unchanged, and that a store
+gives the same CSV files as the Export functions in Calculate.
+'''
+
+Constants = Hamiltonian.RbCs
+I1 = Constants['I1']
+I2 = Constants['I2']
+
+@pytest.fixture(scope="module")
+def sweep():
+    Hams = Hamiltonian.Build_Hamiltonians(1,Constants,True,True)
+    fields = numpy.zeros((7,3))
+    fields[:,0] = numpy.linspace(1e-4,2e-2,7)
+    fields[:,1] = numpy.linspace(0,1e3,7)
+    energies,states = Calculate.Sweep(Hams,fields)
+    N,MN = Calculate.LabelStates_N_MN(states,1,I1,I2)
+    F,MF = Calculate.LabelStates_F_MF(states,1,I1,I2)
+    return Hams,fields,energies,states,{"N":N.real,"MF":MF.real}
+
+def test_store_round_trip(tmp_path,sweep):
+    Hams,fields,energies,states,labels = sweep
+    path = str(tmp_path/"store")
+    Store.Create_Store(path,1,Constants,metadata={"note":"test"})
+    # three chunks of uneven size
+    for start,stop in ((0,3),(3,4),(4,7)):
+        Store.Append_Store(path,energies[start:stop],fields[start:stop],
+                    states[start:stop],
+                    {k:v[start:stop] for k,v in labels.items()})
+
+    info = Store.Store_Info(path)
+    assert info["points"] == 7
+    assert info["Nmax"] == 1
+    assert info["metadata"] == {"note":"test"}
+    assert info["constants"]["I1"] == I1
+
+    assert numpy.array_equal(Store.Read_Store(path,"energies"),energies)
+    assert numpy.array_equal(Store.Read_Store(path,"states"),states)
+    # across a chunk boundary, with and without memory mapping
+    for mmap in (True,False):
+        assert numpy.array_equal(Store.Read_Store(path,"fields",2,5,mmap=mmap),
+                                                                fields[2:5])
+    assert numpy.array_equal(Store.Read_Store(path,"MF",3,4),
+                                                        labels["MF"][3:4])
+
+    results = Store.Load_Store(path,states=False)
+    assert "states" not in results
+    assert numpy.array_equal(results["energies"],energies)
+    for k,v in labels.items():
+        assert numpy.array_equal(results["labels"][k],v)
+
+    with pytest.raises(ValueError):
+        Store.Append_Store(path,energies[:1])
+    with pytest.raises(ValueError):
+        Store.Create_Store(path)
+
+def test_store_to_csv(tmp_path,sweep):
+    Hams,fields,energies,states,labels = sweep
+    path = str(tmp_path/"store")
+    Store.Create_Store(path,1,Constants)
+    Store.Append_Store(path,energies[:4],fields[:4],states[:4],
+                                    {k:v[:4] for k,v in labels.items()})
+    Store.Append_Store(path,energies[4:],fields[4:],states[4:],
+                                    {k:v[4:] for k,v in labels.items()})
+    Store.Store_To_CSV(path,str(tmp_path/"store_csv"))
+
+    Calculate.Export_Energy(str(tmp_path/"direct"),energies*(1/Calculate.h),
+            fields[:,0],labels=[labels["N"][-1],labels["MF"][-1]],
+            headers=["N","MF"])
+    Calculate.Export_State_Comp(str(tmp_path/"direct_States"),1,I1,I2,
+            states[-1],labels=[labels["N"][-1],labels["MF"][-1]],
+            headers=["N","MF"])
+    for a,b in (("store_csv.csv","direct.csv"),
+                ("store_csv_States.csv","direct_States.csv")):
+        with open(os.path.join(tmp_path,a)) as f:
+            stored = f.read()
+        with open(os.path.join(tmp_path,b)) as f:
+            direct = f.read()
+        assert stored == direct
+
+def test_store_sweep(tmp_path,sweep):
+    Hams,fields,energies,states,labels = sweep
+    path = str(tmp_path/"store")
+    Store.Store_Sweep(path,Hams,fields,1,Constants,return_states=True,
+                                                chunk=3,labels=["N","MF"])
+    results = Store.Load_Store(path)
+    assert numpy.array_equal(results["energies"],energies)
+    assert numpy.array_equal(results["states"],states)
+    assert numpy.array_equal(results["fields"],fields)
+    for k,v in labels.items():
+        assert numpy.array_equal(results["labels"][k],v)